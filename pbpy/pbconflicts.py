@@ -0,0 +1,135 @@
+import os
+from collections import namedtuple
+
+from pbpy import pbgit, pbgitindex, pblog, pbtools
+
+# finds the files a pull would fail on before it touches the working tree, from the commits and the status alone
+# a failed rebase on a big project costs its checkout and the abort, and may leave LFS files half checked out
+
+Conflict = namedtuple("Conflict", ["path", "reason"])
+
+# for git merge-tree --write-tree
+merge_tree_git_version = (2, 38)
+
+
+def get_changed_files(*revs, diff_filter=None):
+    """Returns the files git diff --name-only reports between revs, or None if git failed."""
+    cmd = [pbgit.get_git_executable(), "diff", "--name-only", "--no-renames", "-z"]
+    if diff_filter is not None:
+        cmd.append(f"--diff-filter={diff_filter}")
+    diff = pbtools.iter_output(cmd + list(revs))
+    files = {file for file in diff if file}
+    if diff.returncode:
+        pblog.warning(
+            f"Could not list the files changed in {' '.join(revs)}: {diff.error}"
+        )
+        return None
+    return files
+
+
+def get_binary_files(files):
+    """Returns the files which git can not merge: Unreal assets, and everything in LFS."""
+    files = sorted(files)
+    binary = {
+        file for file in files if file.lower().endswith(pbgitindex.lockable_extensions)
+    }
+    return binary | set(pbgit.get_lfs_files(files))
+
+
+def get_merge_conflicts(upstream):
+    """Returns the files a merge of HEAD and upstream conflicts on, without a working tree, or None if this git can not tell."""
+    if pbgit.get_git_version_tuple() < merge_tree_git_version:
+        return None
+    records = pbtools.iter_output(
+        [
+            pbgit.get_git_executable(),
+            "merge-tree",
+            "--write-tree",
+            "--name-only",
+            "--no-messages",
+            "-z",
+            "HEAD",
+            upstream,
+        ]
+    )
+    # the merged tree comes first, then the conflicted files
+    files = [record for record in records if record][1:]
+    # 1 means conflicts, anything else failed
+    if records.returncode not in (0, 1):
+        pblog.warning(f"Could not merge {upstream} in memory: {records.error}")
+        return None
+    return set(files)
+
+
+def get_untracked_collisions(added):
+    """Returns the untracked files in the working tree which upstream adds as well."""
+    existing = [file for file in added if os.path.lexists(file)]
+    if not existing:
+        return set()
+    untracked = set()
+    for proc in pbtools.run_batched(
+        [
+            pbgit.get_git_executable(),
+            "--literal-pathspecs",
+            "ls-files",
+            "-z",
+            "--others",
+            "--exclude-standard",
+            "--",
+        ],
+        existing,
+    ):
+        untracked.update(file for file in proc.stdout.split("\0") if file)
+    return untracked
+
+
+def find_conflicts(branch_name, status):
+    """Returns the conflicts which would make pulling origin/branch_name into status fail, and warns about the ones which may.
+
+    Pulls fast forward when nothing is unpushed, which git refuses for any local change upstream changes too.
+    Rebases replay the unpushed commits, and restore the local changes from the autostash afterwards.
+    Nothing is found when git could not tell, so the pull goes ahead as before.
+    """
+    upstream = f"origin/{branch_name}"
+    upstream_changes = get_changed_files(f"HEAD...{upstream}")
+    if not upstream_changes:
+        return []
+    uncommitted = upstream_changes.intersection(status.get_changed_paths(True))
+    conflicts = []
+    warnings = []
+    if status.branch.ahead == 0:
+        for file in sorted(uncommitted):
+            conflicts.append(Conflict(file, "changed locally and upstream"))
+        added = get_changed_files(f"HEAD...{upstream}", diff_filter="A") or set()
+        for file in sorted(get_untracked_collisions(added)):
+            conflicts.append(Conflict(file, "untracked locally, added upstream"))
+        return conflicts
+
+    # files the unpushed commits change, which upstream changed to something else
+    unpushed = get_changed_files(f"{upstream}...HEAD")
+    different = get_changed_files("HEAD", upstream)
+    committed = set()
+    if unpushed is not None and different is not None:
+        committed = unpushed & upstream_changes & different
+    binary = get_binary_files(committed | uncommitted)
+    merge_conflicts = get_merge_conflicts(upstream) if committed else set()
+    for file in sorted(committed):
+        if merge_conflicts is not None:
+            if file in merge_conflicts:
+                conflicts.append(
+                    Conflict(file, "unpushed commits conflict with upstream")
+                )
+        elif file in binary:
+            conflicts.append(
+                Conflict(file, "binary file changed in unpushed commits and upstream")
+            )
+        else:
+            warnings.append(Conflict(file, "changed in unpushed commits and upstream"))
+    for file in sorted(uncommitted):
+        if file in binary:
+            conflicts.append(Conflict(file, "binary file changed locally and upstream"))
+        else:
+            warnings.append(Conflict(file, "changed locally and upstream"))
+    for file, reason in warnings:
+        pblog.warning(f"{file} may conflict: {reason}")
+    return conflicts
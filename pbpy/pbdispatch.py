@@ -24,16 +24,20 @@ def publish_build(branch_type, dispath_exec_path, publish_stagedir, dispatch_con
     # Push and Publish the build
     retry = True
     while True:
-        proc = pbtools.run(
-            [
-                dispath_exec_path,
-                "build",
-                "push",
-                branch_id,
-                dispatch_config,
-                publish_stagedir,
-                "-p",
-            ]
+        proc = pbtools.retry_on_timeout(
+            lambda: pbtools.run_stream(
+                [
+                    dispath_exec_path,
+                    "build",
+                    "push",
+                    branch_id,
+                    dispatch_config,
+                    publish_stagedir,
+                    "-p",
+                ],
+                idle_timeout=pbtools.get_timeout("dispatch_idle"),
+            ),
+            "Dispatch push",
         )
         result = proc.returncode
         if result != 0:
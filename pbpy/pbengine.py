@@ -16,7 +16,8 @@ def generate_module_changes(old_commitish, new_commitish):
             "diff",
             "--cumulative",
             f"{old_commitish}...{new_commitish}",
-        ]
+        ],
+        cache=True,
     )
     if proc.returncode != 0:
         pbtools.error_state(proc.stdout)
@@ -10,6 +10,7 @@ from pbpy import pblog
 from pbpy import pbtools
 from pbpy import pbconfig
 from pbpy import pbgit
+from pbpy import pbgitsession
 from pbpy import pbunreal
 from pbpy import pbinfo
 
@@ -93,7 +94,7 @@ def download_release_file(version, pattern=None, directory=None, repo=None):
         return 0
 
     def check_wildcard(path):
-        if "*" in file:
+        if "*" in path:
             return False
         return True
 
@@ -117,11 +118,27 @@ def download_release_file(version, pattern=None, directory=None, repo=None):
 
     creds = get_token_env(full_repo)
 
+    def remove_partial_downloads():
+        for file in pattern if isinstance(pattern, list) else []:
+            if check_wildcard(file):
+                try_remove(file)
+
     try:
-        proc = pbtools.run_with_combined_output(args, env=creds)
+        proc = pbtools.retry_on_timeout(
+            lambda: pbtools.run_with_combined_output(
+                args, env=creds, timeout=pbtools.get_timeout("release_download")
+            ),
+            f"Downloading release {version}",
+            remove_partial_downloads,
+        )
         output = proc.stdout
         if proc.returncode == 0:
             pass
+        elif pbtools.is_timed_out(proc):
+            pblog.error(
+                f"Downloading release file {pattern} for release {version} timed out. Please check your connection and try again."
+            )
+            return -1
         elif pbtools.it_has_any(output, "release not found", "no assets"):
             pblog.error(
                 f"Release {version} not found. Please wait and try again later."
@@ -184,21 +201,35 @@ def pull_binaries(version_number: str, pass_checksum=False):
 
         creds = get_token_env()
 
+        def remove_partial_download():
+            if os.path.exists(binary_package_name):
+                os.remove(binary_package_name)
+
         try:
-            proc = pbtools.run_with_combined_output(
-                [
-                    cli_exec_path,
-                    "release",
-                    "download",
-                    version_number,
-                    "-n" if "glab" in cli_exec_path else "-p",
-                    binary_package_name,
-                ],
-                env=creds,
+            proc = pbtools.retry_on_timeout(
+                lambda: pbtools.run_with_combined_output(
+                    [
+                        cli_exec_path,
+                        "release",
+                        "download",
+                        version_number,
+                        "-n" if "glab" in cli_exec_path else "-p",
+                        binary_package_name,
+                    ],
+                    env=creds,
+                    timeout=pbtools.get_timeout("release_download"),
+                ),
+                f"Downloading binaries for {version_number}",
+                remove_partial_download,
             )
             output = proc.stdout
             if proc.returncode == 0:
                 pass
+            elif pbtools.is_timed_out(proc):
+                pblog.error(
+                    f"Downloading binaries for release {version_number} timed out. Please check your connection and try again."
+                )
+                return -1
             elif pbtools.it_has_any(output, "release not found", "no assets"):
                 pblog.error(
                     f"Release {version_number} not found. Please wait and try again later."
@@ -258,10 +289,7 @@ def generate_release():
     if version is None:
         pbtools.error_state("Failed to get project version!")
     target_branch = pbconfig.get("expected_branch_names")[0]
-    proc = pbtools.run_with_combined_output(
-        [pbgit.get_git_executable(), "rev-parse", version, "--"]
-    )
-    if proc.returncode == 0:
+    if pbgitsession.get_session().rev_parse(version) is not None:
         pblog.error("Tag already exists. Not creating a release.")
         pblog.info(
             "Please use --autoversion {major,minor,patch} if you'd like to make a new version."
@@ -1,4 +1,4 @@
-import fnmatch
+import asyncio
 import itertools
 import json
 import multiprocessing
@@ -7,19 +7,34 @@ import re
 import shutil
 import stat
 from functools import lru_cache
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from urllib.parse import urlparse
 
-from pbpy import pbconfig, pblog, pbtools
+from pbpy import (
+    pbconfig,
+    pbgitattributes,
+    pbgitindex,
+    pbgitmeta,
+    pbgitsession,
+    pblfsfilter,
+    pblog,
+    pbsparse,
+    pbstatus,
+    pbtools,
+)
 
 missing_version = "not installed"
 
 
 @lru_cache()
 def get_current_branch_name():
-    return pbtools.get_one_line_output(
-        [get_git_executable(), "branch", "--show-current"]
-    )
+    try:
+        return pbgitmeta.get_current_branch_name()
+    except (pbgitmeta.MetadataError, OSError):
+        return pbtools.get_one_line_output(
+            [get_git_executable(), "branch", "--show-current"]
+        )
 
 
 def compare_with_current_branch_name(compared_branch):
@@ -54,37 +69,44 @@ def get_lfs_executable():
     return pbconfig.get_user("paths", "git-lfs", "git-lfs")
 
 
+def get_gcm_helper_executable(gcm_exec):
+    # old style
+    if "manager-core" == gcm_exec:
+        return [get_git_executable(), "credential-manager-core"]
+    # new style
+    if "manager" == gcm_exec:
+        return [get_git_executable(), "credential-manager"]
+    # helper installed, but not GCM
+    if "git-credential-manager" not in gcm_exec:
+        return None
+    return [gcm_exec]
+
+
 @lru_cache()
 def get_gcm_executable(recursed=False):
-    gcm_exec = pbtools.get_one_line_output(
-        [get_git_executable(), "config", "--get", "credential.helper"]
-    ).replace("\\", "")
+    gcm_exec = (
+        pbgitsession.get_session().get_config("credential.helper").replace("\\", "")
+    )
     # no helper installed
     if not gcm_exec:
         # try setting GCM
         if not recursed:
             pbtools.run(["git", "config", "credential.helper", "manager"])
+            pbgitsession.invalidate_config()
             return get_gcm_executable(recursed=True)
         return None
-    # old style
-    if "manager-core" == gcm_exec:
-        return [get_git_executable(), "credential-manager-core"]
-    # new style
-    if "manager" == gcm_exec:
-        return [get_git_executable(), "credential-manager"]
-    # helper installed, but not GCM
-    if "git-credential-manager" not in gcm_exec:
+    helper_exec = get_gcm_helper_executable(gcm_exec)
+    if helper_exec is None:
         if not recursed:
             pbtools.run(["git", "config", "credential.helper", "manager"])
+            pbgitsession.invalidate_config()
             return get_gcm_executable(recursed=True)
         return [f"diff.{gcm_exec}"]
-    return [gcm_exec]
+    return helper_exec
 
 
-def get_git_version():
-    installed_version_split = pbtools.get_one_line_output(
-        [get_git_executable(), "--version"]
-    ).split(" ")
+def parse_git_version(output):
+    installed_version_split = output.split(" ")
 
     list_len = len(installed_version_split)
     if list_len == 0:
@@ -99,12 +121,28 @@ def get_git_version():
     return installed_version
 
 
-def get_lfs_version(lfs_exec=None):
-    if lfs_exec is None:
-        lfs_exec = get_lfs_executable()
-    installed_version_split = pbtools.get_one_line_output(
-        [lfs_exec, "--version"]
-    ).split(" ")
+def get_git_version():
+    return parse_git_version(
+        pbtools.get_one_line_output([get_git_executable(), "--version"])
+    )
+
+
+async def get_git_version_async():
+    return parse_git_version(
+        await pbtools.get_one_line_output_async([get_git_executable(), "--version"])
+    )
+
+
+def get_git_version_tuple():
+    """Returns the major and minor version of git, to compare with the version a feature needs, or (0, 0) if it is unknown."""
+    try:
+        return tuple(int(part) for part in get_git_version().split(".")[:2])
+    except ValueError:
+        return (0, 0)
+
+
+def parse_lfs_version(output):
+    installed_version_split = output.split(" ")
 
     if len(installed_version_split) == 0:
         return missing_version
@@ -118,14 +156,19 @@ def get_lfs_version(lfs_exec=None):
     return installed_version.split("/")[1]
 
 
-def get_gcm_version():
-    gcm_exec = get_gcm_executable()
-    if gcm_exec is None:
-        return missing_version
-    if gcm_exec[0].startswith("diff"):
-        return gcm_exec
-    installed_version = pbtools.get_one_line_output([*gcm_exec, "--version"])
+def get_lfs_version(lfs_exec=None):
+    if lfs_exec is None:
+        lfs_exec = get_lfs_executable()
+    return parse_lfs_version(pbtools.get_one_line_output([lfs_exec, "--version"]))
+
+
+async def get_lfs_version_async():
+    return parse_lfs_version(
+        await pbtools.get_one_line_output_async([get_lfs_executable(), "--version"])
+    )
 
+
+def parse_gcm_version(installed_version):
     if installed_version == "":
         return missing_version
 
@@ -135,7 +178,31 @@ def get_gcm_version():
     return installed_version
 
 
+def get_gcm_version():
+    gcm_exec = get_gcm_executable()
+    if gcm_exec is None:
+        return missing_version
+    if gcm_exec[0].startswith("diff"):
+        return gcm_exec
+    return parse_gcm_version(pbtools.get_one_line_output([*gcm_exec, "--version"]))
+
+
+async def get_gcm_version_async():
+    gcm_exec = await pbgitsession.get_session().get_config_async("credential.helper")
+    gcm_exec = get_gcm_helper_executable(gcm_exec.replace("\\", ""))
+    # the helper has to be repaired, which writes to the git config, so leave it to get_gcm_version
+    if gcm_exec is None:
+        return None
+    return parse_gcm_version(
+        await pbtools.get_one_line_output_async([*gcm_exec, "--version"])
+    )
+
+
 def get_lockables():
+    try:
+        return pbgitindex.get_lockables()
+    except (pbgitmeta.MetadataError, OSError) as e:
+        pblog.debug(f"Finding lockables without the index: {e}")
     lockables = set()
     content_dir = Path("Content")
     lockables.update(content_dir.glob("**/*.uasset"))
@@ -144,32 +211,38 @@ def get_lockables():
     if plugins_dir.is_dir():
         lockables.update(plugins_dir.glob("*/Content/**/*.uasset"))
         lockables.update(plugins_dir.glob("*/Content/**/*.umap"))
-    return lockables
+    # the same form as the paths of locks
+    return {lockable.as_posix() for lockable in lockables}
+
+
+# locks are held on the server, so only reuse them for a short while
+locks_cache_lifetime = 30
+
+
+def get_locks_cmd():
+    return [get_lfs_executable(), "locks", "--verify", "--json"]
 
 
 def get_locked(key="ours", include_new=True):
-    proc = pbtools.run_with_combined_output(
-        [get_lfs_executable(), "locks", "--verify", "--json"]
-    )
+    proc = pbtools.run_with_combined_output(get_locks_cmd(), cache=locks_cache_lifetime)
     if proc.returncode:
         return None
     locked_objects = json.loads(proc.stdout)[key]
     locked = set([l.get("path") for l in locked_objects])
     # also check untracked and added files
     if key == "ours" and include_new:
-        proc = pbtools.run_with_combined_output(
-            [
-                get_git_executable(),
-                "--no-optional-locks",
-                "status",
-                "--porcelain",
-                "-uall",
-            ]
-        )
-        if not proc.returncode:
-            for line in proc.stdout.splitlines():
-                if line[0] == "?" or line[1] == "?" or line[0] == "A" or line[1] == "A":
-                    locked.add(line[3:])
+        try:
+            locked.update(pbgitindex.get_new_files())
+            return locked
+        except (pbgitmeta.MetadataError, OSError) as e:
+            pblog.debug(f"Finding new files through git status: {e}")
+        status = pbstatus.get_status("all")
+        if status is not None:
+            locked.update(
+                entry.path
+                for entry in status.entries
+                if "?" in entry.xy or "A" in entry.xy
+            )
     return locked
 
 
@@ -201,7 +274,14 @@ def fix_lfs_ro_attr(should_unlock_unmodified):
     if should_unlock_unmodified:
         unlock_unmodified()
     lockables = get_lockables()
-    locked = get_locked()
+    # locks can be held on files which the sparse checkout leaves out
+    locked = set(pbsparse.filter_checked_out(get_locked()))
+    # files which are locked to be worked on need their content, even if the LFS fetch filter leaves them out
+    pointers = find_lfs_pointers(locked)
+    if pointers:
+        remaining = repair_lfs_pointers(pointers, hydrate=True)
+        for file in remaining:
+            pblog.warning(f"Locked file {file} could not be hydrated")
     not_locked = lockables - locked
     with multiprocessing.Pool(min(8, os.cpu_count())) as pool:
         for message in itertools.chain(
@@ -212,20 +292,18 @@ def fix_lfs_ro_attr(should_unlock_unmodified):
                 pblog.warning(message)
 
 
-def chunks(lst, n):
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
-
-
 def unlock_unmodified():
-    modified = get_modified_files(paths=False)
+    # new files hold no locks, and only the locked files have to be checked for modifications
+    locked = get_locked(include_new=False)
+    if locked is None:
+        return False
+    modified = get_modified_files(paths=False, files=locked)
     pending = pbtools.get_combined_output(
         [get_lfs_executable(), "push", "--dry-run", "origin", "HEAD"]
     )
     pending = pending.splitlines()
     pending = {line.rsplit(" => ", 1)[1] for line in pending if line}
     keep = modified | pending
-    locked = get_locked()
     unlock = {file for file in locked if file not in keep}
     prefix_filter = []
     for path in modified:
@@ -244,29 +322,156 @@ def unlock_unmodified():
     unlock = list(unlock)
     if not unlock:
         return True
-    for chunk in chunks(unlock, 50):
-        args = [get_lfs_executable(), "unlock"]
-        args.extend(chunk)
-        proc = pbtools.run(args)
-        if proc.returncode:
-            return False
-    return True
+    procs = pbtools.run_batched(
+        [get_lfs_executable(), "unlock", "--"], unlock, processes=4, runner=pbtools.run
+    )
+    pbtools.clear_cached_output(get_locks_cmd(), combined=True)
+    return not any(proc.returncode for proc in procs)
 
 
-@lru_cache()
-def get_lfs_file_regex():
+def is_lfs_file(file):
+    return get_lfs_files([file]) == [file]
+
+
+def get_lfs_files(files):
+    """Returns the files which are stored in LFS, according to their attributes."""
+    files = list(files)
+    try:
+        values = pbgitattributes.get_attr_values(files, "filter")
+        return [file for file, value in zip(files, values) if value == "lfs"]
+    except (pbgitmeta.MetadataError, OSError) as e:
+        pblog.debug(f"Checking attributes through git: {e}")
+    attrs = pbgitsession.get_session().check_attr_paths(files, "filter")
+    return [file for file, attr in zip(files, attrs) if attr["filter"] == "lfs"]
+
+
+# a smudge which failed or was skipped leaves the pointer in the working tree instead of the content
+lfs_pointer_max_size = 1024
+lfs_pointer_headers = (
+    b"version https://git-lfs.github.com/spec/v1\n",
+    b"version https://hawser.github.com/spec/v1\n",
+)
+lfs_pointer_oid_pattern = re.compile(rb"^oid sha256:([0-9a-f]{64})$", re.MULTILINE)
+
+
+def get_tracked_files():
+    try:
+        return pbgitindex.get_worktree_files()
+    except (pbgitmeta.MetadataError, OSError) as e:
+        pblog.debug(f"Listing tracked files through git: {e}")
+    return [
+        file
+        for file in pbtools.iter_output([get_git_executable(), "ls-files", "-z"])
+        if file
+    ]
+
+
+def get_common_dir():
+    try:
+        return pbgitmeta.get_common_dir(pbgitmeta.get_git_dir())
+    except (pbgitmeta.MetadataError, OSError) as e:
+        pblog.debug(f"Locating the git directory through git: {e}")
+        return Path(
+            pbtools.get_one_line_output(
+                [get_git_executable(), "rev-parse", "--git-common-dir"]
+            )
+        )
+
+
+def get_lfs_storage_dir():
+    common_dir = get_common_dir()
+    # relative to the git directory, like git lfs does it
+    storage = pbgitsession.get_session().get_config("lfs.storage")
+    return common_dir / storage if storage else common_dir / "lfs"
+
+
+def has_lfs_object(objects_dir, oid):
+    return (objects_dir / oid[:2] / oid[2:4] / oid).is_file()
+
+
+def get_pointer_sized_files(dir, names):
+    """Returns the files in dir among names which are small enough to be LFS pointers."""
     files = []
-    with open(".gitattributes") as f:
-        for line in f:
-            pair = line.strip().split(" ")
-            if pair[1] == "lfs" or pair[1] == "lock":
-                files.append(fnmatch.translate(pair[0]))
-    file_group = "|".join(files)
-    return re.compile(f"^({file_group})$")
+    try:
+        it = os.scandir(dir or ".")
+    except OSError:
+        return files
+    with it:
+        for entry in it:
+            if entry.name not in names:
+                continue
+            try:
+                # on Windows, the size comes with the directory listing
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and 0 < st.st_size <= lfs_pointer_max_size:
+                files.append(f"{dir}/{entry.name}" if dir else entry.name)
+    return files
+
+
+def read_lfs_pointer(file):
+    """Returns the object id file points to if it is an LFS pointer, or None if it holds anything else."""
+    try:
+        with open(file, "rb") as f:
+            data = f.read(lfs_pointer_max_size + 1)
+    except OSError:
+        return None
+    if len(data) > lfs_pointer_max_size or not data.startswith(lfs_pointer_headers):
+        return None
+    match = lfs_pointer_oid_pattern.search(data)
+    return match.group(1).decode() if match else None
+
+
+def find_lfs_pointers(files=None, processes=8):
+    """Returns the LFS files which are pointers in the working tree, along with the object id each points to."""
+    if files is None:
+        files = get_tracked_files()
+    files = get_lfs_files(str(file).replace("\\", "/") for file in files)
+    names_by_dir = {}
+    for file in files:
+        dir, _, name = file.rpartition("/")
+        names_by_dir.setdefault(dir, set()).add(name)
+    if not names_by_dir:
+        return {}
+    # most LFS files are far too large to be pointers, which listing their directories tells without opening them
+    with ThreadPool(min(processes, len(names_by_dir))) as pool:
+        candidates = list(
+            itertools.chain.from_iterable(
+                pool.starmap(get_pointer_sized_files, names_by_dir.items())
+            )
+        )
+        oids = pool.map(read_lfs_pointer, candidates, 16)
+    return {file: oid for file, oid in zip(candidates, oids) if oid is not None}
 
 
-def is_lfs_file(file):
-    return get_lfs_file_regex().match(file) is not None
+def repair_lfs_pointers(files=None, checkout_processes=1, config=None, hydrate=False):
+    """Replaces LFS pointers among files in the working tree with their content, fetching the objects which are missing first.
+
+    Checks every tracked file if files is None. Pointers which the LFS fetch filter leaves out are only replaced when hydrating.
+    config is passed to git lfs and its git processes. Returns the files which are still pointers afterwards.
+    """
+    pointers = find_lfs_pointers(files)
+    if hydrate:
+        config = (config or {}) | pblfsfilter.no_filter_config
+    else:
+        # these are meant to stay pointers until they are hydrated
+        fetched = pblfsfilter.filter_fetched(pointers)
+        pointers = {file: pointers[file] for file in fetched}
+    if not pointers:
+        return []
+    env = pbtools.get_config_env(config)
+    pblog.info(f"Checking out {len(pointers)} LFS files which are pointers")
+    objects_dir = get_lfs_storage_dir() / "objects"
+    missing = [
+        file for file, oid in pointers.items() if not has_lfs_object(objects_dir, oid)
+    ]
+    if missing:
+        pblog.info(f"Fetching {len(missing)} missing LFS objects")
+        # the pointers are the ones checked out, not the ones upstream
+        pbtools.do_lfs_fetch(missing, ref="HEAD", env=env)
+    pbtools.do_lfs_checkout(list(pointers), checkout_processes, env)
+    return sorted(find_lfs_pointers(pointers))
 
 
 def set_tracking_information(upstream_branch_name: str):
@@ -306,19 +511,23 @@ def stash_pop():
         )
 
 
-def check_remote_connection():
-    current_url = pbtools.get_one_line_output(
-        [get_git_executable(), "remote", "get-url", "origin"]
-    )
+def get_remote_url():
     recent_url = pbconfig.get("git_url")
     git_user = pbconfig.get_user("project", "git_user")
     if git_user:
         recent_url = recent_url.replace("https://", f"https://{git_user}@")
+    return recent_url
+
+
+def check_remote_connection():
+    current_url = pbgitsession.get_session().get_remote_url("origin")
+    recent_url = get_remote_url()
 
     if current_url != recent_url:
         output = pbtools.get_combined_output(
             [get_git_executable(), "remote", "set-url", "origin", recent_url]
         )
+        pbgitsession.invalidate_config()
         current_url = recent_url
         pblog.info(output)
 
@@ -328,20 +537,45 @@ def check_remote_connection():
     return out == 0, current_url
 
 
-def check_credentials():
-    output = pbtools.get_one_line_output([get_git_executable(), "config", "user.name"])
+async def check_remote_connection_async():
+    current_url = await pbgitsession.get_session().get_remote_url_async("origin")
+    # the remote has to be updated, which writes to the git config, so leave it to check_remote_connection
+    if current_url != get_remote_url():
+        return None
+    proc = await pbtools.run_async([get_git_executable(), "ls-remote", "-hq", "--refs"])
+    return proc.returncode == 0, current_url
+
+
+async def get_user_identity_async():
+    session = pbgitsession.get_session()
+    return await asyncio.gather(
+        session.get_config_async("user.name"),
+        session.get_config_async("user.email"),
+    )
+
+
+def check_credentials(identity=None):
+    if identity is None:
+        output = pbgitsession.get_session().get_config("user.name")
+    else:
+        output = identity[0]
     if output == "" or output is None:
         user_name = input("Please enter your GitHub username: ")
         pbtools.run_with_output(
             [get_git_executable(), "config", "user.name", user_name]
         )
+        pbgitsession.invalidate_config()
 
-    output = pbtools.get_one_line_output([get_git_executable(), "config", "user.email"])
+    if identity is None:
+        output = pbgitsession.get_session().get_config("user.email")
+    else:
+        output = identity[1]
     if output == "" or output is None:
         user_mail = input("Please enter your GitHub email: ")
         pbtools.run_with_output(
             [get_git_executable(), "config", "user.email", user_mail]
         )
+        pbgitsession.invalidate_config()
 
 
 def sync_file(file_path, sync_target=None):
@@ -361,6 +595,12 @@ def abort_all():
     # Just in case
     shutil.rmtree(os.path.join(os.getcwd(), ".git", "rebase-apply"), ignore_errors=True)
     shutil.rmtree(os.path.join(os.getcwd(), ".git", "rebase-merge"), ignore_errors=True)
+    pbstatus.invalidate()
+
+
+def is_rebase_in_progress():
+    git_dir = pbtools.get_git_dir() or Path(".git")
+    return (git_dir / "rebase-merge").exists() or (git_dir / "rebase-apply").exists()
 
 
 def abort_rebase():
@@ -368,18 +608,45 @@ def abort_rebase():
     pbtools.run_with_output([get_git_executable(), "rebase", "--abort"])
 
 
-def setup_config():
-    pbtools.run_with_output(
-        [get_git_executable(), "config", "include.path", "../.gitconfig"]
+# the shared config of the project, then the settings --tune measured for this clone, which win over it
+tuned_config_name = "pbsync-tuned.gitconfig"
+config_includes = ("../.gitconfig", tuned_config_name)
+
+
+def get_tuned_config_path():
+    return get_common_dir() / tuned_config_name
+
+
+def read_tuned_config():
+    """Returns the settings of the tuned include, which are empty until --tune wrote it."""
+    proc = pbtools.run_with_combined_output(
+        [
+            get_git_executable(),
+            "config",
+            "--file",
+            str(get_tuned_config_path()),
+            "--list",
+        ]
     )
+    if proc.returncode:
+        return {}
+    return dict(line.split("=", 1) for line in proc.stdout.splitlines() if "=" in line)
+
+
+def setup_config():
+    included = pbgitsession.get_session().get_config_all("include.path")
+    for path in config_includes:
+        if path not in included:
+            pbtools.run_with_output(
+                [get_git_executable(), "config", "--add", "include.path", path]
+            )
+    pbgitsession.invalidate_config()
 
 
 @lru_cache()
 def get_credentials(repo_str=None):
     if not repo_str:
-        repo_str = pbtools.get_one_line_output(
-            [get_git_executable(), "remote", "get-url", "origin"]
-        )
+        repo_str = pbgitsession.get_session().get_remote_url("origin")
     repo_url = urlparse(repo_str)
 
     creds = f"protocol={repo_url.scheme}\n"
@@ -410,10 +677,21 @@ def get_credentials(repo_str=None):
     return cred_dict.get("username"), cred_dict.get("password")
 
 
-def get_modified_files(paths=True):
-    proc = pbtools.run_with_output(
-        [get_git_executable(), "--no-optional-locks", "status", "--porcelain"]
-    )
+def get_modified_files(paths=True, files=None, pathspecs=()):
+    """Returns the files which differ from HEAD, limited to files, or to the literal pathspecs."""
+    if files is not None:
+        # only the given files are of interest, which the index answers without scanning the working tree
+        try:
+            modified = pbgitindex.get_modified_files(files)
+            return {Path(path) for path in modified} if paths else modified
+        except (pbgitmeta.MetadataError, OSError) as e:
+            pblog.debug(f"Finding modified files through git status: {e}")
+    status = pbstatus.get_status("normal", pathspecs)
+    modified = set()
+    if status is not None:
+        # keep the source of a rename too, its lock is still held under the old name
+        modified.update(status.get_changed_paths(orig_paths=True))
+        modified.update(status.untracked_files)
     if paths:
-        return {Path(line[3:]) for line in proc.stdout.splitlines()}
-    return {line[3:] for line in proc.stdout.splitlines()}
+        return {Path(path) for path in modified}
+    return modified
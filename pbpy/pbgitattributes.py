@@ -0,0 +1,686 @@
+import os
+import re
+import string
+from collections import namedtuple
+from pathlib import Path
+
+from pbpy import pbgitindex, pbgitmeta, pbgitsession, pblog
+
+# answers git check-attr in process, following git's attribute semantics:
+# info/attributes, then .gitattributes from the deepest directory up, then the global and system files,
+# later lines win over earlier ones, and [attr] macros may only be defined at the top level
+
+builtin_macros = "[attr]binary -diff -merge -text\n"
+max_line_length = 2048
+blank_pattern = re.compile(r"[^ \t\r\n]*")
+attribute_name_pattern = re.compile(r"^[A-Za-z0-9_.][A-Za-z0-9_.-]*$")
+wildcard_chars = "*?[\\"
+class_patterns = {
+    "alnum": "a-zA-Z0-9",
+    "alpha": "a-zA-Z",
+    "blank": " \\t",
+    "cntrl": "\\x00-\\x1f\\x7f",
+    "digit": "0-9",
+    "graph": "\\x21-\\x7e",
+    "lower": "a-z",
+    "print": "\\x20-\\x7e",
+    "punct": "!-/:-@\\[-`{-~",
+    "space": " \\t\\n\\r\\f\\v",
+    "upper": "A-Z",
+    "xdigit": "0-9a-fA-F",
+}
+
+# states are (attribute, value), with True for set, False for unset, None for unspecified, or the assigned string
+Rule = namedtuple("Rule", ["pattern", "states"])
+
+engine_cache = {}
+nested_paths_cache = {}
+
+# git folds case byte by byte, so only ASCII letters
+ascii_lower = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+class InvalidPattern(Exception):
+    pass
+
+
+def fold(text):
+    return text.lower() if text.isascii() else text.translate(ascii_lower)
+
+
+def translate_bracket(pattern, pos, ignore_case=False):
+    """Translates the bracket expression starting after the [ at pos. Returns the regex and the position after it.
+
+    When ignoring case, git folds the path but not the characters in brackets, so only ranges and classes fold.
+    """
+    negated = pos < len(pattern) and pattern[pos] in "!^"
+    if negated:
+        pos += 1
+    items = []
+    prev = None
+    first = True
+    while True:
+        if pos >= len(pattern):
+            raise InvalidPattern
+        c = pattern[pos]
+        if c == "]" and not first:
+            break
+        first = False
+        if c == "\\":
+            pos += 1
+            if pos >= len(pattern):
+                raise InvalidPattern
+            c = pattern[pos]
+            items.append(re.escape(c))
+            prev = c
+        elif (
+            c == "-"
+            and prev is not None
+            and pos + 1 < len(pattern)
+            and pattern[pos + 1] != "]"
+        ):
+            pos += 1
+            end = pattern[pos]
+            if end == "\\":
+                pos += 1
+                if pos >= len(pattern):
+                    raise InvalidPattern
+                end = pattern[pos]
+            # the start of the range was already added on its own
+            if prev <= end:
+                items.append(f"{re.escape(prev)}-{re.escape(end)}")
+                low, high = max(prev, "A"), min(end, "Z")
+                if ignore_case and low <= high:
+                    items.append(f"{low.lower()}-{high.lower()}")
+            prev = None
+        elif c == "[" and pattern.startswith(":", pos + 1):
+            end = pattern.find("]", pos + 2)
+            if end == -1:
+                raise InvalidPattern
+            if pattern[end - 1] != ":" or end - 1 < pos + 2:
+                # not a class after all, so a literal [
+                items.append("\\[")
+                prev = c
+            else:
+                name = pattern[pos + 2 : end - 1]
+                if name not in class_patterns:
+                    raise InvalidPattern
+                if ignore_case and name == "upper":
+                    name = "alpha"
+                items.append(class_patterns[name])
+                prev = None
+                pos = end
+        else:
+            items.append(re.escape(c))
+            prev = c
+        pos += 1
+    # a bracket never matches a slash in a path
+    if negated:
+        return f"[^/{''.join(items)}]", pos + 1
+    if not items:
+        return "(?!)", pos + 1
+    return f"(?!/)[{''.join(items)}]", pos + 1
+
+
+# regexes of ** between slashes, which cross directories
+any_dirs = "(?:.*/)?"
+anything = ".*"
+star = "[^/]*"
+
+
+def tokenize(pattern, literal_length=0, ignore_case=False):
+    """Translates a wildmatch pattern with WM_PATHNAME to (regex, literal character) tokens, the latter None for wildcards.
+
+    git compares the literal start of a pattern separately, so a ** right after it counts as being at the start.
+    """
+    tokens = []
+    pos = 0
+    n = len(pattern)
+    while pos < n:
+        c = pattern[pos]
+        if c == "*":
+            start = pos
+            while pos < n and pattern[pos] == "*":
+                pos += 1
+            at_start = start in (0, literal_length) or pattern[start - 1] == "/"
+            if pos - start > 1 and at_start and (pos == n or pattern[pos] == "/"):
+                if pos == n:
+                    tokens.append((anything, None))
+                else:
+                    # any number of leading directories, including none
+                    tokens.append((any_dirs, None))
+                    pos += 1
+            else:
+                tokens.append((star, None))
+            continue
+        if c == "?":
+            tokens.append(("[^/]", None))
+        elif c == "[":
+            regex, pos = translate_bracket(pattern, pos + 1, ignore_case)
+            tokens.append((regex, None))
+            continue
+        else:
+            if c == "\\":
+                pos += 1
+                if pos >= n:
+                    raise InvalidPattern
+                c = pattern[pos]
+            if ignore_case:
+                c = fold(c)
+            tokens.append((re.escape(c), c))
+        pos += 1
+    return tokens
+
+
+def join_tokens(tokens):
+    return "".join(regex for regex, _ in tokens)
+
+
+def get_literal_length(pattern):
+    return next(
+        (pos for pos, c in enumerate(pattern) if c in wildcard_chars), len(pattern)
+    )
+
+
+def unquote(text):
+    """Unquotes a C-style quoted pattern. Returns the pattern and the rest of the line, or None if it is malformed."""
+    escapes = {
+        "a": "\a",
+        "b": "\b",
+        "f": "\f",
+        "n": "\n",
+        "r": "\r",
+        "t": "\t",
+        "v": "\v",
+    }
+    out = bytearray()
+    pos = 1
+    while pos < len(text):
+        c = text[pos]
+        if c == '"':
+            return out.decode("utf-8", errors="surrogateescape"), text[pos + 1 :]
+        if c == "\\":
+            pos += 1
+            if pos >= len(text):
+                return None
+            c = text[pos]
+            if c in escapes:
+                out += escapes[c].encode()
+            elif c in "01234567":
+                if not re.match(r"[0-3][0-7]{2}", text[pos : pos + 3]):
+                    return None
+                out.append(int(text[pos : pos + 3], 8))
+                pos += 2
+            elif c in '"\\':
+                out += c.encode()
+            else:
+                return None
+        else:
+            out += c.encode("utf-8", errors="surrogateescape")
+        pos += 1
+    return None
+
+
+def parse_states(words):
+    states = []
+    for word in words:
+        if word.startswith("-") or word.startswith("!"):
+            # a value after an unset is ignored
+            name, value = word[1:].partition("=")[0], False if word[0] == "-" else None
+        else:
+            name, eq, value = word.partition("=")
+            value = value if eq else True
+        if not attribute_name_pattern.match(name) or name.startswith("builtin_"):
+            return None
+        states.append((name, value))
+    return states
+
+
+class AttributeFile:
+    """The rules and macros of one attributes file, which apply to the paths under base."""
+
+    def __init__(self, text, base, macros_allowed, source):
+        self.base = base
+        self.rules = []
+        self.macros = []
+        for line in text.split("\n"):
+            line = line.lstrip(" \t\r")
+            if not line or line.startswith("#") or len(line) >= max_line_length:
+                continue
+            # a malformed quoted pattern is taken as it is
+            unquoted = unquote(line) if line.startswith('"') else None
+            if unquoted is not None:
+                pattern, rest = unquoted
+            else:
+                pattern = blank_pattern.match(line).group()
+                rest = line[len(pattern) :]
+            states = parse_states(rest.split())
+            if states is None:
+                pblog.debug(f"Ignoring invalid attribute line in {source}: {line}")
+                continue
+            if pattern.startswith("[attr]"):
+                name = pattern[len("[attr]") :]
+                if macros_allowed and attribute_name_pattern.match(name):
+                    self.macros.append((name, states))
+                continue
+            # negative patterns are not allowed in attributes files
+            if pattern.startswith("!"):
+                continue
+            self.rules.append(Rule(pattern, states))
+
+
+class BasenameRule:
+    """A rule which only has to look at the file name, in one of the forms the matcher indexes."""
+
+    def __init__(self, tokens):
+        self.literal = None
+        self.suffix = None
+        self.regex = None
+        if all(literal is not None for _, literal in tokens):
+            self.literal = "".join(literal for _, literal in tokens)
+        elif tokens[0][0] == star and all(
+            literal is not None for _, literal in tokens[1:]
+        ):
+            self.suffix = "".join(literal for _, literal in tokens[1:])
+        else:
+            self.regex = re.compile(join_tokens(tokens))
+
+
+class PathRule:
+    """A rule with a slash, matched by first checking the directory, and then the file name.
+
+    Patterns where the file name part may cross directories are matched against the whole path instead.
+    """
+
+    def __init__(self, pattern, base, ignore_case):
+        literal_length = get_literal_length(pattern)
+        if pattern.startswith("/"):
+            pattern = pattern[1:]
+            literal_length -= 1
+        if ignore_case:
+            base = fold(base)
+        prefix = re.escape(f"{base}/") if base else ""
+        self.dir_regex = None
+        self.name_rule = None
+        self.path_regex = None
+        tokens = tokenize(pattern, literal_length, ignore_case)
+        separators = [
+            i
+            for i, (regex, literal) in enumerate(tokens)
+            if literal == "/"
+            # right after the literal start, ** may also match no directory and no slash at all
+            or (regex == any_dirs and (i == 0 or tokens[i - 1][1] == "/"))
+        ]
+        split = separators[-1] + 1 if separators else 0
+        dir_regex = prefix + join_tokens(tokens[:split])
+        name_tokens = tokens[split:]
+        if [regex for regex, _ in name_tokens] == [anything]:
+            # everything below the directory
+            self.dir_regex = re.compile(dir_regex + any_dirs)
+            self.name_rule = BasenameRule([(star, None)])
+        elif any(regex in (anything, any_dirs) for regex, _ in name_tokens):
+            self.path_regex = re.compile(prefix + join_tokens(tokens))
+        else:
+            self.dir_regex = re.compile(dir_regex)
+            self.name_rule = BasenameRule(name_tokens)
+
+    def matches_dir(self, dir):
+        return self.dir_regex.fullmatch(f"{dir}/" if dir else "") is not None
+
+
+class Matcher:
+    """The rules which apply to the files in one directory, indexed by file name, extension and suffix."""
+
+    def __init__(self, rules, macros):
+        # rules are (basename rule or whole path rule, states), in order of precedence
+        self.states = [states for _, states in rules]
+        self.macros = macros
+        self.always = []
+        self.literals = {}
+        # *.ext patterns, by the extension after the last dot
+        self.extensions = {}
+        self.suffixes = {}
+        self.regexes = []
+        self.path_regexes = []
+        for rank, (rule, _) in enumerate(rules):
+            if isinstance(rule, PathRule):
+                self.path_regexes.append((rank, rule.path_regex))
+            elif rule.literal is not None:
+                self.literals.setdefault(rule.literal, []).append(rank)
+            elif rule.suffix == "":
+                self.always.append(rank)
+            elif rule.suffix is not None and rule.suffix.rfind(".") == 0:
+                self.extensions.setdefault(rule.suffix, []).append(rank)
+            elif rule.suffix is not None:
+                self.suffixes.setdefault(len(rule.suffix), {}).setdefault(
+                    rule.suffix, []
+                ).append(rank)
+            elif rule.regex is not None:
+                self.regexes.append((rank, rule.regex))
+        self.suffixes = sorted(self.suffixes.items())
+        self.resolved = {}
+        # most directories only have extension rules, so their files are decided by the extension alone
+        self.by_extension = None
+        self.unmatched = None
+        if not (
+            self.always
+            or self.literals
+            or self.suffixes
+            or self.regexes
+            or self.path_regexes
+        ):
+            self.by_extension = {
+                extension: self.resolve(tuple(ranks))
+                for extension, ranks in self.extensions.items()
+            }
+            self.unmatched = self.resolve(())
+
+    def match(self, name, path):
+        dot = name.rfind(".")
+        ranks = list(self.always)
+        if dot != -1:
+            extension = self.extensions.get(name[dot:])
+            if extension:
+                ranks.extend(extension)
+        literal = self.literals.get(name)
+        if literal:
+            ranks.extend(literal)
+        for length, suffixes in self.suffixes:
+            suffix = suffixes.get(name[-length:])
+            if suffix:
+                ranks.extend(suffix)
+        for rank, regex in self.regexes:
+            if regex.fullmatch(name):
+                ranks.append(rank)
+        for rank, regex in self.path_regexes:
+            if regex.fullmatch(path):
+                ranks.append(rank)
+        key = tuple(sorted(ranks))
+        values = self.resolved.get(key)
+        if values is None:
+            values = self.resolve(key)
+        return values
+
+    def resolve(self, key):
+        values = {}
+        for rank in key:
+            self.fill(values, self.states[rank])
+        self.resolved[key] = values
+        return values
+
+    def fill(self, values, states):
+        # the last attribute on a line wins, and the first line to decide an attribute wins
+        for name, value in reversed(states):
+            if name in values:
+                continue
+            values[name] = value
+            if value is True and name in self.macros:
+                self.fill(values, self.macros[name])
+
+
+class AttributeEngine:
+    """Resolves the attributes of paths in one repository, with a matcher per directory."""
+
+    def __init__(self, info, nested, root, outer, ignore_case):
+        self.ignore_case = ignore_case
+        self.info = info
+        # nested attributes files, by the directory they apply to
+        self.nested = (
+            {fold(dir): value for dir, value in nested.items()}
+            if ignore_case
+            else nested
+        )
+        self.root = root
+        self.outer = outer
+        self.macros = {}
+        for attribute_file in [info, root, *outer]:
+            if attribute_file is None:
+                continue
+            for name, states in reversed(attribute_file.macros):
+                self.macros.setdefault(name, states)
+        self.compiled = {}
+        self.matchers = {}
+        self.shared_matchers = {}
+
+    def compile_file(self, attribute_file):
+        rules = self.compiled.get(id(attribute_file))
+        if rules is None:
+            rules = []
+            for rule in reversed(attribute_file.rules):
+                pattern = rule.pattern
+                if pattern.endswith("/"):
+                    # only matches directories, and files are never directories
+                    continue
+                try:
+                    if "/" in pattern:
+                        compiled = PathRule(
+                            pattern, attribute_file.base, self.ignore_case
+                        )
+                    else:
+                        compiled = BasenameRule(
+                            tokenize(pattern, ignore_case=self.ignore_case)
+                        )
+                except (InvalidPattern, re.error):
+                    # git treats malformed patterns as never matching
+                    continue
+                rules.append((compiled, rule.states))
+            self.compiled[id(attribute_file)] = rules
+        return rules
+
+    def get_stack(self, dir):
+        stack = [self.info]
+        parent = dir
+        while parent:
+            nested = self.nested.get(parent)
+            if nested is not None:
+                stack.append(nested)
+            parent = parent.rpartition("/")[0]
+        stack.append(self.root)
+        stack.extend(self.outer)
+        return [
+            attribute_file for attribute_file in stack if attribute_file is not None
+        ]
+
+    def get_matcher(self, dir):
+        stack = self.get_stack(dir)
+        # directories which the same rules apply to share a matcher, and what it already resolved
+        key = []
+        for attribute_file in stack:
+            key.append(id(attribute_file))
+            for rule, _ in self.compile_file(attribute_file):
+                if (
+                    isinstance(rule, PathRule)
+                    and rule.path_regex is None
+                    and rule.matches_dir(dir)
+                ):
+                    key.append(id(rule))
+        key = tuple(key)
+        matcher = self.shared_matchers.get(key)
+        if matcher is None:
+            rules = []
+            for attribute_file in stack:
+                for rule, states in self.compile_file(attribute_file):
+                    if isinstance(rule, PathRule) and rule.path_regex is None:
+                        if id(rule) not in key:
+                            continue
+                        rule = rule.name_rule
+                    rules.append((rule, states))
+            matcher = Matcher(rules, self.macros)
+            self.shared_matchers[key] = matcher
+        self.matchers[dir] = matcher
+        return matcher
+
+    def get_values(self, paths):
+        """Returns the attribute values of each path, as dicts which must not be modified."""
+        matchers = self.matchers
+        ignore_case = self.ignore_case
+        results = []
+        append = results.append
+        last_dir = None
+        # this runs for every path, so the common cases are inlined, and paths from git come sorted by directory
+        for path in paths:
+            if type(path) is not str or "\\" in path or path[:2] == "./":
+                path = normalize_path(path)
+            if ignore_case:
+                path = fold(path)
+            dir, _, name = path.rpartition("/")
+            if dir != last_dir:
+                matcher = matchers.get(dir)
+                if matcher is None:
+                    matcher = self.get_matcher(dir)
+                by_extension = matcher.by_extension
+                unmatched = matcher.unmatched
+                last_dir = dir
+            if by_extension is None:
+                append(matcher.match(name, path))
+                continue
+            dot = name.rfind(".")
+            append(by_extension.get(name[dot:], unmatched) if dot != -1 else unmatched)
+        return results
+
+
+def describe_value(value):
+    if value is True:
+        return "set"
+    if value is False:
+        return "unset"
+    if value is None:
+        return "unspecified"
+    return value
+
+
+def read_text(path):
+    try:
+        with open(path, encoding="utf-8", errors="surrogateescape") as f:
+            return f.read()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def get_attribute_paths(git_dir, config):
+    """Returns the info, global and system attributes files git reads."""
+    info = pbgitmeta.get_common_dir(git_dir) / "info" / "attributes"
+    attributes_file = config.get("core.attributesfile")
+    if attributes_file:
+        global_path = pbgitmeta.expand_path(attributes_file[-1], Path.cwd())
+    else:
+        xdg_config_home = os.getenv("XDG_CONFIG_HOME")
+        xdg_config_dir = (
+            Path(xdg_config_home)
+            if xdg_config_home
+            else pbgitmeta.get_home() / ".config"
+        )
+        global_path = xdg_config_dir / "git" / "attributes"
+    system_path = None
+    if not os.getenv("GIT_ATTR_NOSYSTEM"):
+        if os.getenv("GIT_CONFIG_SYSTEM") or os.getenv("GIT_CONFIG_NOSYSTEM"):
+            raise pbgitmeta.MetadataError(
+                "The system attributes file cannot be located"
+            )
+        system_config = pbgitmeta.get_system_config_path(git_dir)
+        if system_config is not None:
+            system_path = system_config.parent / "gitattributes"
+    return info, global_path, system_path
+
+
+def get_file_key(path):
+    if path is None:
+        return None
+    try:
+        st = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def get_nested_paths(index):
+    # nested attributes files are found through the index, rather than by looking in every directory
+    if nested_paths_cache.get("index") is not index:
+        nested_paths_cache["index"] = index
+        nested_paths_cache["paths"] = [
+            path
+            for path, entry in index.entries.items()
+            if path.endswith("/.gitattributes")
+            and entry.mode != pbgitindex.sparse_dir_mode
+        ]
+    return nested_paths_cache["paths"]
+
+
+def get_engine():
+    """Returns the attribute engine for the current repository, built again once any attributes file changed."""
+    git_dir = pbgitmeta.get_git_dir()
+    config = pbgitsession.get_session().load_config()
+    ignore_case = pbgitmeta.is_true(config.get("core.ignorecase", ["false"])[-1])
+    info_path, global_path, system_path = get_attribute_paths(git_dir, config)
+    nested_paths = get_nested_paths(pbgitindex.read_index(git_dir))
+    key = (
+        ignore_case,
+        str(info_path),
+        str(global_path),
+        str(system_path),
+        tuple(
+            (path, get_file_key(path))
+            for path in [
+                info_path,
+                ".gitattributes",
+                *nested_paths,
+                global_path,
+                system_path,
+            ]
+        ),
+    )
+    engine = engine_cache.get(key)
+    if engine is not None:
+        return engine
+
+    def load(path, base, macros_allowed):
+        if path is None:
+            return None
+        text = read_text(path)
+        return None if text is None else AttributeFile(text, base, macros_allowed, path)
+
+    nested = {}
+    for path in nested_paths:
+        text = read_text(path)
+        if text is None:
+            # git would read it from the index instead
+            raise pbgitmeta.MetadataError(f"{path} is missing from the working tree")
+        base = path[: -len("/.gitattributes")]
+        nested[base] = AttributeFile(text, base, False, path)
+    engine = AttributeEngine(
+        load(info_path, "", True),
+        nested,
+        load(".gitattributes", "", True),
+        [
+            load(global_path, "", True),
+            load(system_path, "", True),
+            AttributeFile(builtin_macros, "", True, "builtin"),
+        ],
+        ignore_case,
+    )
+    engine_cache.clear()
+    engine_cache[key] = engine
+    return engine
+
+
+def normalize_path(path):
+    if not isinstance(path, str):
+        path = str(path)
+    if "\\" in path:
+        path = path.replace("\\", "/")
+    while path.startswith("./"):
+        path = path[2:]
+    return path
+
+
+def check_attr_paths(paths, *attrs):
+    """Like GitSession.check_attr_paths: a dict of attribute values for each of the paths, in order."""
+    return [
+        {attr: describe_value(values.get(attr)) for attr in attrs}
+        for values in get_engine().get_values(paths)
+    ]
+
+
+def get_attr_values(paths, attr):
+    """Returns the raw value of one attribute for each of the paths: True, False, None or a string."""
+    return [values.get(attr) for values in get_engine().get_values(paths)]
@@ -0,0 +1,466 @@
+import bisect
+import os
+import struct
+from collections import namedtuple
+from pathlib import Path
+
+from pbpy import pbgitmeta, pbgitsession, pbsparse
+
+# reads the git index straight from .git/index, without starting git
+# anything this does not understand raises pbgitmeta.MetadataError, for the caller to ask git instead
+
+header_struct = struct.Struct(">4sLL")
+# ctime, mtime, dev, ino, mode, uid, gid and size
+stat_struct = struct.Struct(">10L")
+flags_struct = struct.Struct(">H")
+
+name_mask = 0xFFF
+stage_mask = 0x3000
+stage_shift = 12
+extended_flag = 0x4000
+assume_valid_flag = 0x8000
+skip_worktree_flag = 0x4000
+intent_to_add_flag = 0x2000
+
+file_type_mask = 0o170000
+regular_file_mode = 0o100000
+gitlink_mode = 0o160000
+sparse_dir_mode = 0o040000
+
+# file types which are locked in LFS, in the directories where they can be locked
+lockable_extensions = (".uasset", ".umap")
+
+IndexEntry = namedtuple(
+    "IndexEntry",
+    [
+        "path",
+        "mode",
+        "mtime",
+        "size",
+        "oid",
+        "stage",
+        "assume_valid",
+        "skip_worktree",
+        "intent_to_add",
+    ],
+)
+CacheTree = namedtuple("CacheTree", ["path", "oid", "children"])
+
+index_cache = {}
+
+
+class Index:
+    """The entries of a git index, by path, along with its cached trees."""
+
+    def __init__(self, entries, tree, mtime, ignore_case):
+        self.entries = entries
+        self.tree = tree
+        # entries modified in the same instant the index was written may have changed without their stat changing
+        self.mtime = mtime
+        self.ignore_case = ignore_case
+        self.folded = None
+        self.paths = None
+
+    def get(self, path):
+        entry = self.entries.get(path)
+        if entry is None and self.ignore_case:
+            if self.folded is None:
+                self.folded = {
+                    key.lower(): value for key, value in self.entries.items()
+                }
+            entry = self.folded.get(path.lower())
+        return entry
+
+    def get_range(self, dir):
+        """Returns the bounds of the entries under dir. Entries are sorted by path, so these are contiguous."""
+        if self.paths is None:
+            self.paths = list(self.entries)
+        # "0" is the character after "/"
+        return bisect.bisect_left(self.paths, f"{dir}/"), bisect.bisect_left(
+            self.paths, f"{dir}0"
+        )
+
+    def get_sparse_dir(self, path):
+        """Returns the entry of the directory path was collapsed into by a sparse index, if any."""
+        for parent in get_parent_dirs(path):
+            entry = self.entries.get(f"{parent}/")
+            if entry is not None and entry.mode == sparse_dir_mode:
+                return entry
+        return None
+
+    def is_racy(self, entry):
+        return entry.mtime >= self.mtime
+
+    def stat_matches(self, entry, st):
+        """Whether the file looks like it did when it was staged, comparing mtime and size like core.checkStat=minimal."""
+        if entry.assume_valid or entry.skip_worktree:
+            return True
+        if self.is_racy(entry):
+            return False
+        # the index only keeps 32 bits of the size
+        if entry.size != st.st_size & 0xFFFFFFFF:
+            return False
+        if entry.mtime % 1_000_000_000:
+            return entry.mtime == st.st_mtime_ns
+        # git built without nanosecond timestamps only stores seconds
+        return entry.mtime // 1_000_000_000 == st.st_mtime_ns // 1_000_000_000
+
+
+def get_index_path(git_dir):
+    index_file = os.getenv("GIT_INDEX_FILE")
+    return Path(index_file) if index_file else git_dir / "index"
+
+
+def read_repository_config(git_dir):
+    # the object format and ignorecase are always set in the repository's own config
+    config = {}
+    pbgitmeta.read_config_file(pbgitmeta.get_common_dir(git_dir) / "config", config)
+    return config
+
+
+def read_varint(data, pos):
+    # git's offset encoding, where each continuation also adds one
+    c = data[pos]
+    pos += 1
+    value = c & 0x7F
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7F)
+    return value, pos
+
+
+def parse_cache_tree(data, hash_size):
+    # nodes are stored depth first: path, entry count (-1 if invalidated), subtree count, then the tree id if valid
+    pos = 0
+
+    def parse_node(prefix):
+        nonlocal pos
+        end = data.index(b"\0", pos)
+        name = os.fsdecode(data[pos:end])
+        pos = end + 1
+        end = data.index(b"\n", pos)
+        entry_count, subtree_count = data[pos:end].split(b" ")
+        pos = end + 1
+        oid = None
+        if int(entry_count) >= 0:
+            oid = data[pos : pos + hash_size].hex()
+            pos += hash_size
+        path = f"{prefix}{name}" if name else prefix.rstrip("/")
+        child_prefix = f"{path}/" if path else ""
+        children = [parse_node(child_prefix) for _ in range(int(subtree_count))]
+        return CacheTree(path, oid, children)
+
+    return parse_node("")
+
+
+def parse_index(data, hash_size, mtime, ignore_case):
+    signature, version, count = header_struct.unpack_from(data, 0)
+    if signature != b"DIRC":
+        raise pbgitmeta.MetadataError("Not a git index")
+    if version not in (2, 3, 4):
+        raise pbgitmeta.MetadataError(f"Index version {version} is not supported")
+    entries = {}
+    pos = header_struct.size
+    previous_name = b""
+    for _ in range(count):
+        start = pos
+        stat = stat_struct.unpack_from(data, pos)
+        pos += stat_struct.size
+        oid = data[pos : pos + hash_size].hex()
+        pos += hash_size
+        (flags,) = flags_struct.unpack_from(data, pos)
+        pos += flags_struct.size
+        extended_flags = 0
+        if flags & extended_flag:
+            if version < 3:
+                raise pbgitmeta.MetadataError("Extended flags in a version 2 index")
+            (extended_flags,) = flags_struct.unpack_from(data, pos)
+            pos += flags_struct.size
+        if version == 4:
+            # names are stored as the length to strip from the previous name, and a suffix
+            strip, pos = read_varint(data, pos)
+            end = data.index(b"\0", pos)
+            name = previous_name[: len(previous_name) - strip] + data[pos:end]
+            pos = end + 1
+            previous_name = name
+        else:
+            name_length = flags & name_mask
+            # longer names are only NUL terminated
+            end = (
+                pos + name_length if name_length < name_mask else data.index(b"\0", pos)
+            )
+            name = data[pos:end]
+            # entries are padded with one to eight NULs to a multiple of eight bytes
+            pos = start + (end - start + 8) // 8 * 8
+        path = os.fsdecode(name)
+        entries[path] = IndexEntry(
+            path,
+            stat[6],
+            stat[2] * 1_000_000_000 + stat[3],
+            stat[9],
+            oid,
+            (flags & stage_mask) >> stage_shift,
+            bool(flags & assume_valid_flag),
+            bool(extended_flags & skip_worktree_flag),
+            bool(extended_flags & intent_to_add_flag),
+        )
+    tree = None
+    end = len(data) - hash_size
+    while pos + 8 <= end:
+        signature = data[pos : pos + 4]
+        (size,) = struct.unpack_from(">L", data, pos + 4)
+        pos += 8
+        if signature == b"TREE":
+            tree = parse_cache_tree(data[pos : pos + size], hash_size)
+        elif signature == b"sdir":
+            # marks a sparse index, whose directory entries are told apart by their mode
+            pass
+        elif signature == b"link":
+            raise pbgitmeta.MetadataError("Split indexes are not supported")
+        elif not signature[:1].isupper():
+            raise pbgitmeta.MetadataError(f"Unknown index extension {signature}")
+        pos += size
+    return Index(entries, tree, mtime, ignore_case)
+
+
+def read_index(git_dir=None):
+    """Returns the index of the repository, which is only parsed again once it has been written."""
+    if git_dir is None:
+        git_dir = pbgitmeta.get_git_dir()
+    path = get_index_path(git_dir)
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return Index({}, None, 0, False)
+    key = (str(path), st.st_mtime_ns, st.st_size)
+    index = index_cache.get(key)
+    if index is not None:
+        return index
+    config = read_repository_config(git_dir)
+    object_format = config.get("extensions.objectformat", ["sha1"])[-1].lower()
+    if object_format not in ("sha1", "sha256"):
+        raise pbgitmeta.MetadataError(f"Unknown object format {object_format}")
+    hash_size = 20 if object_format == "sha1" else 32
+    ignore_case = pbgitmeta.is_true(config.get("core.ignorecase", ["false"])[-1])
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        index = parse_index(data, hash_size, st.st_mtime_ns, ignore_case)
+    except (struct.error, ValueError, IndexError) as e:
+        raise pbgitmeta.MetadataError(f"Could not parse {path}: {e}")
+    index_cache.clear()
+    index_cache[key] = index
+    return index
+
+
+def read_index_version(git_dir=None):
+    """Returns the version of the index file, without parsing the rest of it. None if there is no index."""
+    if git_dir is None:
+        git_dir = pbgitmeta.get_git_dir()
+    try:
+        with open(get_index_path(git_dir), "rb") as f:
+            header = f.read(header_struct.size)
+    except FileNotFoundError:
+        return None
+    try:
+        signature, version, _ = header_struct.unpack_from(header, 0)
+    except struct.error as e:
+        raise pbgitmeta.MetadataError(f"Could not parse the index header: {e}")
+    if signature != b"DIRC":
+        raise pbgitmeta.MetadataError("The index has no valid signature")
+    return version
+
+
+def get_lockable_dirs():
+    dirs = ["Content"]
+    try:
+        with os.scandir("Plugins") as it:
+            dirs.extend(
+                f"Plugins/{plugin.name}/Content" for plugin in it if plugin.is_dir()
+            )
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return dirs
+
+
+def scan_dirs(dirs, shallow_dirs=()):
+    """Returns the directory entry of every file under dirs, and directly in shallow_dirs, by path."""
+    files = {}
+    pending = [(dir, True) for dir in dirs]
+    pending.extend((dir, False) for dir in shallow_dirs)
+    while pending:
+        path, recursive = pending.pop()
+        try:
+            it = os.scandir(path)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with it:
+            for entry in it:
+                entry_path = f"{path}/{entry.name}"
+                if not entry.is_dir(follow_symlinks=False):
+                    files[entry_path] = entry
+                elif recursive and entry.name != ".git":
+                    pending.append((entry_path, True))
+    return files
+
+
+def scan_lockable_dirs():
+    """Returns the directory entry of every file in the lockable directories which the sparse checkout includes, by path."""
+    return scan_dirs(
+        *pbsparse.split_scan_dirs(get_lockable_dirs(), pbsparse.get_cone())
+    )
+
+
+def get_parent_dirs(path):
+    parent = path
+    while "/" in parent:
+        parent = parent.rpartition("/")[0]
+        yield parent
+
+
+def is_under(path, dirs):
+    return any(parent in dirs for parent in get_parent_dirs(path))
+
+
+def overlaps(path, dirs):
+    # the root, a directory under one of dirs, or one which contains some of them
+    return (
+        not path
+        or is_under(f"{path}/", dirs)
+        or any(is_under(dir, {path}) for dir in dirs)
+    )
+
+
+def get_staged_entries(index, dirs):
+    """Returns the entries under dirs which differ from HEAD, along with whether HEAD has them at all."""
+    session = pbgitsession.get_session()
+    dirs = set(dirs)
+    # cached trees which still match HEAD vouch for everything under them, level by level
+    clean_trees = set()
+    pending = [] if index.tree is None else [index.tree]
+    while pending:
+        pending = [node for node in pending if overlaps(node.path, dirs)]
+        valid = [node for node in pending if node.oid is not None]
+        head_oids = session.rev_parse_all(
+            f"HEAD:{node.path}" if node.path else "HEAD^{tree}" for node in valid
+        )
+        clean_trees.update(
+            node.path for node, oid in zip(valid, head_oids) if node.oid == oid
+        )
+        pending = [
+            child
+            for node in pending
+            if node.path not in clean_trees
+            for child in node.children
+        ]
+    if "" in clean_trees:
+        return {}
+    excluded = sorted(index.get_range(tree) for tree in clean_trees)
+    candidates = []
+    for dir in dirs:
+        start, end = index.get_range(dir)
+        for clean_start, clean_end in excluded:
+            if clean_end <= start or clean_start >= end:
+                continue
+            candidates.extend(index.paths[start:clean_start])
+            start = max(start, clean_end)
+        candidates.extend(index.paths[start:end])
+    candidates = [
+        index.entries[path]
+        for path in candidates
+        if index.entries[path].mode != sparse_dir_mode
+    ]
+    head_oids = session.rev_parse_all(f"HEAD:{entry.path}" for entry in candidates)
+    return {
+        entry.path: oid is not None
+        for entry, oid in zip(candidates, head_oids)
+        if entry.intent_to_add or entry.oid != oid
+    }
+
+
+def get_lockables():
+    """Returns the tracked lockable files which exist in the working tree."""
+    index = read_index()
+    files = scan_lockable_dirs()
+    lockables = set()
+    for path in files:
+        if not path.lower().endswith(lockable_extensions):
+            continue
+        entry = index.get(path)
+        if entry is not None and not entry.skip_worktree:
+            lockables.add(path)
+    return lockables
+
+
+def get_worktree_files():
+    """Returns the tracked regular files which are checked out in the working tree."""
+    return [
+        entry.path
+        for entry in read_index().entries.values()
+        if entry.mode & file_type_mask == regular_file_mode
+        and entry.stage == 0
+        and not entry.skip_worktree
+    ]
+
+
+def get_stat_modified(files):
+    """Returns the files whose stat changed since they were staged, including deleted ones."""
+    index = read_index()
+    modified = set()
+    for file in files:
+        entry = index.get(file)
+        if entry is None or entry.mode == gitlink_mode:
+            continue
+        try:
+            st = os.lstat(file)
+        except (FileNotFoundError, NotADirectoryError):
+            if not entry.skip_worktree:
+                modified.add(file)
+            continue
+        if not index.stat_matches(entry, st):
+            modified.add(file)
+    return modified
+
+
+def get_new_files():
+    """Returns the files in the lockable directories which are untracked and not ignored, or added since HEAD."""
+    index = read_index()
+    dirs = get_lockable_dirs()
+    files = scan_lockable_dirs()
+    untracked = [path for path in files if index.get(path) is None]
+    ignored = pbgitsession.get_session().check_ignore_paths(untracked)
+    new_files = {path for path, is_ignored in zip(untracked, ignored) if not is_ignored}
+    new_files.update(
+        path for path, in_head in get_staged_entries(index, dirs).items() if not in_head
+    )
+    return new_files
+
+
+def get_modified_files(files):
+    """Returns which of files differ from HEAD: changed on disk, staged, new or deleted.
+
+    Files whose stat changed count as modified without comparing their content.
+    """
+    index = read_index()
+    files = [str(file).replace("\\", "/") for file in files]
+    modified = get_stat_modified(files)
+    pending = [file for file in files if file not in modified]
+    entries = [index.get(file) for file in pending]
+    names = [f"HEAD:{file}" for file in pending]
+    for i, entry in enumerate(entries):
+        if entry is None:
+            # files outside of a sparse checkout are unchanged as long as their collapsed directory is
+            sparse_dir = index.get_sparse_dir(pending[i])
+            if sparse_dir is not None:
+                entries[i] = sparse_dir
+                names[i] = f"HEAD:{sparse_dir.path.rstrip('/')}"
+    head_oids = pbgitsession.get_session().rev_parse_all(names)
+    for file, entry, head_oid in zip(pending, entries, head_oids):
+        if entry is None:
+            # untracked, or deleted from the index
+            if head_oid is not None or os.path.lexists(file):
+                modified.add(file)
+        elif entry.intent_to_add or entry.oid != head_oid:
+            modified.add(file)
+    return modified
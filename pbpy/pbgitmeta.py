@@ -0,0 +1,382 @@
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+
+from pbpy import pbgit, pbtools
+
+# reads repository metadata straight from the files under .git, without starting git
+# anything this does not understand raises MetadataError, for the caller to ask git instead
+
+max_include_depth = 10
+object_id_pattern = re.compile(r"^(?:[0-9a-f]{40}|[0-9a-f]{64})$")
+section_pattern = re.compile(
+    r'\[[ \t]*([A-Za-z0-9.-]+)(?:[ \t]+"((?:[^"\\\n]|\\.)*)")?[ \t]*\]'
+)
+name_pattern = re.compile(r"[A-Za-z][A-Za-z0-9-]*")
+value_escapes = {"n": "\n", "t": "\t", "b": "\b", '"': '"', "\\": "\\"}
+# refs which belong to a worktree, rather than to the common directory
+worktree_ref_prefixes = ("refs/bisect/", "refs/worktree/", "refs/rewritten/")
+
+packed_refs_cache = {}
+
+
+class MetadataError(Exception):
+    pass
+
+
+def normalize_config_key(key):
+    # section and variable names are case insensitive, subsections are not
+    section, _, rest = key.partition(".")
+    subsection, dot, name = rest.rpartition(".")
+    return f"{section.lower()}.{subsection}{dot}{name.lower()}"
+
+
+def is_true(value):
+    # a key without a value is true
+    return value.lower() in ("", "true", "yes", "on", "1")
+
+
+def find_git_dir(path="."):
+    """Returns the git directory of the repository containing path, or None if there is none."""
+    if os.getenv("GIT_DIR"):
+        return Path(os.getenv("GIT_DIR"))
+    path = Path(path).absolute()
+    for parent in [path, *path.parents]:
+        dot_git = parent / ".git"
+        if dot_git.is_dir():
+            return dot_git
+        if dot_git.is_file():
+            # linked worktrees and submodules point to their git directory
+            with open(dot_git) as f:
+                content = f.read().strip()
+            if not content.startswith("gitdir: "):
+                raise MetadataError(f"Unknown .git file format in {dot_git}")
+            git_dir = parent / content[len("gitdir: ") :]
+            return git_dir if git_dir.is_dir() else None
+    return None
+
+
+def get_git_dir():
+    git_dir = find_git_dir()
+    if git_dir is None:
+        raise MetadataError("Not in a git repository")
+    return git_dir
+
+
+def get_common_dir(git_dir):
+    # linked worktrees share the refs and config of the main repository
+    try:
+        with open(git_dir / "commondir") as f:
+            return git_dir / f.read().strip()
+    except FileNotFoundError:
+        return git_dir
+
+
+def read_packed_refs(common_dir):
+    path = common_dir / "packed-refs"
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return {}
+    key = (str(path), st.st_mtime_ns, st.st_size)
+    refs = packed_refs_cache.get(key)
+    if refs is not None:
+        return refs
+    refs = {}
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            # the header, and peeled tags
+            if not line or line.startswith("#") or line.startswith("^"):
+                continue
+            oid, _, name = line.partition(" ")
+            if not object_id_pattern.match(oid) or not name:
+                raise MetadataError(f"Could not parse {path}: {line}")
+            refs[name] = oid
+    packed_refs_cache.clear()
+    packed_refs_cache[key] = refs
+    return refs
+
+
+def read_ref(name, git_dir=None):
+    """Returns the content of a ref: "ref: <target>" for symbolic refs, or an object id. None if it does not exist."""
+    if git_dir is None:
+        git_dir = get_git_dir()
+    common_dir = get_common_dir(git_dir)
+    if (common_dir / "reftable").is_dir():
+        raise MetadataError("reftable is not supported")
+    is_worktree_ref = "/" not in name or name.startswith(worktree_ref_prefixes)
+    base_dir = git_dir if is_worktree_ref else common_dir
+    try:
+        with open(base_dir / name) as f:
+            content = f.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return read_packed_refs(common_dir).get(name)
+    except IsADirectoryError:
+        return None
+    if content.startswith("ref: ") or object_id_pattern.match(content):
+        return content
+    raise MetadataError(f"Could not parse ref {name}: {content}")
+
+
+def resolve_ref(name, git_dir=None):
+    """Follows symbolic refs, and returns the object id name points to, or None if it does not exist."""
+    if git_dir is None:
+        git_dir = get_git_dir()
+    for _ in range(max_include_depth):
+        content = read_ref(name, git_dir)
+        if content is None or not content.startswith("ref: "):
+            return content
+        name = content[len("ref: ") :]
+    raise MetadataError(f"Symbolic ref loop at {name}")
+
+
+def get_current_branch_name(git_dir=None):
+    """Like git branch --show-current: the checked out branch, or an empty string when HEAD is detached."""
+    head = read_ref("HEAD", git_dir)
+    if head is None:
+        raise MetadataError("HEAD is missing")
+    if not head.startswith("ref: "):
+        return ""
+    ref = head[len("ref: ") :]
+    return ref[len("refs/heads/") :] if ref.startswith("refs/heads/") else ""
+
+
+def is_shallow(git_dir=None):
+    if git_dir is None:
+        git_dir = get_git_dir()
+    try:
+        return (get_common_dir(git_dir) / "shallow").stat().st_size > 0
+    except FileNotFoundError:
+        return False
+
+
+def get_home():
+    home = os.getenv("HOME")
+    if home:
+        return Path(home)
+    if os.name == "nt":
+        return Path(os.getenv("USERPROFILE", "~")).expanduser()
+    return Path.home()
+
+
+def expand_path(value, base_dir):
+    if value.startswith("~/"):
+        return get_home() / value[2:]
+    path = Path(value)
+    return path if path.is_absolute() else base_dir / path
+
+
+def parse_value(text, pos):
+    """Parses a config value starting at pos, following git's quoting, escaping and whitespace rules."""
+    value = []
+    quoted = False
+    # whitespace outside of quotes is only kept if something follows it
+    spaces = 0
+    n = len(text)
+    while pos < n:
+        c = text[pos]
+        pos += 1
+        if c == "\n":
+            if quoted:
+                raise MetadataError("Unterminated quote in config value")
+            break
+        if not quoted and c in " \t\r":
+            if value:
+                spaces += 1
+            continue
+        if not quoted and c in "#;":
+            pos = text.find("\n", pos)
+            pos = n if pos == -1 else pos + 1
+            break
+        if spaces:
+            value.append(" " * spaces)
+            spaces = 0
+        if c == "\\":
+            if pos >= n:
+                raise MetadataError("Dangling escape in config value")
+            c = text[pos]
+            pos += 1
+            if c == "\n":
+                # line continuation
+                continue
+            if c == "\r" and text.startswith("\n", pos):
+                pos += 1
+                continue
+            if c not in value_escapes:
+                raise MetadataError(f"Unknown escape \\{c} in config value")
+            value.append(value_escapes[c])
+        elif c == '"':
+            quoted = not quoted
+        else:
+            value.append(c)
+    if quoted:
+        raise MetadataError("Unterminated quote in config value")
+    return "".join(value), pos
+
+
+def read_config_file(path, config, depth=0):
+    """Adds the entries of a config file to config, in order, following include.path."""
+    if depth > max_include_depth:
+        raise MetadataError(f"Too many nested includes at {path}")
+    try:
+        with open(path, encoding="utf-8-sig") as f:
+            text = f.read()
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    except (OSError, UnicodeDecodeError) as e:
+        raise MetadataError(f"Could not read {path}: {e}")
+    section = None
+    pos = 0
+    n = len(text)
+    while pos < n:
+        c = text[pos]
+        if c in " \t\r\n":
+            pos += 1
+            continue
+        if c in "#;":
+            pos = text.find("\n", pos)
+            pos = n if pos == -1 else pos + 1
+            continue
+        if c == "[":
+            match = section_pattern.match(text, pos)
+            if match is None:
+                raise MetadataError(f"Could not parse section in {path}")
+            name, subsection = match.groups()
+            if subsection is None:
+                # the old [section.subsection] syntax is case insensitive throughout
+                section = name.lower()
+            else:
+                subsection = re.sub(r"\\(.)", r"\1", subsection)
+                section = f"{name.lower()}.{subsection}"
+            if section.startswith("includeif."):
+                raise MetadataError("Conditional includes are not supported")
+            pos = match.end()
+            continue
+        match = name_pattern.match(text, pos)
+        if match is None or section is None:
+            raise MetadataError(f"Could not parse config entry in {path}")
+        key = f"{section}.{match.group().lower()}"
+        pos = match.end()
+        while pos < n and text[pos] in " \t":
+            pos += 1
+        if pos < n and text[pos] == "=":
+            value, pos = parse_value(text, pos + 1)
+        elif pos >= n or text[pos] in "\r\n#;":
+            # no value means true
+            value = ""
+            value_end = text.find("\n", pos)
+            pos = n if value_end == -1 else value_end + 1
+        else:
+            raise MetadataError(f"Could not parse config entry {key} in {path}")
+        config.setdefault(key, []).append(value)
+        if key == "include.path" and value:
+            read_config_file(expand_path(value, Path(path).parent), config, depth + 1)
+
+
+def get_system_config_path(git_dir):
+    """Asks git where its system config lives once per git installation, and remembers it in the PBSync cache."""
+    if os.getenv("GIT_CONFIG_NOSYSTEM"):
+        return None
+    if os.getenv("GIT_CONFIG_SYSTEM"):
+        return Path(os.getenv("GIT_CONFIG_SYSTEM"))
+    git = shutil.which(pbgit.get_git_executable())
+    if git is None:
+        raise MetadataError("git is not installed")
+    git = os.path.realpath(git)
+    git_mtime = os.stat(git).st_mtime_ns
+    cache_path = git_dir / pbtools.cache_dir_name / "system-config.json"
+    try:
+        with open(cache_path) as f:
+            entry = json.load(f)
+        if entry["git"] == git and entry["mtime"] == git_mtime:
+            return Path(entry["path"]) if entry["path"] else None
+    except (OSError, ValueError, KeyError):
+        pass
+    proc = pbtools.run_with_output(
+        [pbgit.get_git_executable(), "config", "--system", "--show-origin", "--list"]
+    )
+    origin = re.match(r"^file:(.*?)\t", proc.stdout)
+    if origin is None:
+        # git names the file it wanted when it does not exist
+        origin = re.search(r"'(.+)'", proc.stderr)
+    if origin is None and proc.returncode == 0:
+        raise MetadataError("Could not locate the system git config")
+    if origin is None and "unable to read config file" not in proc.stderr:
+        raise MetadataError(f"Could not run git: {proc.stderr}")
+    path = origin.group(1) if origin else ""
+    try:
+        cache_path.parent.mkdir(exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump({"git": git, "mtime": git_mtime, "path": path}, f)
+    except OSError:
+        pass
+    return Path(path) if path else None
+
+
+def get_global_config_paths():
+    if os.getenv("GIT_CONFIG_GLOBAL"):
+        return [Path(os.getenv("GIT_CONFIG_GLOBAL"))]
+    xdg_config_home = os.getenv("XDG_CONFIG_HOME")
+    xdg_config_dir = (
+        Path(xdg_config_home) if xdg_config_home else get_home() / ".config"
+    )
+    return [xdg_config_dir / "git" / "config", get_home() / ".gitconfig"]
+
+
+def read_config(git_dir=None):
+    """Returns every config entry git would see in this repository, as a dict of lists of values in git config --list order."""
+    if os.getenv("GIT_CONFIG_PARAMETERS"):
+        raise MetadataError("git -c parameters are not supported")
+    if git_dir is None:
+        git_dir = get_git_dir()
+    common_dir = get_common_dir(git_dir)
+    config = {}
+    if os.name == "nt" and os.getenv("PROGRAMDATA"):
+        # Git for Windows portable config
+        read_config_file(Path(os.getenv("PROGRAMDATA")) / "Git" / "config", config)
+    system_config = get_system_config_path(git_dir)
+    if system_config is not None:
+        read_config_file(system_config, config)
+    for path in get_global_config_paths():
+        read_config_file(path, config)
+    read_config_file(common_dir / "config", config)
+    worktree_config = config.get("extensions.worktreeconfig")
+    if worktree_config and is_true(worktree_config[-1]):
+        read_config_file(git_dir / "config.worktree", config)
+    # config passed through the environment comes last
+    for i in range(int(os.getenv("GIT_CONFIG_COUNT", "0") or "0")):
+        key = os.getenv(f"GIT_CONFIG_KEY_{i}")
+        if not key:
+            raise MetadataError(f"GIT_CONFIG_KEY_{i} is missing")
+        config.setdefault(normalize_config_key(key), []).append(
+            os.getenv(f"GIT_CONFIG_VALUE_{i}", "")
+        )
+    return config
+
+
+def read_sparse_checkout_cone(git_dir=None):
+    """Returns the directories of a cone mode sparse-checkout file, which git checks out recursively."""
+    if git_dir is None:
+        git_dir = get_git_dir()
+    with open(git_dir / "info" / "sparse-checkout", encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    included = []
+    # the parents of the directories are included without their subdirectories
+    parents = set()
+    for line in lines:
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("!"):
+            if not line.endswith("/*/"):
+                raise MetadataError(f"Not a cone mode pattern: {line}")
+            parents.add(line[1:-2])
+        elif line.startswith("/") and line.endswith("/"):
+            included.append(line)
+        elif line != "/*":
+            raise MetadataError(f"Not a cone mode pattern: {line}")
+    return [
+        re.sub(r"\\(.)", r"\1", dir[1:-1]) for dir in included if dir not in parents
+    ]
@@ -0,0 +1,336 @@
+import asyncio
+import atexit
+import os
+import subprocess
+import threading
+
+from pbpy import pbgit, pbgitmeta, pblog, pbtools
+
+# long lived git processes, per repository
+sessions = {}
+
+
+class Coprocess:
+    """A long lived git process which answers one request per record written to its stdin."""
+
+    def __init__(self, cmd, cwd):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.proc = None
+        self.buffer = b""
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.proc is not None and self.proc.poll() is None:
+            return
+        cmd, _ = pbtools.handle_shell(self.cmd, shell=False)
+        self.buffer = b""
+        self.proc = subprocess.Popen(
+            cmd,
+            cwd=self.cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            pbtools.kill_process_tree(self.proc.pid)
+        self.proc.stdout.close()
+        self.proc = None
+
+    def read_record(self, sep):
+        while True:
+            end = self.buffer.find(sep)
+            if end != -1:
+                record = self.buffer[:end]
+                self.buffer = self.buffer[end + 1 :]
+                return record
+            chunk = self.proc.stdout.read1(64 * 1024)
+            if not chunk:
+                raise EOFError(f"{self.cmd[1]} exited")
+            self.buffer += chunk
+
+    def request(self, records, sep, count):
+        """Writes the records, and reads back count response records for each of them.
+
+        Returns None if the process failed, for the caller to fall back to a one-shot command.
+        """
+        with self.lock:
+            try:
+                self.start()
+                # write from another thread, so a large request cannot deadlock on full pipes
+                writer = threading.Thread(
+                    target=self.write, args=(records, sep), daemon=True
+                )
+                writer.start()
+                responses = [
+                    [self.read_record(sep) for _ in range(count)] for _ in records
+                ]
+                writer.join()
+                return responses
+            except (OSError, EOFError) as e:
+                pblog.debug(f"git {self.cmd[1]} coprocess failed: {e}")
+                self.close()
+                return None
+
+    def write(self, records, sep):
+        try:
+            self.proc.stdin.write(b"".join(record + sep for record in records))
+            self.proc.stdin.flush()
+        except OSError:
+            # the reader sees the process exit
+            pass
+
+
+def encode_path(path):
+    return os.fsencode(str(path)).replace(b"\\", b"/")
+
+
+class GitSession:
+    """Answers frequent git queries for one repository without starting a git process each time.
+
+    Object lookups, attributes and ignore rules go through long lived git processes,
+    and config reads come from a snapshot of git config --list, which has to be invalidated after writing config.
+    """
+
+    def __init__(self, cwd=None):
+        self.cwd = cwd
+        git = pbgit.get_git_executable()
+        self.cat_file = Coprocess([git, "cat-file", "--batch-check"], cwd)
+        self.check_ignore = Coprocess(
+            [git, "check-ignore", "--stdin", "-z", "-v", "-n"], cwd
+        )
+        self.check_attrs = {}
+        self.config = None
+        self.config_task = None
+
+    def close(self):
+        self.cat_file.close()
+        self.check_ignore.close()
+        for coprocess in self.check_attrs.values():
+            coprocess.close()
+
+    def get_object_infos(self, names):
+        """Returns the object id, type and size of each revision or object name, or None for those which do not exist."""
+        names = list(names)
+        # a newline would split the request
+        queries = [name for name in names if "\n" not in name]
+        if not queries:
+            return [None] * len(names)
+        responses = self.cat_file.request([name.encode() for name in queries], b"\n", 1)
+        if responses is None:
+            proc = pbtools.run_with_stdin(
+                [pbgit.get_git_executable(), "cat-file", "--batch-check"],
+                "".join(f"{name}\n" for name in queries),
+            )
+            responses = proc.stdout.split("\n")
+        else:
+            responses = [response[0].decode() for response in responses]
+        infos = {}
+        for name, response in zip(queries, responses):
+            parts = response.split(" ")
+            if len(parts) != 3 or not parts[2].isdigit():
+                # missing or ambiguous, which echo the name back
+                continue
+            oid, object_type, size = parts
+            infos[name] = (oid, object_type, int(size))
+        return [infos.get(name) for name in names]
+
+    def get_object_info(self, name):
+        return self.get_object_infos([name])[0]
+
+    def rev_parse(self, name):
+        info = self.get_object_info(name)
+        return None if info is None else info[0]
+
+    def rev_parse_all(self, names):
+        return [
+            None if info is None else info[0] for info in self.get_object_infos(names)
+        ]
+
+    def check_attr_paths(self, paths, *attrs):
+        """Returns a dict of attribute values for each of the paths, in order.
+
+        Values are git's: "set", "unset", "unspecified" or the assigned value.
+        """
+        paths = list(paths)
+        if not paths:
+            return []
+        coprocess = self.check_attrs.get(attrs)
+        if coprocess is None:
+            coprocess = Coprocess(
+                [pbgit.get_git_executable(), "check-attr", "--stdin", "-z", *attrs],
+                self.cwd,
+            )
+            self.check_attrs[attrs] = coprocess
+        responses = coprocess.request(
+            [encode_path(path) for path in paths], b"\0", 3 * len(attrs)
+        )
+        if responses is None:
+            proc = pbtools.run_with_paths(
+                [pbgit.get_git_executable(), "check-attr", "--stdin", "-z", *attrs],
+                [str(path) for path in paths],
+                cwd=self.cwd,
+            )
+            records = proc.stdout.split("\0")
+            # path, attribute and value, for each attribute of each path
+            step = 3 * len(attrs)
+            if proc.returncode or len(records) < step * len(paths):
+                return [dict.fromkeys(attrs, "unspecified") for _ in paths]
+            return [
+                dict(zip(records[i + 1 : i + step : 3], records[i + 2 : i + step : 3]))
+                for i in range(0, step * len(paths), step)
+            ]
+        return [
+            {
+                response[i + 1].decode(): os.fsdecode(response[i + 2])
+                for i in range(0, len(response), 3)
+            }
+            for response in responses
+        ]
+
+    def check_attr(self, path, *attrs):
+        return self.check_attr_paths([path], *attrs)[0]
+
+    def check_ignore_paths(self, paths):
+        """Returns whether each of the paths is ignored, in order."""
+        paths = list(paths)
+        if not paths:
+            return []
+        responses = self.check_ignore.request(
+            [encode_path(path) for path in paths], b"\0", 4
+        )
+        if responses is None:
+            proc = pbtools.run_with_paths(
+                [pbgit.get_git_executable(), "check-ignore", "--stdin", "-z"],
+                [str(path) for path in paths],
+                cwd=self.cwd,
+            )
+            ignored = set(proc.stdout.split("\0"))
+            return [str(path) in ignored for path in paths]
+        # negated patterns are reported too, but they un-ignore the path
+        return [
+            bool(source) and not pattern.startswith(b"!")
+            for source, line, pattern, _ in responses
+        ]
+
+    def is_ignored(self, path):
+        return self.check_ignore_paths([path])[0]
+
+    def parse_config(self, output):
+        config = {}
+        for record in output.split("\0"):
+            if not record:
+                continue
+            # valueless keys are boolean true
+            key, _, value = record.partition("\n")
+            config.setdefault(pbgitmeta.normalize_config_key(key), []).append(value)
+        return config
+
+    def get_config_cmd(self):
+        return [pbgit.get_git_executable(), "config", "--list", "-z"]
+
+    def read_config_files(self):
+        """Reads the config files directly, which is much cheaper than asking git. Returns None if git has to be asked."""
+        try:
+            git_dir = pbgitmeta.find_git_dir(self.cwd or ".")
+            if git_dir is None:
+                return None
+            return pbgitmeta.read_config(git_dir)
+        except (pbgitmeta.MetadataError, OSError) as e:
+            pblog.debug(f"Reading git config through git: {e}")
+            return None
+
+    def load_config(self):
+        if self.config is None:
+            self.config = self.read_config_files()
+        if self.config is None:
+            proc = pbtools.run_with_output(self.get_config_cmd())
+            self.config = self.parse_config(proc.stdout)
+        return self.config
+
+    async def load_config_async(self):
+        if self.config is None:
+            self.config = self.read_config_files()
+        if self.config is None:
+            if self.config_task is None:
+                self.config_task = asyncio.ensure_future(
+                    pbtools.run_async(self.get_config_cmd(), cwd=self.cwd)
+                )
+            proc = await self.config_task
+            if self.config is None:
+                self.config = self.parse_config(proc.stdout)
+        return self.config
+
+    def invalidate_config(self):
+        self.config = None
+        self.config_task = None
+
+    def get_config_from(self, config, key, default):
+        values = config.get(pbgitmeta.normalize_config_key(key))
+        # the last value wins, like git config --get
+        return values[-1] if values else default
+
+    def get_config(self, key, default=""):
+        return self.get_config_from(self.load_config(), key, default)
+
+    async def get_config_async(self, key, default=""):
+        return self.get_config_from(await self.load_config_async(), key, default)
+
+    def get_config_all(self, key):
+        return list(self.load_config().get(pbgitmeta.normalize_config_key(key), []))
+
+    def rewrite_url(self, config, url):
+        # the longest matching url.<base>.insteadOf prefix is replaced by its base, like git remote get-url
+        best_base = None
+        best_prefix = ""
+        for key, values in config.items():
+            if not key.startswith("url.") or not key.endswith(".insteadof"):
+                continue
+            base = key[len("url.") : -len(".insteadof")]
+            for prefix in values:
+                if url.startswith(prefix) and len(prefix) > len(best_prefix):
+                    best_base = base
+                    best_prefix = prefix
+        if best_base is None:
+            return url
+        return best_base + url[len(best_prefix) :]
+
+    def get_remote_url(self, remote="origin"):
+        config = self.load_config()
+        url = self.get_config_from(config, f"remote.{remote}.url", "")
+        return self.rewrite_url(config, url)
+
+    async def get_remote_url_async(self, remote="origin"):
+        config = await self.load_config_async()
+        url = self.get_config_from(config, f"remote.{remote}.url", "")
+        return self.rewrite_url(config, url)
+
+
+def get_session(cwd=None):
+    key = os.path.abspath(cwd or os.getcwd())
+    session = sessions.get(key)
+    if session is None:
+        session = GitSession(cwd)
+        sessions[key] = session
+    return session
+
+
+def invalidate_config():
+    for session in sessions.values():
+        session.invalidate_config()
+
+
+def close_sessions():
+    """Stops the long lived git processes. They keep pack files open, which blocks repacking on Windows."""
+    for session in sessions.values():
+        session.close()
+
+
+atexit.register(close_sessions)
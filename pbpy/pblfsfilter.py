@@ -0,0 +1,129 @@
+import os
+import re
+
+from pbpy import pbconfig, pbgit, pbgitattributes, pbgitsession, pblog, pbtools
+
+# LFS fetch profiles: the files they exclude stay pointers until they are hydrated
+# profiles are defined in the lfs section of PBSync.xml, and one is selected with lfs in the project section of the user config
+
+# fetches everything again
+full_profile = "full"
+# for hydrating files which the fetch filter leaves out
+no_filter_config = {"lfs.fetchinclude": "", "lfs.fetchexclude": ""}
+
+
+def compile_pattern(pattern):
+    """Compiles a git lfs include or exclude pattern, which also matches everything under the directories it matches."""
+    pattern = pattern.strip().replace("\\", "/").rstrip("/")
+    # patterns without a slash match at any depth
+    prefix = "" if "/" in pattern else pbgitattributes.any_dirs
+    tokens = pbgitattributes.tokenize(pattern.lstrip("/"))
+    return re.compile(f"{prefix}{pbgitattributes.join_tokens(tokens)}(?:/.*)?")
+
+
+def compile_patterns(patterns):
+    regexes = []
+    for pattern in patterns:
+        if not pattern.strip():
+            continue
+        try:
+            regexes.append(compile_pattern(pattern))
+        except pbgitattributes.InvalidPattern:
+            pblog.warning(f"Invalid LFS fetch pattern: {pattern}")
+    return regexes
+
+
+class PathFilter:
+    """Tells which paths git lfs fetches, from include and exclude patterns like lfs.fetchinclude and lfs.fetchexclude."""
+
+    def __init__(self, includes, excludes):
+        self.includes = compile_patterns(includes)
+        self.excludes = compile_patterns(excludes)
+
+    def allows(self, path):
+        path = str(path).replace("\\", "/")
+        if self.includes and not any(regex.fullmatch(path) for regex in self.includes):
+            return False
+        return not any(regex.fullmatch(path) for regex in self.excludes)
+
+
+def split_patterns(value):
+    return [pattern for pattern in value.split(",") if pattern.strip()]
+
+
+def get_fetch_filter():
+    """Returns the filter of the fetch include and exclude config, or None if everything is fetched."""
+    session = pbgitsession.get_session()
+    includes = split_patterns(session.get_config("lfs.fetchinclude"))
+    excludes = split_patterns(session.get_config("lfs.fetchexclude"))
+    if not includes and not excludes:
+        return None
+    return PathFilter(includes, excludes)
+
+
+def filter_fetched(paths):
+    """Returns which of paths the fetch filter lets git lfs download."""
+    fetch_filter = get_fetch_filter()
+    if fetch_filter is None:
+        return list(paths)
+    return [path for path in paths if fetch_filter.allows(path)]
+
+
+def get_profiles():
+    return pbconfig.config.get("lfs_profiles") or {}
+
+
+def get_profile_name():
+    return pbconfig.get_user("project", "lfs", "")
+
+
+def set_config(key, value):
+    session = pbgitsession.get_session()
+    if session.get_config(key) == value:
+        return True
+    git = pbgit.get_git_executable()
+    if value:
+        proc = pbtools.run_with_combined_output([git, "config", key, value])
+    else:
+        proc = pbtools.run_with_combined_output([git, "config", "--unset-all", key])
+        # nothing to unset
+        if proc.returncode == 5:
+            return True
+    pbgitsession.invalidate_config()
+    if proc.returncode:
+        pblog.error(proc.stdout.strip())
+        return False
+    return True
+
+
+def apply_profile():
+    """Sets the fetch include and exclude config of the profile selected in the user config. Does nothing if none is selected."""
+    name = get_profile_name()
+    if not name:
+        return True
+    if name == full_profile:
+        includes, excludes = [], []
+    else:
+        profiles = get_profiles()
+        profile = profiles.get(name)
+        if profile is None:
+            pblog.warning(
+                f"Unknown LFS fetch profile {name}. Available profiles: {', '.join([full_profile, *profiles])}"
+            )
+            return False
+        includes, excludes = profile["include"], profile["exclude"]
+    include_ok = set_config("lfs.fetchinclude", ",".join(includes))
+    exclude_ok = set_config("lfs.fetchexclude", ",".join(excludes))
+    return include_ok and exclude_ok
+
+
+def hydrate(patterns):
+    """Fetches and checks out the LFS files matching patterns which are still pointers, in one parallel batch.
+
+    Returns the files which are still pointers afterwards.
+    """
+    path_filter = PathFilter(patterns, [])
+    if not path_filter.includes:
+        return []
+    files = [file for file in pbgit.get_tracked_files() if path_filter.allows(file)]
+    return pbgit.repair_lfs_pointers(files, os.cpu_count(), hydrate=True)
@@ -0,0 +1,497 @@
+import json
+import os
+import time
+
+import psutil
+
+from pbpy import pbconfig, pbgit, pbgitindex, pbgitmeta, pbgitsession, pblog, pbtools
+
+# runs repository maintenance in a background process at low priority, one task at a time
+# background work holds the repository lock while it runs. a sync takes the lock over:
+# it asks the holder to stop after its current task, and ends the current task if that takes too long
+
+lock_file_name = "repo.lock"
+preempt_file_name = "preempt"
+status_file_name = "maintenance.json"
+# the argument each holder of the lock runs with, to tell it from a process which reused its pid
+owner_args = {
+    "sync": "--sync",
+    "maintenance": "--maintain",
+    "prefetch": "--prefetch",
+    "tune": "--tune",
+}
+# seconds a sync waits for background work to stop on its own
+preempt_timeout = 10
+# seconds maintenance waits for the sync which started it to finish
+lock_timeout = 60 * 60
+history_length = 20
+# how much of the output of a task to keep in the status
+output_length = 2000
+# the planner picks tasks by these limits, and runs them for [maintenance] budget seconds at most
+loose_objects_limit = 100
+incremental_repack_packs = 10
+default_budget = 15 * 60
+# commits git log walks when measuring latency
+log_depth = 5000
+latency_rounds = 2
+
+
+def get_cache_file(name):
+    git_dir = pbtools.get_git_dir()
+    if git_dir is None:
+        return None
+    return git_dir / pbtools.cache_dir_name / name
+
+
+def read_lock():
+    """Returns the pid and owner of the process which holds the repository lock, or None if none does."""
+    path = get_cache_file(lock_file_name)
+    if path is None:
+        return None
+    try:
+        pid, owner = path.read_text().split(" ", 1)
+        pid = int(pid)
+        arg = owner_args.get(owner)
+        # as --sync all or --sync=all
+        if arg is not None and any(
+            part == arg or part.startswith(f"{arg}=")
+            for part in psutil.Process(pid).cmdline()
+        ):
+            return pid, owner
+    except (OSError, ValueError, psutil.Error):
+        pass
+    return None
+
+
+def try_lock(owner):
+    """Takes the repository lock for owner, unless another process holds it."""
+    path = get_cache_file(lock_file_name)
+    if path is None:
+        return True
+    holder = read_lock()
+    if holder is not None:
+        return holder[0] == os.getpid()
+    # the holder exited without releasing it
+    try:
+        stale = path.read_text()
+        # another process may have taken it over in the meantime
+        if read_lock() is None and path.read_text() == stale:
+            path.unlink()
+    except OSError:
+        pass
+    try:
+        path.parent.mkdir(exist_ok=True)
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    except OSError as e:
+        pblog.warning(f"Could not take the repository lock: {e}")
+        return True
+    with os.fdopen(fd, "w") as f:
+        f.write(f"{os.getpid()} {owner}")
+    return True
+
+
+def release_lock():
+    holder = read_lock()
+    if holder is not None and holder[0] == os.getpid():
+        get_cache_file(lock_file_name).unlink(missing_ok=True)
+
+
+def is_preempted():
+    path = get_cache_file(preempt_file_name)
+    return path is not None and path.exists()
+
+
+def kill_children(pid):
+    # the holder sees its task fail, and records that it was preempted
+    try:
+        children = psutil.Process(pid).children(recursive=True)
+    except psutil.Error:
+        return
+    for child in children:
+        try:
+            child.kill()
+        except psutil.Error:
+            pass
+    psutil.wait_procs(children, timeout=5)
+
+
+def preempt():
+    """Takes the repository lock for a sync, and stops background work which holds it.
+
+    Returns False if another sync holds the lock.
+    """
+    preempt_file = get_cache_file(preempt_file_name)
+    deadline = None
+    killed = False
+    while not try_lock("sync"):
+        holder = read_lock()
+        if holder is None:
+            # released in the meantime, or just taken and not written yet
+            time.sleep(0.05)
+            continue
+        pid, owner = holder
+        if owner == "sync":
+            return False
+        if deadline is None:
+            pblog.info(f"Waiting for background {owner} to stop...")
+            preempt_file.touch()
+            deadline = time.monotonic() + preempt_timeout
+        elif time.monotonic() > deadline:
+            if killed:
+                pblog.warning(f"Background {owner} did not stop, ending it")
+                pbtools.kill_process_tree(pid)
+            else:
+                pblog.info(f"Stopping the current task of background {owner}")
+                kill_children(pid)
+                killed = True
+                deadline = time.monotonic() + preempt_timeout
+        time.sleep(0.25)
+    if preempt_file is not None:
+        preempt_file.unlink(missing_ok=True)
+    return True
+
+
+def get_tasks():
+    """Returns the maintenance tasks in order, as (name, command)."""
+    git = pbgit.get_git_executable()
+    tasks = []
+
+    # fill in the git repo optionally
+    try:
+        is_shallow = pbgitmeta.is_shallow()
+    except (pbgitmeta.MetadataError, OSError):
+        is_shallow = (
+            pbtools.get_one_line_output(
+                [git, "rev-parse", "--is-shallow-repository"], cache=True
+            )
+            == "true"
+        )
+    # first, so everything else can clean up after the fetch
+    # partial clones fetch with their filter, so filling in history only adds commits and trees
+    if is_shallow:
+        pblog.info(
+            "Shallow clone detected. PBSync will fill in history in the background."
+        )
+        tasks.append(("fetch", [git, "fetch", "--unshallow"]))
+    else:
+        # repo was already fetched in UpdateProject for the current branch
+        current_branch = pbgit.get_current_branch_name()
+        configured_branches = pbconfig.get("branches") or []
+        branches = [
+            branch for branch in configured_branches if branch != current_branch
+        ]
+        tasks.append(("fetch", [git, "fetch", "--no-tags", "origin", *branches]))
+
+    does_maintainence = (
+        pbgitsession.get_session().get_config("maintenance.prefetch.schedule")
+        == "hourly"
+    )
+    if not does_maintainence:
+        tasks.append(("register", ["scalar", "register", "."]))
+
+    tasks.append(("lfs-prune", [pbgit.get_lfs_executable(), "prune", "-fc"]))
+    return tasks
+
+
+def read_status():
+    path = get_cache_file(status_file_name)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (TypeError, OSError, ValueError):
+        return {"tasks": [], "history": []}
+
+
+def write_status(status):
+    path = get_cache_file(status_file_name)
+    if path is None:
+        return
+    try:
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        pblog.debug(f"Could not write {path}: {e}")
+
+
+def start():
+    """Runs maintenance in the background. It waits for the sync to finish first."""
+    pbtools.run_non_blocking_ex(pbtools.get_launch_cmd("--maintain", "run"))
+
+
+def get_budget():
+    try:
+        return int(pbconfig.get_user("maintenance", "budget", default_budget))
+    except ValueError:
+        pblog.warning("Invalid maintenance budget, using the default")
+        return default_budget
+
+
+def get_mtime(path):
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return None
+
+
+def count_loose_objects(objects_dir):
+    # like git gc --auto, estimated from one of the 256 fan out directories
+    try:
+        with os.scandir(objects_dir / "17") as it:
+            return sum(1 for entry in it if entry.is_file()) * 256
+    except OSError:
+        return 0
+
+
+def inspect():
+    """Returns the state of the object store and the index which git performance depends on."""
+    objects_dir = pbgit.get_common_dir() / "objects"
+    pack_dir = objects_dir / "pack"
+    pack_stats = [pack.stat() for pack in pack_dir.glob("pack-*.pack")]
+    newest_pack = max((st.st_mtime for st in pack_stats), default=0)
+    commit_graph = get_mtime(objects_dir / "info" / "commit-graph") or get_mtime(
+        objects_dir / "info" / "commit-graphs" / "commit-graph-chain"
+    )
+    midx = get_mtime(pack_dir / "multi-pack-index")
+    try:
+        index_version = pbgitindex.read_index_version()
+    except (pbgitmeta.MetadataError, OSError) as e:
+        pblog.debug(f"Could not read the index version: {e}")
+        index_version = None
+    return {
+        "packs": len(pack_stats),
+        "pack_size": sum(st.st_size for st in pack_stats),
+        "loose_objects": count_loose_objects(objects_dir),
+        # objects fetched since they were written are not covered
+        "commit_graph": commit_graph is not None,
+        "commit_graph_stale": commit_graph is None or commit_graph < newest_pack,
+        "multi_pack_index": midx is not None,
+        "multi_pack_index_stale": midx is None or midx < newest_pack,
+        "index_version": index_version,
+        # --tune measured which version is faster in this clone
+        "tuned_index_version": pbgit.read_tuned_config().get("index.version"),
+    }
+
+
+def plan(health):
+    """Returns the tasks which the repository needs by health, as (name, command)."""
+    git = pbgit.get_git_executable()
+    tasks = []
+    packs = health["packs"]
+    # packs the loose objects first, which adds a pack for the next tasks to cover
+    if health["loose_objects"] > loose_objects_limit:
+        tasks.append(
+            ("loose-objects", [git, "maintenance", "run", "--task=loose-objects"])
+        )
+        packs += 1
+    if packs > incremental_repack_packs:
+        # writes the multi-pack-index too
+        tasks.append(
+            (
+                "incremental-repack",
+                [git, "maintenance", "run", "--task=incremental-repack"],
+            )
+        )
+    elif packs > 1 and (packs != health["packs"] or health["multi_pack_index_stale"]):
+        tasks.append(("multi-pack-index", [git, "multi-pack-index", "write"]))
+    if health["commit_graph_stale"]:
+        tasks.append(
+            (
+                "commit-graph",
+                [
+                    git,
+                    "commit-graph",
+                    "write",
+                    "--split",
+                    "--reachable",
+                    "--changed-paths",
+                ],
+            )
+        )
+    if health["index_version"] not in (None, 4) and not health.get(
+        "tuned_index_version"
+    ):
+        # paths are prefix compressed, which makes the index of a large tree much smaller
+        tasks.append(("index-version", [git, "update-index", "--index-version", "4"]))
+    return tasks
+
+
+def measure_latency():
+    """Returns how long git status and git log take in seconds, the best of a few rounds."""
+    git = pbgit.get_git_executable()
+    commands = {
+        "status": [git, "--no-optional-locks", "status", "--porcelain"],
+        "log": [git, "log", "--format=%H", f"-{log_depth}"],
+    }
+    latency = {}
+    for name, cmd in commands.items():
+        times = []
+        for _ in range(latency_rounds):
+            start = time.perf_counter()
+            pbtools.run_with_output(cmd)
+            times.append(time.perf_counter() - start)
+        latency[name] = min(times)
+    return latency
+
+
+def format_latency(latency):
+    before, after = latency["before"], latency["after"]
+    return ", ".join(
+        f"git {name}: {before[name] * 1000:.0f}ms -> {after[name] * 1000:.0f}ms"
+        for name in before
+    )
+
+
+def log_health(health):
+    pblog.info(
+        f"{health['packs']} packs ({health['pack_size'] / 1024 / 1024:.1f} MiB), about {health['loose_objects']} loose objects"
+    )
+    pblog.info(
+        f"commit-graph: {'stale' if health['commit_graph_stale'] else 'current'}, multi-pack-index: {'stale' if health['multi_pack_index_stale'] else 'current'}, index version: {health['index_version']}"
+    )
+
+
+def print_plan():
+    health = inspect()
+    log_health(health)
+    tasks = plan(health)
+    if not tasks:
+        pblog.info("The repository needs no maintenance")
+    for name, cmd in tasks:
+        pblog.info(f"{name}: {' '.join(cmd[1:])}")
+    return True
+
+
+def run_plan(status):
+    """Runs the tasks the repository needs within the time budget, and records the latency before and after."""
+    health = inspect()
+    status["health"] = health
+    tasks = [
+        {"name": name, "cmd": cmd, "status": "pending"} for name, cmd in plan(health)
+    ]
+    if not tasks:
+        pblog.info("The repository needs no maintenance")
+        return
+    before = measure_latency()
+    status["tasks"].extend(tasks)
+    write_status(status)
+    run_tasks(status, tasks, time.monotonic() + get_budget())
+    after = measure_latency()
+    status["latency"] = {"before": before, "after": after}
+    pblog.info(format_latency(status["latency"]))
+
+
+def wait_for_lock():
+    deadline = time.monotonic() + lock_timeout
+    while not try_lock("maintenance"):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(5)
+    return True
+
+
+def run_tasks(status, tasks, deadline=None):
+    for task in tasks:
+        if is_preempted():
+            task["status"] = "preempted"
+            continue
+        # a task is not started without time for it, but the one that is running is left to finish
+        if deadline is not None and time.monotonic() > deadline:
+            task["status"] = "skipped"
+            continue
+        task["status"] = "running"
+        task["started"] = time.time()
+        write_status(status)
+        pblog.info(f"Running maintenance task {task['name']}")
+        proc = pbtools.run_with_combined_output(task["cmd"])
+        task["finished"] = time.time()
+        task["returncode"] = proc.returncode
+        task["output"] = (proc.stdout or "")[-output_length:]
+        if proc.returncode == 0:
+            task["status"] = "succeeded"
+        elif is_preempted():
+            task["status"] = "preempted"
+        else:
+            task["status"] = "failed"
+        write_status(status)
+        # long lived git processes keep pack files open, which would block gc on Windows
+        pbgitsession.close_sessions()
+
+
+def run():
+    """Runs the maintenance tasks one at a time at low priority, holding the repository lock."""
+    pbtools.lower_priority()
+    status = read_status()
+    status["pid"] = os.getpid()
+    status["started"] = time.time()
+    status["finished"] = None
+    status["health"] = None
+    status["latency"] = None
+    status["tasks"] = [
+        {"name": name, "cmd": cmd, "status": "pending"} for name, cmd in get_tasks()
+    ]
+    write_status(status)
+    if not wait_for_lock():
+        pblog.warning("The repository stayed locked, skipping maintenance")
+        for task in status["tasks"]:
+            task["status"] = "skipped"
+    else:
+        try:
+            run_tasks(status, status["tasks"])
+            if not is_preempted():
+                run_plan(status)
+        finally:
+            release_lock()
+    status["finished"] = time.time()
+    status.setdefault("history", []).append(
+        {
+            "started": status["started"],
+            "finished": status["finished"],
+            "tasks": {task["name"]: task["status"] for task in status["tasks"]},
+            "latency": status.get("latency"),
+        }
+    )
+    status["history"] = status["history"][-history_length:]
+    write_status(status)
+    return not any(task["status"] == "failed" for task in status["tasks"])
+
+
+def format_time(timestamp):
+    if not timestamp:
+        return "-"
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+
+def print_status():
+    status = read_status()
+    holder = read_lock()
+    if holder is not None:
+        pblog.info(f"The repository is locked by {holder[1]} ({holder[0]})")
+    if not status["tasks"]:
+        pblog.info("Maintenance has not run yet")
+        return True
+    running = holder is not None and holder[1] == "maintenance"
+    pblog.info(f"Last maintenance started at {format_time(status.get('started'))}")
+    for task in status["tasks"]:
+        task_status = task["status"]
+        # ended along with its process
+        if task_status == "running" and not running:
+            task_status = "interrupted"
+        pblog.info(f"{task['name']}: {task_status}")
+        if task_status == "failed":
+            pblog.info(task.get("output", "").strip())
+    if status.get("latency"):
+        pblog.info(format_latency(status["latency"]))
+    history = status.get("history", [])
+    for run in reversed(history):
+        if run["started"] == status.get("started"):
+            continue
+        tasks = ", ".join(f"{name}: {value}" for name, value in run["tasks"].items())
+        pblog.info(f"{format_time(run['started'])} {tasks}")
+        if run.get("latency"):
+            pblog.info(format_latency(run["latency"]))
+    return True
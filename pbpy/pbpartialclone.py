@@ -0,0 +1,215 @@
+import os
+
+from pbpy import pbgit, pbgitmeta, pbgitsession, pblog, pbprefetch, pbtools
+
+# converts existing clones into blobless partial clones, which keep the commits and trees of the whole history,
+# but only the file contents that are checked out or not pushed yet. git fetches the rest from origin when it needs them
+
+partial_clone_filter = "blob:none"
+# for git fetch --refetch
+min_git_version = (2, 36)
+# the files of a pack, next to its .pack
+pack_extensions = (".idx", ".rev", ".bitmap", ".mtimes", ".pack")
+
+
+def is_partial_clone():
+    session = pbgitsession.get_session()
+    return pbgitmeta.is_true(
+        session.get_config("remote.origin.promisor", "false")
+    ) or bool(session.get_config("extensions.partialclone"))
+
+
+def get_dir_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                # removed while walking
+                pass
+    return size
+
+
+def measure():
+    """Returns the size of the git directory in bytes, split into git objects, LFS objects and everything else."""
+    common_dir = pbgit.get_common_dir().resolve()
+    lfs_dir = pbgit.get_lfs_storage_dir().resolve()
+    objects = get_dir_size(common_dir / "objects")
+    lfs = get_dir_size(lfs_dir)
+    other = get_dir_size(common_dir) - objects
+    # lfs.storage may point outside of the git directory
+    if lfs_dir.is_relative_to(common_dir):
+        other -= lfs
+    return {"objects": objects, "lfs": lfs, "other": other}
+
+
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            break
+        size /= 1024
+    return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+
+
+def log_sizes(sizes, before=None):
+    for name, size in sizes.items():
+        msg = f"{name}: {format_size(size)}"
+        if before is not None:
+            msg = f"{name}: {format_size(before[name])} -> {format_size(size)}"
+        pblog.info(msg)
+    total = sum(sizes.values())
+    if before is None:
+        pblog.info(f"total: {format_size(total)}")
+    else:
+        pblog.info(
+            f"total: {format_size(sum(before.values()))} -> {format_size(total)}"
+        )
+
+
+def print_size():
+    pblog.info(f"Size of {pbgit.get_common_dir()}:")
+    log_sizes(measure())
+    if is_partial_clone():
+        pblog.info("This is a partial clone")
+    return True
+
+
+def get_full_packs(pack_dir):
+    """Returns the packs which may hold blobs that origin can fill in again."""
+    packs = []
+    for pack in pack_dir.glob("pack-*.pack"):
+        # kept packs stay, and promisor packs came from origin with the filter already
+        if pack.with_suffix(".keep").exists() or pack.with_suffix(".promisor").exists():
+            continue
+        packs.append(pack)
+    return packs
+
+
+def remove_pack(pack):
+    # the index goes first, so git never finds an index without its pack
+    for extension in pack_extensions:
+        pack.with_suffix(extension).unlink(missing_ok=True)
+
+
+def pack_local_objects(pack_dir):
+    """Packs the objects which origin does not have or are checked out: unpushed commits, stashes, and the contents of the index."""
+    git = pbgit.get_git_executable()
+    objects = pbtools.iter_output(
+        [
+            git,
+            "rev-list",
+            "--objects",
+            "--all",
+            "--reflog",
+            "--indexed-objects",
+            "--exclude-promisor-objects",
+        ],
+        sep="\n",
+    )
+    lines = [line for line in objects if line]
+    if objects.returncode:
+        pblog.error(f"Could not list local objects: {objects.error}")
+        return False
+    if not lines:
+        return True
+    proc = pbtools.run_with_stdin(
+        [git, "pack-objects", "-q", str(pack_dir / "pack")], "\n".join(lines) + "\n"
+    )
+    if proc.returncode:
+        pblog.error(f"Could not pack local objects: {proc.stderr.strip()}")
+        return False
+    return True
+
+
+def convert():
+    """Converts this clone into a blobless partial clone in place, and reports how much smaller .git got."""
+    if is_partial_clone():
+        pblog.info("Already a partial clone")
+        return print_size()
+    if pbgit.get_git_version_tuple() < min_git_version:
+        pblog.error(
+            f"Converting to a partial clone needs git {'.'.join(map(str, min_git_version))} or newer"
+        )
+        return False
+    if pbprefetch.get_running_pid() is not None:
+        pblog.error(
+            "Prefetch is running in the background. Stop it with --prefetch unregister, and try again"
+        )
+        return False
+
+    before = measure()
+    pack_dir = pbgit.get_common_dir() / "objects" / "pack"
+    full_packs = get_full_packs(pack_dir)
+    # long lived git processes keep the packs open, so they could not be removed on Windows
+    pbgitsession.close_sessions()
+
+    pblog.info("Fetching the history without file contents. It may take a while...")
+    # registers origin as the promisor remote, and fetches everything again as a fresh partial clone would
+    proc = pbtools.run(
+        [
+            pbgit.get_git_executable(),
+            "fetch",
+            "--refetch",
+            f"--filter={partial_clone_filter}",
+            "--no-auto-maintenance",
+            "origin",
+        ]
+    )
+    pbgitsession.invalidate_config()
+    if proc.returncode or not is_partial_clone():
+        pblog.error("Could not fetch from origin as a partial clone")
+        return False
+
+    if not pack_local_objects(pack_dir):
+        # nothing is removed, so the clone just keeps its full history for now
+        return False
+    for pack in full_packs:
+        remove_pack(pack)
+    # it indexes the removed packs, git maintenance writes it again
+    for midx in pack_dir.glob("multi-pack-index*"):
+        midx.unlink(missing_ok=True)
+    pbtools.run([pbgit.get_git_executable(), "prune-packed", "-q"])
+
+    pblog.success("Converted to a partial clone. Size of .git:")
+    log_sizes(measure(), before)
+    return True
+
+
+def fetch_blobs(ref, files):
+    """Fetches the blobs of files at ref from the promisor remote in one go.
+
+    git would fetch them one at a time when git lfs reads the pointers, so this does nothing outside of partial clones.
+    """
+    if not files or not is_partial_clone():
+        return True
+    git = pbgit.get_git_executable()
+    oids = []
+    for proc in pbtools.run_batched([git, "ls-tree", "-z", ref, "--"], files):
+        for record in proc.stdout.split("\0"):
+            # <mode> SP <type> SP <object> TAB <file>
+            info = record.split("\t", 1)[0].split(" ")
+            if len(info) == 3 and info[1] == "blob":
+                oids.append(info[2])
+    if not oids:
+        return True
+    # like git's own lazy fetch, which already knows exactly which objects it wants
+    proc = pbtools.run_with_stdin(
+        [
+            git,
+            "-c",
+            "fetch.negotiationAlgorithm=noop",
+            "fetch",
+            "origin",
+            "--no-tags",
+            "--no-write-fetch-head",
+            "--recurse-submodules=no",
+            f"--filter={partial_clone_filter}",
+            "--stdin",
+        ],
+        "\n".join(oids) + "\n",
+    )
+    if proc.returncode:
+        pblog.warning(f"Could not fetch blobs from origin: {proc.stderr.strip()}")
+        return False
+    return True
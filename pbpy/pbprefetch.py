@@ -0,0 +1,174 @@
+import os
+import subprocess
+import time
+
+import psutil
+
+from pbpy import pbconfig, pbgit, pbgitsession, pblog, pbmaintenance, pbtools
+
+# fetches upcoming changes in the background, so a sync only has to fast forward and check out locally
+# settings live in the [prefetch] section of the user config
+
+default_interval = 30 * 60
+# git lfs has no bandwidth limit, so fewer transfers at once leave room for everything else
+default_transfers = 1
+pid_file_name = "prefetch.pid"
+task_name_prefix = "PBSync Prefetch"
+
+
+def get_interval():
+    try:
+        return max(60, int(pbconfig.get_user("prefetch", "interval", default_interval)))
+    except ValueError:
+        pblog.warning("Invalid prefetch interval, using the default")
+        return default_interval
+
+
+def get_env():
+    transfers = pbconfig.get_user("prefetch", "transfers", str(default_transfers))
+    return pbtools.get_config_env({"lfs.concurrenttransfers": transfers})
+
+
+def get_pid_file():
+    git_dir = pbtools.get_git_dir()
+    if git_dir is None:
+        return None
+    return git_dir / pbtools.cache_dir_name / pid_file_name
+
+
+def get_running_pid():
+    path = get_pid_file()
+    if path is None:
+        return None
+    try:
+        pid = int(path.read_text())
+        # the pid may have been reused by another program since
+        if "--prefetch" in psutil.Process(pid).cmdline():
+            return pid
+    except (OSError, ValueError, psutil.Error):
+        pass
+    return None
+
+
+def claim_pid_file():
+    path = get_pid_file()
+    if path is None:
+        return False
+    pid = get_running_pid()
+    if pid is not None and pid != os.getpid():
+        return False
+    try:
+        path.parent.mkdir(exist_ok=True)
+        path.write_text(str(os.getpid()))
+    except OSError as e:
+        pblog.warning(f"Could not write {path}: {e}")
+    return True
+
+
+def get_launch_cmd():
+    return pbtools.get_launch_cmd("--prefetch", "daemon")
+
+
+def prefetch():
+    """Fetches the configured branches, and the LFS objects of the files the current branch is about to change."""
+    # a sync holds the lock from start to end, since fetching at the same time would fail on the locks of the refs for one of them
+    # it takes the lock over from a running prefetch, and running maintenance is left to finish
+    if not pbmaintenance.try_lock("prefetch"):
+        pblog.info("Skipping prefetch while the repository is locked")
+        return True
+    try:
+        return fetch_upcoming()
+    finally:
+        pbmaintenance.release_lock()
+
+
+def fetch_upcoming():
+    env = get_env()
+    git = pbgit.get_git_executable()
+    branches = pbconfig.get("branches")
+    proc = pbtools.run_with_combined_output(
+        [git, "fetch", "--no-tags", "origin", *branches], env=env
+    )
+    if proc.returncode:
+        pblog.warning(f"Prefetch could not fetch origin: {proc.stdout.strip()}")
+        return False
+    branch_name = pbgit.get_current_branch_name()
+    if branch_name in branches:
+        files = pbtools.get_incoming_lfs_files(branch_name)
+        if files:
+            pblog.info(f"Prefetching {len(files)} LFS files from origin/{branch_name}")
+            procs = pbtools.do_lfs_fetch(files, processes=1, env=env)
+            if any(proc.returncode for proc in procs):
+                pblog.warning("Prefetch could not fetch all LFS objects")
+                return False
+    return True
+
+
+def run_daemon():
+    if not claim_pid_file():
+        pblog.info("Prefetch is already running")
+        return
+    pbtools.lower_priority()
+    interval = get_interval()
+    pblog.info(f"Prefetching every {interval}s")
+    while True:
+        start = time.monotonic()
+        prefetch()
+        # the long lived git processes keep pack files open, which would block gc on Windows
+        pbgitsession.close_sessions()
+        time.sleep(max(0, interval - (time.monotonic() - start)))
+
+
+def run_once():
+    pbtools.lower_priority()
+    return prefetch()
+
+
+def start_daemon():
+    """Starts the prefetch daemon in the background, unless it is already running."""
+    if get_running_pid() is not None:
+        return
+    pbtools.run_non_blocking_ex(get_launch_cmd())
+
+
+def get_task_name():
+    return f"{task_name_prefix} {os.path.basename(os.getcwd())}"
+
+
+def register():
+    """Starts the prefetch daemon at login."""
+    if os.name != "nt":
+        pblog.error(
+            f"Registering for login is only supported on Windows. Start {subprocess.list2cmdline(get_launch_cmd())} from your session startup instead."
+        )
+        return False
+    proc = pbtools.run_with_combined_output(
+        [
+            "schtasks",
+            "/create",
+            "/f",
+            "/sc",
+            "onlogon",
+            "/tn",
+            get_task_name(),
+            "/tr",
+            subprocess.list2cmdline(get_launch_cmd()),
+        ]
+    )
+    if proc.returncode:
+        pblog.error(proc.stdout)
+        return False
+    start_daemon()
+    return True
+
+
+def unregister():
+    if os.name != "nt":
+        return True
+    proc = pbtools.run_with_combined_output(
+        ["schtasks", "/delete", "/f", "/tn", get_task_name()]
+    )
+    pid = get_running_pid()
+    if pid is not None:
+        pbtools.kill_process_tree(pid)
+    return proc.returncode == 0
@@ -0,0 +1,122 @@
+from pbpy import pbconfig, pbgit, pbgitindex, pbgitmeta, pbgitsession, pblog, pbtools
+
+# role based sparse checkouts: profiles are defined in the sparse section of PBSync.xml,
+# and one is selected with sparse in the project section of the user config
+
+# checks out everything again
+full_profile = "full"
+
+
+def get_profiles():
+    return pbconfig.config.get("sparse_profiles") or {}
+
+
+def get_profile_name():
+    return pbconfig.get_user("project", "sparse", "")
+
+
+def normalize_dir(dir):
+    return dir.replace("\\", "/").strip("/")
+
+
+def get_cone():
+    """Returns the directories of the cone mode sparse checkout, or None if the whole tree is checked out."""
+    session = pbgitsession.get_session()
+    if not pbgitmeta.is_true(session.get_config("core.sparsecheckout", "false")):
+        return None
+    # without cone mode, any pattern can be excluded, and everything which exists has to be looked at
+    if not pbgitmeta.is_true(session.get_config("core.sparsecheckoutcone", "false")):
+        return None
+    try:
+        return pbgitmeta.read_sparse_checkout_cone()
+    except (pbgitmeta.MetadataError, OSError) as e:
+        pblog.debug(f"Listing the sparse checkout through git: {e}")
+    proc = pbtools.run_with_output(
+        [pbgit.get_git_executable(), "sparse-checkout", "list"]
+    )
+    if proc.returncode:
+        return None
+    return [line for line in proc.stdout.splitlines() if line]
+
+
+def get_cone_parents(cone):
+    return {parent for dir in cone for parent in pbgitindex.get_parent_dirs(dir)}
+
+
+def filter_checked_out(paths, cone=None):
+    """Returns which of paths a cone mode sparse checkout includes: files in the root, under one of its directories, or directly in one of their parents."""
+    if cone is None:
+        cone = get_cone()
+    if cone is None:
+        return list(paths)
+    cone = set(cone)
+    # the root is the parent of top level directories
+    cone_parents = get_cone_parents(cone) | {""}
+    checked_out = []
+    for path in paths:
+        dir = str(path).replace("\\", "/").rpartition("/")[0]
+        if dir in cone_parents or dir in cone or pbgitindex.is_under(dir, cone):
+            checked_out.append(path)
+    return checked_out
+
+
+def split_scan_dirs(dirs, cone):
+    """Narrows dirs down to what a sparse checkout includes.
+
+    Returns the directories to scan recursively, and those where only the files directly inside are checked out.
+    """
+    if cone is None:
+        return list(dirs), []
+    cone = set(cone)
+    cone_parents = get_cone_parents(cone)
+    recursive = set()
+    shallow = set()
+    for dir in dirs:
+        if dir in cone or pbgitindex.is_under(dir, cone):
+            recursive.add(dir)
+            continue
+        prefix = f"{dir}/"
+        recursive.update(path for path in cone if path.startswith(prefix))
+        shallow.update(
+            path for path in cone_parents if path == dir or path.startswith(prefix)
+        )
+    return sorted(recursive), sorted(shallow)
+
+
+def apply_profile():
+    """Makes the sparse checkout match the profile selected in the user config.
+
+    Does nothing if no profile is selected, or if it is already applied. git only adds and removes the directories which changed.
+    """
+    name = get_profile_name()
+    if not name:
+        return True
+    git = pbgit.get_git_executable()
+    cone = get_cone()
+    if name == full_profile:
+        if cone is None:
+            return True
+        pblog.info("Leaving sparse checkout, and checking out the whole tree")
+        proc = pbtools.run_with_combined_output([git, "sparse-checkout", "disable"])
+    else:
+        profiles = get_profiles()
+        dirs = profiles.get(name)
+        if dirs is None:
+            pblog.warning(
+                f"Unknown sparse checkout profile {name}. Available profiles: {', '.join([full_profile, *profiles])}"
+            )
+            return False
+        dirs = sorted({normalize_dir(dir) for dir in dirs})
+        if cone is not None and sorted(cone) == dirs:
+            return True
+        pblog.info(f"Applying sparse checkout profile {name}: {', '.join(dirs)}")
+        # the sparse index only keeps the directories which are not checked out as single entries
+        proc = pbtools.run_with_stdin(
+            [git, "sparse-checkout", "set", "--cone", "--sparse-index", "--stdin"],
+            "".join(f"{dir}\n" for dir in dirs),
+        )
+    pbgitsession.invalidate_config()
+    if proc.returncode:
+        pblog.error(f"{proc.stdout}{proc.stderr or ''}".strip())
+        return False
+    return True
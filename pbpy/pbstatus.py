@@ -0,0 +1,223 @@
+import threading
+from collections import namedtuple
+
+from pbpy import pbgit, pbgitmeta, pblog, pbtools
+
+# one git status scan per run, shared by everything that needs it
+# it is only taken again once PBSync changed the tree itself, which invalidate() marks, or HEAD, the index or refs changed
+# changes made outside of PBSync during the run are not picked up
+
+# ahead and behind are None without an upstream
+Branch = namedtuple("Branch", ["oid", "head", "upstream", "ahead", "behind"])
+# kind is 1 for changes, 2 for renames and copies, u for unmerged, ? for untracked and ! for ignored files
+# orig_path is the source of a rename or copy, and score its similarity, like R100
+Entry = namedtuple("Entry", ["kind", "xy", "path", "orig_path", "score"])
+
+# each mode reports everything the ones before it do
+untracked_modes = ("no", "normal", "all")
+
+lock = threading.Lock()
+snapshots = []
+snapshots_fingerprint = None
+
+
+def matches(path, pathspecs):
+    # pathspecs are literal, a file or a directory with everything below it
+    return not pathspecs or any(
+        path == pathspec or path.startswith(f"{pathspec}/") for pathspec in pathspecs
+    )
+
+
+class Status:
+    """A parsed git status --porcelain=2 --branch -z scan."""
+
+    def __init__(self, branch, entries, untracked, pathspecs):
+        self.branch = branch
+        self.entries = entries
+        self.untracked = untracked
+        self.pathspecs = pathspecs
+
+    def covers(self, untracked, pathspecs):
+        if untracked_modes.index(self.untracked) < untracked_modes.index(untracked):
+            return False
+        # a scan of the whole tree, or of directories holding everything asked for
+        return not self.pathspecs or (
+            bool(pathspecs)
+            and all(matches(pathspec, self.pathspecs) for pathspec in pathspecs)
+        )
+
+    def narrow(self, untracked, pathspecs):
+        """Returns the part of this scan that git status would report for untracked and pathspecs."""
+        if untracked == self.untracked and pathspecs == self.pathspecs:
+            return self
+        entries = [
+            entry
+            for entry in self.entries
+            if matches(entry.path, pathspecs)
+            and (entry.kind != "?" or untracked != "no")
+        ]
+        return Status(self.branch, entries, untracked, pathspecs)
+
+    @property
+    def changed(self):
+        return [entry for entry in self.entries if entry.kind in "12u"]
+
+    @property
+    def untracked_files(self):
+        return [entry.path for entry in self.entries if entry.kind == "?"]
+
+    @property
+    def unmerged(self):
+        return [entry.path for entry in self.entries if entry.kind == "u"]
+
+    def get_changed_paths(self, orig_paths=False):
+        """Returns the paths of the tracked changes, and with orig_paths also the sources of renames and copies."""
+        paths = []
+        for entry in self.changed:
+            paths.append(entry.path)
+            if orig_paths and entry.orig_path is not None:
+                paths.append(entry.orig_path)
+        return paths
+
+
+def parse_ab(value):
+    ahead, behind = value.split(" ")
+    return int(ahead), -int(behind)
+
+
+def parse(records):
+    """Parses the records of git status --porcelain=2 --branch -z into the branch and the entries."""
+    headers = {}
+    entries = []
+    records = iter(records)
+    for record in records:
+        kind = record[:1]
+        if kind == "#":
+            key, _, value = record[2:].partition(" ")
+            headers[key] = value
+        elif kind == "1":
+            # 1 <XY> <sub> <mH> <mI> <mW> <hH> <hI> <path>
+            fields = record.split(" ", 8)
+            entries.append(Entry(kind, fields[1], fields[8], None, None))
+        elif kind == "2":
+            # 2 <XY> <sub> <mH> <mI> <mW> <hH> <hI> <X><score> <path>, then the source path as its own record
+            fields = record.split(" ", 9)
+            orig_path = next(records, None)
+            entries.append(Entry(kind, fields[1], fields[9], orig_path, fields[8]))
+        elif kind == "u":
+            # u <XY> <sub> <m1> <m2> <m3> <mW> <h1> <h2> <h3> <path>
+            fields = record.split(" ", 10)
+            entries.append(Entry(kind, fields[1], fields[10], None, None))
+        elif kind in "?!" and record:
+            entries.append(Entry(kind, kind * 2, record[2:], None, None))
+    ahead, behind = None, None
+    if "branch.ab" in headers:
+        ahead, behind = parse_ab(headers["branch.ab"])
+    branch = Branch(
+        headers.get("branch.oid"),
+        headers.get("branch.head"),
+        headers.get("branch.upstream"),
+        ahead,
+        behind,
+    )
+    return branch, entries
+
+
+def get_cmd(untracked, pathspecs):
+    return [
+        pbgit.get_git_executable(),
+        # the scan would refresh the index otherwise, which changes the fingerprint
+        "--no-optional-locks",
+        "--literal-pathspecs",
+        "status",
+        "--porcelain=2",
+        "--branch",
+        "-z",
+        f"--untracked-files={untracked}",
+        "--",
+        *pathspecs,
+    ]
+
+
+def get_fingerprint():
+    git_dir = pbtools.get_git_dir()
+    if git_dir is None:
+        return None
+    try:
+        return pbtools.get_repo_fingerprint(git_dir)
+    except (pbgitmeta.MetadataError, OSError):
+        return None
+
+
+def normalize_pathspecs(pathspecs):
+    return tuple(
+        sorted({str(pathspec).replace("\\", "/").rstrip("/") for pathspec in pathspecs})
+    )
+
+
+def find_snapshot(untracked, pathspecs):
+    global snapshots_fingerprint
+    fingerprint = get_fingerprint()
+    if fingerprint is None or fingerprint != snapshots_fingerprint:
+        snapshots.clear()
+        snapshots_fingerprint = fingerprint
+    for snapshot in snapshots:
+        if snapshot.covers(untracked, pathspecs):
+            return snapshot.narrow(untracked, pathspecs)
+    return None
+
+
+def add_snapshot(status, fingerprint):
+    global snapshots_fingerprint
+    # the tree may have changed while git was scanning it
+    if fingerprint is None or fingerprint != get_fingerprint():
+        return
+    if fingerprint != snapshots_fingerprint:
+        snapshots.clear()
+        snapshots_fingerprint = fingerprint
+    snapshots.append(status)
+
+
+def get_status(untracked="no", pathspecs=()):
+    """Returns the status of the tree, limited to the literal pathspecs, or None if git failed.
+
+    untracked is no, normal or all, like git status --untracked-files.
+    """
+    pathspecs = normalize_pathspecs(pathspecs)
+    with lock:
+        status = find_snapshot(untracked, pathspecs)
+        if status is not None:
+            return status
+        fingerprint = get_fingerprint()
+        records = pbtools.iter_output(get_cmd(untracked, pathspecs))
+        branch, entries = parse(records)
+        if records.returncode:
+            pblog.warning(f"git status failed: {records.error}")
+            return None
+        status = Status(branch, entries, untracked, pathspecs)
+        add_snapshot(status, fingerprint)
+        return status
+
+
+async def get_status_async(untracked="no", pathspecs=()):
+    pathspecs = normalize_pathspecs(pathspecs)
+    with lock:
+        status = find_snapshot(untracked, pathspecs)
+    if status is not None:
+        return status
+    fingerprint = get_fingerprint()
+    proc = await pbtools.run_async(get_cmd(untracked, pathspecs))
+    if proc.returncode:
+        pblog.warning(f"git status failed: {proc.stderr.strip()}")
+        return None
+    branch, entries = parse(proc.stdout.split("\0"))
+    status = Status(branch, entries, untracked, pathspecs)
+    with lock:
+        add_snapshot(status, fingerprint)
+    return status
+
+
+def invalidate():
+    """Drops the snapshots, for after PBSync changed the tree in ways which the fingerprint does not show."""
+    with lock:
+        snapshots.clear()
@@ -130,7 +130,14 @@ def publish_build(
         script_path = (Path() / app_script.format(branch_type)).resolve()
         build_cmd = base_steamcmd_command.copy()
         build_cmd.extend(["+run_app_build", script_path, "+quit"])
-        proc = pbtools.run_stream(build_cmd, logfunc=steam_log)
+        proc = pbtools.retry_on_timeout(
+            lambda: pbtools.run_stream(
+                build_cmd,
+                logfunc=steam_log,
+                idle_timeout=pbtools.get_timeout("steamcmd_idle"),
+            ),
+            "steamcmd build upload",
+        )
         result = proc.returncode
 
         if drm_exe_path and drm_exe_path.is_file():
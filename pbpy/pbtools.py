@@ -1,21 +1,44 @@
+import asyncio
+import contextlib
+import contextvars
 import hashlib
 import json
+import locale
 import math
-import multiprocessing
 import os
+import shlex
 import shutil
 import stat
 import subprocess
 import sys
+import tempfile
 import threading
 import time
+from functools import lru_cache
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from subprocess import CalledProcessError
 
 import psutil
 
 # PBSync Imports
-from pbpy import pbconfig, pbgit, pblog, pbuac, pbunreal
+from pbpy import (
+    pbconfig,
+    pbconflicts,
+    pbgit,
+    pbgitindex,
+    pbgitmeta,
+    pbgitsession,
+    pblog,
+    pbmaintenance,
+    pbpartialclone,
+    pbprefetch,
+    pbsparse,
+    pbstatus,
+    pbtrace,
+    pbuac,
+    pbunreal,
+)
 
 error_file = ".pbsync_err"
 
@@ -27,53 +50,407 @@ def handle_env(env):
         return os.environ | env
 
 
-def handle_env_out(cmd, env_out):
-    if env_out:
-        for env_var in env_out:
+def make_env_file(env_out):
+    if not env_out:
+        return None
+    fd, env_file = tempfile.mkstemp(prefix="pbsync_env_")
+    os.close(fd)
+    return env_file
+
+
+def handle_env_out(cmd, env_out, env_file):
+    """Appends commands which save the env_out variables to env_file, once cmd succeeds."""
+    if os.name == "posix":
+        # NUL separated, skipping unset variables
+        records = " ".join(f'${{{var}+"{var}=${var}"}}' for var in env_out)
+        capture = ["&&", "printf", "'%s\\0'", records, ">", shlex.quote(env_file)]
+    else:
+        # set also lists variables which only start with the name, these are filtered out when reading
+        capture = ["&&", "("]
+        for var in env_out:
+            if len(capture) > 2:
+                capture.append("&")
+            capture.extend(["set", var])
+        capture.extend([")", "2>nul", ">", env_file])
+    if isinstance(cmd, str):
+        return f"{cmd} {subprocess.list2cmdline(capture) if os.name == 'nt' else ' '.join(capture)}"
+    cmd.extend(capture)
+    return cmd
+
+
+def apply_env_file(env_file, env_out):
+    """Sets the variables saved in env_file in our environment, and removes the file."""
+    if env_file is None:
+        return
+    try:
+        with open(env_file, "rb") as f:
+            saved = f.read()
+    except OSError:
+        return
+    finally:
+        remove_file(env_file)
+    if os.name == "posix":
+        records = os.fsdecode(saved).split("\0")
+    else:
+        records = decode_output(saved).splitlines()
+    for record in records:
+        k, sep, v = record.partition("=")
+        if sep and k in env_out:
+            os.environ[k] = v
+
+
+@lru_cache()
+def resolve_executable(program):
+    # CreateProcess only appends .exe, so resolve .cmd/.bat wrappers through PATHEXT like the shell would
+    if os.name != "nt" or os.path.splitext(program)[1]:
+        return program
+    resolved = shutil.which(program)
+    return resolved if resolved else program
+
+
+def handle_shell(cmd, env_out=None, shell=None, env_file=None):
+    if shell is None:
+        # argv lists are executed directly, command lines and env_out capture need a shell
+        shell = isinstance(cmd, str) or env_file is not None
+    if isinstance(cmd, list):
+        cmd = [str(arg) for arg in cmd]
+        if shell:
+            if env_file is not None:
+                handle_env_out(cmd, env_out, env_file)
             if os.name == "posix":
-                cmd.extend(["&&", "echo", f"{env_var}=${env_var}"])
-            else:
-                cmd.extend(["&&", "set", env_var])
+                cmd = " ".join(cmd)
+        elif cmd:
+            cmd[0] = resolve_executable(cmd[0])
+    elif env_file is not None:
+        cmd = handle_env_out(cmd, env_out, env_file)
+    return cmd, shell
+
+
+timeout_returncode = 124
+timeout_retries = 2
+
+# timeouts in seconds, which can be overridden in the [timeouts] section of the user config
+default_timeouts = {
+    # for the whole command
+    "release_download": 30 * 60,
+    "lfs_fetch": 60 * 60,
+    # for a command which did not output anything
+    "longtail_idle": 10 * 60,
+    "dispatch_idle": 30 * 60,
+    "steamcmd_idle": 30 * 60,
+    # for a whole phase of the sync, disabled by default
+    "pull_phase": None,
+    "binaries_phase": None,
+    "engine_phase": None,
+}
+
+phase_deadline = contextvars.ContextVar("phase_deadline", default=None)
+
+
+class TimedOut(subprocess.CompletedProcess):
+    """The result of a command which was killed for running past its deadline."""
 
+    timed_out = True
 
-def parse_environment(stdout, env_out):
-    if env_out is None:
+    def __init__(self, args, timeout, stdout=None, stderr=None, idle=False):
+        super().__init__(args, timeout_returncode, stdout, stderr)
+        self.timeout = timeout
+        self.idle = idle
+
+
+def is_timed_out(proc):
+    return getattr(proc, "timed_out", False)
+
+
+def get_timeout(name):
+    value = pbconfig.get_user("timeouts", name)
+    if value is None:
+        return default_timeouts.get(name)
+    try:
+        value = float(value)
+    except ValueError:
+        pblog.warning(f"Invalid timeout for {name}: {value}")
+        return default_timeouts.get(name)
+    # 0 disables the timeout
+    return value if value > 0 else None
+
+
+def get_timeout_retries():
+    return pbconfig.get_user_config().getint(
+        "timeouts", "retries", fallback=timeout_retries
+    )
+
+
+def retry_on_timeout(func, description, cleanup=None):
+    """Calls func again while its result timed out, up to the configured number of retries."""
+    retries = get_timeout_retries()
+    attempt = 0
+    while True:
+        proc = func()
+        if not is_timed_out(proc) or attempt >= retries:
+            return proc
+        attempt += 1
+        pblog.warning(f"{description} timed out. Retrying ({attempt}/{retries})...")
+        if cleanup is not None:
+            cleanup()
+
+
+@contextlib.contextmanager
+def phase_timeout(seconds):
+    """Limits the commands run inside the block to the time remaining in the phase."""
+    if seconds is None:
+        yield
         return
-    for line in stdout.splitlines():
-        # if not a valid line for environment echo, skip it
-        if line.startswith("?") or line.startswith("Environment variable "):
-            continue
-        k, _, v = line.partition("=")
-        # v is empty if no partition (not a key=value) or no value set (key=)
-        # must check to see if we actually requested this key
-        # then, check if this was a set variable in posix
-        if v and k in env_out and not v.startswith("$"):
-            os.environ[k] = v.strip('"')
+    deadline = time.monotonic() + seconds
+    outer_deadline = phase_deadline.get()
+    if outer_deadline is not None:
+        deadline = min(deadline, outer_deadline)
+    token = phase_deadline.set(deadline)
+    try:
+        yield
+    finally:
+        phase_deadline.reset(token)
 
 
-def run(cmd, env=None, cwd=None):
-    if os.name == "posix":
-        cmd = " ".join(cmd) if isinstance(cmd, list) else cmd
+def get_effective_timeout(timeout):
+    deadline = phase_deadline.get()
+    if deadline is None:
+        return timeout
+    remaining = max(deadline - time.monotonic(), 0)
+    return remaining if timeout is None else min(timeout, remaining)
 
-    env = handle_env(env)
-    return subprocess.run(cmd, shell=True, env=env, cwd=cwd)
+
+def kill_process_tree(pid):
+    try:
+        parent = psutil.Process(pid)
+        procs = parent.children(recursive=True)
+    except psutil.Error:
+        return
+    procs.append(parent)
+    for proc in procs:
+        try:
+            proc.kill()
+        except psutil.Error:
+            pass
+    psutil.wait_procs(procs, timeout=5)
 
 
-def run_with_output(cmd, env=None, env_out=None):
-    handle_env_out(cmd, env_out)
-    if os.name == "posix":
-        cmd = " ".join(cmd) if isinstance(cmd, list) else cmd
+def describe_cmd(cmd):
+    if isinstance(cmd, list):
+        cmd = " ".join(cmd)
+    return cmd if len(cmd) <= 200 else f"{cmd[:197]}..."
+
+
+def log_timeout(cmd, timeout, idle=False):
+    reason = " without output" if idle else ""
+    pblog.error(f"Killed after {timeout:g}s{reason}: {describe_cmd(cmd)}")
+
+
+def trace_output(span, stdout, stderr):
+    pbtrace.add_output(span, stdout)
+    pbtrace.add_output(span, stderr)
 
+
+def run_process(
+    cmd, shell, input=None, capture_output=False, timeout=None, text=None, **kwargs
+):
+    timeout = get_effective_timeout(timeout)
+    empty = None
+    if capture_output:
+        kwargs["stdout"] = subprocess.PIPE
+        kwargs["stderr"] = subprocess.PIPE
+    if kwargs.get("stdout") is not None:
+        empty = "" if text else b""
+    if timeout is not None and timeout <= 0:
+        log_timeout(cmd, 0)
+        return TimedOut(cmd, 0, empty, empty)
+    if input is not None:
+        kwargs["stdin"] = subprocess.PIPE
+    try:
+        proc = subprocess.Popen(cmd, shell=shell, text=text, **kwargs)
+    except OSError as e:
+        # report a missing executable like the shell would, instead of raising
+        pbtrace.end(pbtrace.begin(cmd, None), 127)
+        if empty is None:
+            pblog.error(str(e))
+            return subprocess.CompletedProcess(cmd, 127)
+        return subprocess.CompletedProcess(cmd, 127, empty, str(e))
+    span = pbtrace.begin(cmd, proc.pid)
+    try:
+        stdout, stderr = proc.communicate(input, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process_tree(proc.pid)
+        try:
+            stdout, stderr = proc.communicate(timeout=5)
+        except subprocess.TimeoutExpired:
+            # something outside of the tree is holding on to our pipes
+            stdout, stderr = empty, empty
+        log_timeout(cmd, timeout)
+        trace_output(span, stdout, stderr)
+        pbtrace.end(span, timeout_returncode, timed_out=True)
+        return TimedOut(cmd, timeout, stdout, stderr)
+    except BaseException:
+        # cancelled, don't leave the tree running behind us
+        kill_process_tree(proc.pid)
+        pbtrace.end(span, None)
+        raise
+    trace_output(span, stdout, stderr)
+    pbtrace.end(span, proc.returncode)
+    return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+
+def run(cmd, env=None, cwd=None, shell=None, timeout=None, env_out=None):
+    env_file = make_env_file(env_out)
+    cmd, shell = handle_shell(cmd, env_out, shell, env_file)
     env = handle_env(env)
-    proc = subprocess.run(cmd, capture_output=True, text=True, shell=True, env=env)
-    parse_environment(proc.stdout, env_out)
+    try:
+        return run_process(cmd, shell, env=env, cwd=cwd, timeout=timeout)
+    finally:
+        apply_env_file(env_file, env_out)
+
+
+cache_dir_name = "pbsync-cache"
+
+
+def get_git_dir():
+    try:
+        return pbgitmeta.find_git_dir()
+    except pbgitmeta.MetadataError:
+        return None
+
+
+def get_repo_fingerprint(git_dir):
+    """Hashes the repository state which read-only git commands depend on."""
+    fingerprint = hashlib.sha1()
+    try:
+        fingerprint.update((git_dir / "HEAD").read_bytes())
+    except OSError:
+        pass
+    common_dir = pbgitmeta.get_common_dir(git_dir)
+    paths = [
+        common_dir / "packed-refs",
+        git_dir / "index",
+        common_dir / "shallow",
+        Path(".gitattributes"),
+    ]
+    # loose refs are replaced by renaming, which updates the modification time of their directory
+    for root, _, _ in os.walk(common_dir / "refs"):
+        paths.append(Path(root))
+    for path in paths:
+        try:
+            st = path.stat()
+            fingerprint.update(f"{path}:{st.st_mtime_ns}:{st.st_size}\n".encode())
+        except OSError:
+            fingerprint.update(f"{path}:\n".encode())
+    return fingerprint.hexdigest()
+
+
+def get_cache_path(git_dir, cmd, combined):
+    key = "\0".join([os.getcwd(), str(combined), *[str(arg) for arg in cmd]])
+    return git_dir / cache_dir_name / hashlib.sha1(key.encode()).hexdigest()
+
+
+def read_cached_output(cmd, combined, cache):
+    """Returns where cmd is cached, the repository fingerprint, and the stored result if it is still valid."""
+    git_dir = get_git_dir()
+    if git_dir is None:
+        return None, None, None
+    cache_path = get_cache_path(git_dir, cmd, combined)
+    fingerprint = get_repo_fingerprint(git_dir)
+    try:
+        with open(cache_path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return cache_path, fingerprint, None
+    if entry.get("fingerprint") != fingerprint:
+        return cache_path, fingerprint, None
+    # a number is a lifetime in seconds, for results which also depend on something outside of the repo
+    if cache is not True and time.time() - entry.get("time", 0) > cache:
+        return cache_path, fingerprint, None
+    proc = subprocess.CompletedProcess(cmd, 0, entry["stdout"], entry["stderr"])
+    return cache_path, fingerprint, proc
+
+
+def write_cached_output(cache_path, fingerprint, proc):
+    # failures may be temporary, so only successful results are kept
+    if cache_path is None or proc.returncode != 0:
+        return
+    entry = {
+        "fingerprint": fingerprint,
+        "time": time.time(),
+        "stdout": proc.stdout,
+        "stderr": proc.stderr,
+    }
+    try:
+        cache_path.parent.mkdir(exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        pblog.debug(f"Could not write {cache_path}: {e}")
+
+
+def clear_cached_output(cmd, combined=False):
+    git_dir = get_git_dir()
+    if git_dir is None:
+        return
+    try:
+        os.remove(get_cache_path(git_dir, cmd, combined))
+    except OSError:
+        pass
+
+
+def run_cached(cmd, combined, cache, func):
+    if not cache:
+        return func()
+    cache_path, fingerprint, proc = read_cached_output(cmd, combined, cache)
+    if proc is not None:
+        return proc
+    proc = func()
+    write_cached_output(cache_path, fingerprint, proc)
     return proc
 
 
+def run_with_output(cmd, env=None, env_out=None, shell=None, timeout=None, cache=None):
+    """Runs cmd, and captures its output.
+
+    Read-only git commands can pass cache=True to reuse the output of an earlier run until the repository changes,
+    or a number of seconds for results which also depend on something else, like the LFS server.
+    Commands which look at the working tree, like status, should not be cached.
+    """
+    if cache:
+        return run_cached(
+            cmd,
+            False,
+            cache,
+            lambda: run_with_output(
+                cmd, env=env, env_out=env_out, shell=shell, timeout=timeout
+            ),
+        )
+    env_file = make_env_file(env_out)
+    cmd, shell = handle_shell(cmd, env_out, shell, env_file)
+    env = handle_env(env)
+    try:
+        return run_process(
+            cmd, shell, capture_output=True, text=True, env=env, timeout=timeout
+        )
+    finally:
+        apply_env_file(env_file, env_out)
+
+
 def default_stream_log(msg):
     pblog.info(msg)
 
 
+def default_stream_batch_log(lines):
+    pblog.info("\n".join(lines))
+
+
+def default_stream_progress(msg):
+    print(msg, end="\r", flush=True)
+
+
 def checked_stream_log(msg, error="error", warning="warning"):
     if error in msg:
         pblog.error(msg)
@@ -83,6 +460,26 @@ def checked_stream_log(msg, error="error", warning="warning"):
         pblog.info(msg)
 
 
+def checked_stream_batch_log(lines, error="error", warning="warning"):
+    # log consecutive lines of the same level as one record
+    group = []
+    group_log = None
+    for line in lines:
+        if error in line:
+            log = pblog.error
+        elif warning in line:
+            log = pblog.warning
+        else:
+            log = pblog.info
+        if log is not group_log and group:
+            group_log("\n".join(group))
+            group = []
+        group_log = log
+        group.append(line)
+    if group:
+        group_log("\n".join(group))
+
+
 def raised_stream_log(msg, error="error", warning="warning"):
     if error in msg:
         pblog.error(msg)
@@ -102,72 +499,297 @@ def progress_stream_log(msg, error="error", warning="warning"):
         print(f"{msg}", end="\r", flush=True)
 
 
-def run_stream(cmd, env=None, logfunc=None, cwd=None):
-    if logfunc is None:
-        logfunc = default_stream_log
+stream_read_size = 64 * 1024
+stream_max_record = 1024 * 1024
+# the end of stderr kept for error when it is not combined with stdout
+stream_max_error = 64 * 1024
 
-    startupinfo = None
 
-    if os.name == "posix":
-        cmd = " ".join(cmd) if isinstance(cmd, list) else cmd
-    elif os.name == "nt":
-        startupinfo = subprocess.STARTUPINFO(dwFlags=subprocess.CREATE_NEW_CONSOLE)
+class ProcessStream:
+    """Reads the output of a process as it arrives, split into records by sep.
 
-    env = handle_env(env)
-    proc = subprocess.Popen(
+    Output is read in blocking chunks of at most stream_read_size, and nothing is read ahead of the consumer,
+    so a slow consumer stalls the child on a full pipe instead of buffering without bounds.
+    When splitting lines, carriage return progress updates are reported separately from the lines.
+    returncode is set once the output has been consumed, and error along with it if the process failed.
+    Without combined, stderr is read on the side, and only its end is kept for error.
+    The process tree is killed if it runs past timeout, or if it outputs nothing for idle_timeout.
+    The env_out variables are saved to a side file by the shell, and set in our environment once the process exits.
+    """
+
+    def __init__(
+        self,
         cmd,
-        text=True,
-        shell=True,
-        bufsize=1,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        env=env,
-        cwd=cwd,
-        startupinfo=startupinfo,
-        encoding="utf8",
-    )
-    returncode = None
-    while True:
+        env=None,
+        cwd=None,
+        shell=None,
+        sep="\n",
+        combined=True,
+        timeout=None,
+        idle_timeout=None,
+        env_out=None,
+        progress=None,
+    ):
+        self.sep = sep.encode()
+        self.progress = sep == "\n" if progress is None else progress
+        self.returncode = None
+        self.timed_out = False
+        self.idle = False
+        self.timeout = get_effective_timeout(timeout)
+        self.idle_timeout = idle_timeout
+        self.last_output = time.monotonic()
+        self.done = threading.Event()
+        startupinfo = None
+
+        self.env_out = env_out
+        self.env_file = make_env_file(env_out)
+        cmd, shell = handle_shell(cmd, env_out, shell, self.env_file)
+        if os.name == "nt":
+            startupinfo = subprocess.STARTUPINFO(dwFlags=subprocess.CREATE_NEW_CONSOLE)
+
+        self.args = cmd
+        self.error = None
+        self.stderr_tail = b""
+        self.stderr_thread = None
         try:
-            for line in iter(lambda: proc.stdout.readline(), ""):
-                logfunc(line)
-        except:
-            continue
-        returncode = proc.poll()
-        if returncode is not None:
-            break
-    return proc
-
+            self.proc = subprocess.Popen(
+                cmd,
+                shell=shell,
+                bufsize=0,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT if combined else subprocess.PIPE,
+                env=handle_env(env),
+                cwd=cwd,
+                startupinfo=startupinfo,
+            )
+        except OSError as e:
+            self.proc = None
+            self.error = str(e)
+            self.returncode = 127
+            pbtrace.end(pbtrace.begin(cmd, None), 127)
+            apply_env_file(self.env_file, env_out)
+            return
+        self.span = pbtrace.begin(cmd, self.proc.pid)
+        if not combined:
+            self.stderr_thread = threading.Thread(target=self.read_stderr, daemon=True)
+            self.stderr_thread.start()
+        if self.timeout is not None or self.idle_timeout is not None:
+            threading.Thread(target=self.watchdog, daemon=True).start()
+
+    def read_stderr(self):
+        # drained alongside stdout, so a chatty child never blocks on a full stderr pipe
+        fd = self.proc.stderr.fileno()
+        try:
+            while chunk := os.read(fd, stream_read_size):
+                self.stderr_tail = (self.stderr_tail + chunk)[-stream_max_error:]
+        finally:
+            self.proc.stderr.close()
+
+    def watchdog(self):
+        start = self.last_output
+        while True:
+            now = time.monotonic()
+            remaining = []
+            if self.timeout is not None:
+                remaining.append((start + self.timeout - now, False))
+            if self.idle_timeout is not None:
+                remaining.append((self.last_output + self.idle_timeout - now, True))
+            wait, idle = min(remaining)
+            if wait <= 0:
+                break
+            if self.done.wait(min(wait, 1.0)):
+                return
+        self.timed_out = True
+        self.idle = idle
+        log_timeout(self.args, self.idle_timeout if idle else self.timeout, idle)
+        kill_process_tree(self.proc.pid)
 
-def run_with_stdin(cmd, input, env=None, env_out=None):
-    handle_env_out(cmd, env_out)
-    if os.name == "posix":
-        cmd = " ".join(cmd) if isinstance(cmd, list) else cmd
+    def decode(self, record):
+        return record.decode("utf8", errors="replace")
 
-    env = handle_env(env)
-    proc = subprocess.run(
-        cmd, input=input, capture_output=True, text=True, shell=True, env=env
-    )
-    parse_environment(proc.stdout, env_out)
-    return proc
+    def chunks(self):
+        """Yields a list of complete records and the latest progress update (or None) for every read."""
+        if self.proc is None:
+            return
+        fd = self.proc.stdout.fileno()
+        pending = b""
+        try:
+            while True:
+                chunk = os.read(fd, stream_read_size)
+                if not chunk:
+                    break
+                self.last_output = time.monotonic()
+                pbtrace.add_output(self.span, chunk)
+                data = pending + chunk
+                held = b""
+                if self.progress:
+                    # a trailing CR may be the first half of a CRLF
+                    if data.endswith(b"\r"):
+                        held = b"\r"
+                        data = data[:-1]
+                    data = data.replace(b"\r\n", b"\n")
+                records = data.split(self.sep)
+                pending = records.pop()
+                progress = None
+                if self.progress:
+                    # only the last carriage return segment of a line is what ends up on screen
+                    records = [record.rpartition(b"\r")[2] for record in records]
+                    if b"\r" in pending:
+                        update, _, pending = pending.rpartition(b"\r")
+                        progress = self.decode(update.rpartition(b"\r")[2])
+                pending += held
+                if len(pending) > stream_max_record:
+                    records.append(pending)
+                    pending = b""
+                if records or progress:
+                    yield [self.decode(record) for record in records], progress
+            if self.progress:
+                pending = pending.rstrip(b"\r").rpartition(b"\r")[2]
+            if pending:
+                yield [self.decode(pending)], None
+        except BaseException:
+            # cancelled, don't leave the tree running behind us
+            kill_process_tree(self.proc.pid)
+            raise
+        finally:
+            self.done.set()
+            self.proc.stdout.close()
+            self.returncode = self.proc.wait()
+            if self.timed_out:
+                self.returncode = timeout_returncode
+            if self.stderr_thread is not None:
+                # children which outlive the process may hold stderr open
+                self.stderr_thread.join(1)
+                if self.returncode and self.error is None:
+                    self.error = (
+                        self.decode(self.stderr_tail).strip()
+                        or f"exited with code {self.returncode}"
+                    )
+            pbtrace.end(self.span, self.returncode, self.timed_out)
+            apply_env_file(self.env_file, self.env_out)
+
+    def __iter__(self):
+        for records, _ in self.chunks():
+            yield from records
+
+
+def run_stream(
+    cmd,
+    env=None,
+    logfunc=None,
+    cwd=None,
+    shell=None,
+    batchfunc=None,
+    progressfunc=None,
+    timeout=None,
+    idle_timeout=None,
+    env_out=None,
+):
+    """Runs cmd, handing its output to the callbacks while it runs.
+
+    batchfunc receives the list of lines from each read, logfunc receives the lines one by one,
+    and progressfunc receives the latest carriage return progress update of each read.
+    Without callbacks, output is logged in batches and progress is shown on the console.
+    """
+    if batchfunc is None:
+        if logfunc is None:
+            batchfunc = default_stream_batch_log
+        else:
 
+            def batchfunc(lines):
+                for line in lines:
+                    logfunc(line)
 
-def run_with_combined_output(cmd, env=None, env_out=None):
-    handle_env_out(cmd, env_out)
-    if os.name == "posix":
-        cmd = " ".join(cmd) if isinstance(cmd, list) else cmd
+    if progressfunc is None:
+        progressfunc = default_stream_progress if logfunc is None else logfunc
 
-    env = handle_env(env)
-    proc = subprocess.run(
+    stream = ProcessStream(
         cmd,
-        text=True,
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
         env=env,
+        cwd=cwd,
+        shell=shell,
+        timeout=timeout,
+        idle_timeout=idle_timeout,
+        env_out=env_out,
+    )
+    if stream.error is not None:
+        batchfunc([stream.error])
+    for lines, progress in stream.chunks():
+        if lines:
+            batchfunc(lines)
+        if progress:
+            progressfunc(progress)
+    return stream
+
+
+def iter_output(
+    cmd, sep="\0", env=None, cwd=None, shell=None, timeout=None, idle_timeout=None
+):
+    """Runs cmd, and returns an iterator over the records of its stdout as they arrive.
+
+    Only one read worth of output is held at a time, so this suits large listings like git's -z output.
+    returncode and error are set on the returned stream once it is exhausted.
+    Stopping the iteration early kills the process.
+    """
+    return ProcessStream(
+        cmd,
+        env=env,
+        cwd=cwd,
+        shell=shell,
+        sep=sep,
+        combined=False,
+        timeout=timeout,
+        idle_timeout=idle_timeout,
+        progress=False,
     )
-    parse_environment(proc.stdout, env_out)
-    return proc
+
+
+def run_with_stdin(cmd, input, env=None, env_out=None, shell=None, timeout=None):
+    env_file = make_env_file(env_out)
+    cmd, shell = handle_shell(cmd, env_out, shell, env_file)
+    env = handle_env(env)
+    try:
+        return run_process(
+            cmd,
+            shell,
+            input=input,
+            capture_output=True,
+            text=True,
+            env=env,
+            timeout=timeout,
+        )
+    finally:
+        apply_env_file(env_file, env_out)
+
+
+def run_with_combined_output(
+    cmd, env=None, env_out=None, shell=None, timeout=None, cache=None
+):
+    if cache:
+        return run_cached(
+            cmd,
+            True,
+            cache,
+            lambda: run_with_combined_output(
+                cmd, env=env, env_out=env_out, shell=shell, timeout=timeout
+            ),
+        )
+    env_file = make_env_file(env_out)
+    cmd, shell = handle_shell(cmd, env_out, shell, env_file)
+    env = handle_env(env)
+    try:
+        return run_process(
+            cmd,
+            shell,
+            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+            timeout=timeout,
+        )
+    finally:
+        apply_env_file(env_file, env_out)
 
 
 def run_non_blocking(*commands):
@@ -196,38 +818,125 @@ def run_non_blocking(*commands):
 
 
 def run_non_blocking_ex(cmd, env=None):
-    if os.name == "posix":
-        cmd.insert("nohup", 0)
-        cmd = " ".join(cmd) if isinstance(cmd, list) else cmd
+    # a new session already detaches the child from our terminal, so nohup is not needed
+    cmd, shell = handle_shell(cmd)
+    env = handle_env(env)
+    try:
+        if os.name == "nt":
+            subprocess.Popen(
+                cmd,
+                shell=shell,
+                env=env,
+                creationflags=subprocess.DETACHED_PROCESS
+                | subprocess.CREATE_NEW_PROCESS_GROUP,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        elif os.name == "posix":
+            subprocess.Popen(
+                cmd,
+                shell=shell,
+                env=env,
+                start_new_session=True,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+    except OSError as e:
+        pblog.error(str(e))
+
+
+def get_combined_output(
+    cmd, env=None, env_out=None, shell=None, timeout=None, cache=None
+):
+    return run_with_combined_output(
+        cmd, env=env, env_out=env_out, shell=shell, timeout=timeout, cache=cache
+    ).stdout
+
+
+def get_one_line_output(
+    cmd, env=None, env_out=None, shell=None, timeout=None, cache=None
+):
+    return run_with_output(
+        cmd, env=env, env_out=env_out, shell=shell, timeout=timeout, cache=cache
+    ).stdout.rstrip()
+
 
+def decode_output(output):
+    if output is None:
+        return None
+    encoding = locale.getpreferredencoding(False)
+    return output.decode(encoding, errors="replace").replace("\r\n", "\n")
+
+
+async def run_async(
+    cmd, env=None, cwd=None, input=None, combined=False, shell=None, timeout=None
+):
+    cmd, shell = handle_shell(cmd, shell=shell)
     env = handle_env(env)
-    if os.name == "nt":
-        subprocess.Popen(
-            cmd,
-            shell=True,
-            creationflags=subprocess.DETACHED_PROCESS
-            | subprocess.CREATE_NEW_PROCESS_GROUP,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-    elif os.name == "posix":
-        subprocess.Popen(
-            cmd,
-            shell=True,
-            start_new_session=True,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+    stderr = asyncio.subprocess.STDOUT if combined else asyncio.subprocess.PIPE
+    kwargs = dict(
+        stdin=asyncio.subprocess.PIPE if input is not None else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=stderr,
+        env=env,
+        cwd=cwd,
+    )
+    try:
+        if shell:
+            cmdline = subprocess.list2cmdline(cmd) if isinstance(cmd, list) else cmd
+            proc = await asyncio.create_subprocess_shell(cmdline, **kwargs)
+        else:
+            proc = await asyncio.create_subprocess_exec(*cmd, **kwargs)
+    except OSError as e:
+        pbtrace.end(pbtrace.begin(cmd, None), 127)
+        return subprocess.CompletedProcess(cmd, 127, "", None if combined else str(e))
+    span = pbtrace.begin(cmd, proc.pid)
+    timeout = get_effective_timeout(timeout)
+    try:
+        stdout, stderr = await asyncio.wait_for(
+            proc.communicate(
+                input.encode(locale.getpreferredencoding(False))
+                if input is not None
+                else None
+            ),
+            timeout,
         )
+    except asyncio.TimeoutError:
+        kill_process_tree(proc.pid)
+        await proc.wait()
+        log_timeout(cmd, timeout)
+        pbtrace.end(span, timeout_returncode, timed_out=True)
+        return TimedOut(cmd, timeout, "", None if combined else "")
+    except BaseException:
+        kill_process_tree(proc.pid)
+        pbtrace.end(span, None)
+        raise
+    trace_output(span, stdout, stderr)
+    pbtrace.end(span, proc.returncode)
+    return subprocess.CompletedProcess(
+        cmd, proc.returncode, decode_output(stdout), decode_output(stderr)
+    )
+
+
+async def get_one_line_output_async(cmd, env=None, shell=None):
+    proc = await run_async(cmd, env=env, shell=shell)
+    return proc.stdout.rstrip()
+
 
+async def get_combined_output_async(cmd, env=None, shell=None):
+    proc = await run_async(cmd, env=env, combined=True, shell=shell)
+    return proc.stdout
 
-def get_combined_output(cmd, env=None, env_out=None):
-    return run_with_combined_output(cmd, env=env, env_out=env_out).stdout
 
+def gather(*aws):
+    """Runs the awaitables concurrently, and returns their results in the order they were passed."""
 
-def get_one_line_output(cmd, env=None, env_out=None):
-    return run_with_output(cmd, env=env, env_out=env_out).stdout.rstrip()
+    async def gather_all():
+        return await asyncio.gather(*aws)
+
+    return asyncio.run(gather_all())
 
 
 def it_has_any(it, *args):
@@ -247,14 +956,13 @@ def whereis(app):
 
     try:
         result = subprocess.run(
-            f"{command} {app}",
+            [command, app],
             text=True,
-            shell=True,
             check=True,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         ).stdout
-    except CalledProcessError:
+    except (CalledProcessError, OSError):
         pass
 
     if result is None:
@@ -436,6 +1144,155 @@ def chunks(lst, n):
         yield lst[i : i + n]
 
 
+# room left for environment changes and launcher overhead when sizing batches
+cmdline_headroom = 4096
+# Linux rejects any single argument longer than MAX_ARG_STRLEN
+max_arg_bytes = 128 * 1024 - 1
+
+
+def get_arg_length(arg):
+    if os.name == "nt":
+        # UTF-16 code units, plus quotes and a separating space
+        return len(arg.encode("utf-16-le")) // 2 + 3
+    # bytes, plus the terminator and the argv pointer
+    return len(os.fsencode(arg)) + 1 + 8
+
+
+@lru_cache()
+def get_max_cmdline_length():
+    if os.name == "nt":
+        # CreateProcess limit
+        return 32767 - cmdline_headroom
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (ValueError, OSError):
+        arg_max = 128 * 1024
+    # the environment shares the same space as the arguments
+    env_length = sum(get_arg_length(f"{k}={v}") for k, v in os.environ.items())
+    return max(arg_max - env_length - cmdline_headroom, 4096)
+
+
+def batch_args(cmd, args, sep=None, max_count=None):
+    """Splits args into batches that fit on a command line after cmd.
+
+    With sep, each batch is joined into a single argument, which is kept under the single argument limit too.
+    A batch holds at most max_count args, so work can be spread over several processes.
+    """
+    budget = get_max_cmdline_length() - sum(get_arg_length(str(arg)) for arg in cmd)
+    if sep is not None:
+        if os.name != "nt":
+            budget = min(budget, max_arg_bytes)
+        # joined args only pay for the separator, not for being a separate argument
+        overhead = get_arg_length("")
+        sep_length = get_arg_length(sep) - overhead
+    batch = []
+    length = 0
+    for arg in args:
+        arg_length = get_arg_length(arg)
+        if sep is not None:
+            arg_length += sep_length - overhead
+        full = max_count is not None and len(batch) >= max_count
+        if batch and (full or length + arg_length > budget):
+            yield batch if sep is None else [sep.join(batch)]
+            batch = []
+            length = 0
+        batch.append(arg)
+        length += arg_length
+    if batch:
+        yield batch if sep is None else [sep.join(batch)]
+
+
+def run_batched(
+    cmd, args, sep=None, max_count=None, processes=1, runner=None, **kwargs
+):
+    """Runs cmd once for every batch of args that fits on a command line, and returns the results in order.
+
+    Batches run concurrently on up to processes threads, so only use that when the batches do not contend.
+    runner defaults to run_with_combined_output, and receives kwargs.
+    """
+    if runner is None:
+        runner = run_with_combined_output
+    cmds = [cmd + batch for batch in batch_args(cmd, args, sep, max_count)]
+    if processes <= 1 or len(cmds) <= 1:
+        return [runner(batch_cmd, **kwargs) for batch_cmd in cmds]
+    # carry over phase timeouts into the worker threads
+    context = contextvars.copy_context()
+    with ThreadPool(min(processes, len(cmds))) as pool:
+        return pool.map(
+            lambda batch_cmd: context.copy().run(runner, batch_cmd, **kwargs), cmds
+        )
+
+
+def run_with_paths(cmd, paths, env=None, cwd=None, timeout=None):
+    """Runs cmd with paths written to its stdin, NUL separated.
+
+    For commands which read paths with --stdin -z, or --pathspec-from-file=- --pathspec-file-nul,
+    so that any number of paths takes a single process.
+    """
+    cmd, shell = handle_shell(cmd, shell=False)
+    proc = run_process(
+        cmd,
+        shell,
+        input="\0".join(paths).encode("utf-8"),
+        capture_output=True,
+        env=handle_env(env),
+        cwd=cwd,
+        timeout=timeout,
+    )
+    return subprocess.CompletedProcess(
+        proc.args,
+        proc.returncode,
+        decode_output(proc.stdout),
+        decode_output(proc.stderr),
+    )
+
+
+def get_spawn_benchmark_commands():
+    git = pbgit.get_git_executable()
+    # roughly the mix of short queries a full sync spawns, weighted by how often they run
+    return [
+        ([git, "--version"], 1),
+        ([pbgit.get_lfs_executable(), "--version"], 1),
+        ([git, "config", "--get", "credential.helper"], 2),
+        ([git, "config", "user.name"], 1),
+        ([git, "config", "user.email"], 1),
+        ([git, "remote", "get-url", "origin"], 2),
+        ([git, "branch", "--show-current"], 4),
+        ([git, "rev-parse", "--is-shallow-repository"], 1),
+        ([git, "config", "maintenance.prefetch.schedule"], 1),
+        ([git, "ls-files", "--", "Plugins"], 1),
+    ]
+
+
+def benchmark_spawn(rounds=5):
+    commands = get_spawn_benchmark_commands()
+    calls = sum(weight for _, weight in commands)
+    pblog.info(f"Benchmarking {calls} subprocess calls per sync over {rounds} rounds")
+
+    def measure(shell):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for cmd, weight in commands:
+                for _ in range(weight):
+                    run_with_output(cmd, shell=shell)
+        return (time.perf_counter() - start) / rounds
+
+    # warm up the file system cache and executable lookup before measuring
+    measure(False)
+    shell_time = measure(True)
+    direct_time = measure(False)
+    saved = shell_time - direct_time
+    pblog.info(
+        f"Shell: {shell_time * 1000:.1f}ms per sync ({shell_time * 1000 / calls:.2f}ms per call)"
+    )
+    pblog.info(
+        f"Direct: {direct_time * 1000:.1f}ms per sync ({direct_time * 1000 / calls:.2f}ms per call)"
+    )
+    pblog.info(
+        f"Saved: {saved * 1000:.1f}ms per sync ({saved * 100 / shell_time:.1f}%)"
+    )
+
+
 def wipe_workspace():
     current_branch = pbgit.get_current_branch_name()
     response = input(
@@ -457,6 +1314,7 @@ def wipe_workspace():
     pblog.info(proc.stdout)
     output = get_combined_output([pbgit.get_git_executable(), "clean", "-fd"])
     pblog.info(output)
+    pbstatus.invalidate()
     output = get_combined_output([pbgit.get_git_executable(), "pull"])
     pblog.info(output)
     return result == 0
@@ -465,11 +1323,9 @@ def wipe_workspace():
 def maintain_repo():
     pblog.info("Starting repo maintenance...")
 
-    commands = [f"{pbgit.get_lfs_executable()} prune -fc"]
-
     if os.name == "nt" and pbgit.get_git_executable() == "git":
         proc = run_with_combined_output(
-            ["schtasks" "/query", "/TN", "Git for Windows Updater"]
+            ["schtasks", "/query", "/TN", "Git for Windows Updater"]
         )
         # if exists
         if proc.returncode == 0:
@@ -486,57 +1342,37 @@ def maintain_repo():
             else:
                 proc = run_with_combined_output(cmdline)
 
-    does_maintainence = (
-        get_one_line_output(
-            [pbgit.get_git_executable(), "config", "maintenance.prefetch.schedule"]
-        )
-        == "hourly"
-    )
-    if not does_maintainence:
-        commands.insert(0, f"scalar register .")
+    pbgitsession.close_sessions()
+    pbmaintenance.start()
 
-    # fill in the git repo optionally
-    is_shallow = get_one_line_output(
-        [pbgit.get_git_executable(), "rev-parse", "--is-shallow-repository"]
-    )
-    # add in the front, so everything else can clean up after the fetch
-    if is_shallow == "true":
-        pblog.info(
-            "Shallow clone detected. PBSync will fill in history in the background."
-        )
-        commands.insert(0, f"{pbgit.get_git_executable()} fetch --unshallow")
-    else:
-        # repo was already fetched in UpdateProject for the current branch
-        current_branch = pbgit.get_current_branch_name()
-        fetch_base = [pbgit.get_git_executable(), "fetch", "--no-tags", "origin"]
-        # sync other branches, but we already synced our own in UpdateProject.bat
-        configured_branches = pbconfig.get("branches")
-        branches = []
-        if configured_branches:
-            for branch in configured_branches:
-                if branch == current_branch:
-                    continue
-                branches.append(branch)
-            fetch_base.extend(branches)
-        commands.insert(0, " ".join(fetch_base))
-
-    run_non_blocking(*commands)
+    if pbconfig.get_user_config().getboolean("prefetch", "autostart", fallback=False):
+        pbprefetch.start_daemon()
 
 
 lfs_fetch_thread = None
 
 
-def do_lfs_fetch(files):
-    branch_name = pbgit.get_current_branch_name()
+def do_lfs_fetch(files, processes=4, ref=None, env=None):
+    if ref is None:
+        ref = f"origin/{pbgit.get_current_branch_name()}"
     fetch = [
         pbgit.get_lfs_executable(),
         "fetch",
         "origin",
-        f"origin/{branch_name}",
+        ref,
         "-I",
-        ",".join(files),
     ]
-    run(fetch)
+
+    def fetch_batch(cmd):
+        return retry_on_timeout(
+            lambda: run(cmd, env=env, timeout=get_timeout("lfs_fetch")),
+            "Git LFS fetch",
+        )
+
+    # git lfs reads the pointers at ref, which a partial clone may not have yet
+    pbpartialclone.fetch_blobs(ref, files)
+
+    return run_batched(fetch, files, sep=",", processes=processes, runner=fetch_batch)
 
 
 def start_lfs_fetch(files):
@@ -550,14 +1386,131 @@ def finish_lfs_fetch():
         lfs_fetch_thread.join()
 
 
-def do_lfs_checkout(files):
+# config for the git processes of a mass checkout
+no_fsmonitor_config = {"core.fsmonitor": "false", "core.useBuiltinFSMonitor": "false"}
+
+
+def lower_priority():
+    """Lowers the CPU and disk priority of this process, which the processes it starts inherit."""
+    process = psutil.Process()
+    try:
+        if os.name == "nt":
+            process.nice(psutil.BELOW_NORMAL_PRIORITY_CLASS)
+            process.ionice(psutil.IOPRIO_LOW)
+        else:
+            process.nice(10)
+            if hasattr(psutil, "IOPRIO_CLASS_IDLE"):
+                process.ionice(psutil.IOPRIO_CLASS_IDLE)
+    except psutil.Error as e:
+        pblog.warning(f"Could not lower the process priority: {e}")
+
+
+def get_launch_cmd(*args):
+    """Returns the command which starts PBSync with args, in this workspace and with this config."""
+    if getattr(sys, "frozen", False):
+        cmd = [sys.executable]
+    else:
+        cmd = [sys.executable, "-m", "pbsync"]
+    return cmd + [
+        *args,
+        "--debugpath",
+        os.getcwd(),
+        "--config",
+        os.path.abspath(pbconfig.config_filepath),
+    ]
+
+
+def get_config_env(config):
+    """Returns the environment which sets config for a git process, and the git processes it starts, like git lfs does.
+
+    This leaves the config files alone.
+    """
+    if not config:
+        return None
+    env = {"GIT_CONFIG_COUNT": str(len(config))}
+    for i, (key, value) in enumerate(config.items()):
+        env[f"GIT_CONFIG_KEY_{i}"] = key
+        env[f"GIT_CONFIG_VALUE_{i}"] = value
+    return env
+
+
+def refresh_index(files, env=None):
+    update_index = [
+        pbgit.get_git_executable(),
+        "update-index",
+        "-q",
+        "--refresh",
+        "--unmerged",
+        "-z",
+        "--stdin",
+    ]
+    return run_with_paths(update_index, files, env=env)
+
+
+def do_lfs_checkout(files, processes=1, env=None):
     # todo: is not using Git LFS user exe ok?
     lfs_checkout = ["git-lfs", "checkout", "--"]
-    lfs_checkout.extend(files)
-    run_with_combined_output(lfs_checkout)
+    # starting git lfs costs more than checking out a handful of files
+    processes = max(1, min(processes, math.ceil(len(files) / 5)))
+    git_dir = get_git_dir()
+    if processes == 1 or git_dir is None:
+        return run_batched(lfs_checkout, files, env=env)
+    # git lfs refreshes the index after checking out, and only one process can hold index.lock,
+    # so each worker refreshes a scratch copy of the index, and the real one is refreshed once at the end
+    index_path = pbgitindex.get_index_path(git_dir).absolute()
+    scratch_dir = git_dir.absolute() / cache_dir_name
+    scratch_indexes = set()
+
+    def checkout_batch(cmd):
+        scratch_index = scratch_dir / f"index-{threading.get_ident()}"
+        if scratch_index not in scratch_indexes:
+            shutil.copyfile(index_path, scratch_index)
+            scratch_indexes.add(scratch_index)
+        batch_env = (env or {}) | {"GIT_INDEX_FILE": str(scratch_index)}
+        return run_with_combined_output(cmd, env=batch_env)
+
+    # spread the files evenly over the processes
+    max_count = math.ceil(len(files) / processes)
+    try:
+        scratch_dir.mkdir(exist_ok=True)
+        procs = run_batched(
+            lfs_checkout,
+            files,
+            max_count=max_count,
+            processes=processes,
+            runner=checkout_batch,
+        )
+    finally:
+        for scratch_index in scratch_indexes:
+            scratch_index.unlink(missing_ok=True)
+    refresh_index(files, env)
+    return procs
+
+
+def get_incoming_lfs_files(branch_name):
+    """Returns the LFS files which differ between HEAD and upstream, or None if git could not tell."""
+    # both ways, rebased local commits are written out again too
+    diff = iter_output(
+        [
+            pbgit.get_git_executable(),
+            "diff",
+            "--name-only",
+            "--no-renames",
+            "-z",
+            "HEAD",
+            f"origin/{branch_name}",
+        ]
+    )
+    # the sparse checkout leaves out the rest
+    changed_files = pbsparse.filter_checked_out(pbgit.get_lfs_files(diff))
+    return None if diff.returncode != 0 else changed_files
 
 
-def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
+def resolve_conflicts_and_pull(retry_count=0, max_retries=1, fast=False):
+    """Merges or rebases onto upstream.
+
+    fast skips smudging during the merge, and checks out the LFS files afterwards in parallel, with their objects fetched alongside the merge.
+    """
     branch_name = pbgit.get_current_branch_name()
     on_expected_branch = pbgit.is_on_expected_branch()
     configured_branches = pbconfig.get("branches")
@@ -580,6 +1533,15 @@ def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
     def handle_error(msg=None):
         error_state(msg, fatal_error=True)
 
+    # long lived git processes hold pack files open, which blocks auto gc after fetching on Windows
+    pbgitsession.close_sessions()
+
+    # background maintenance and prefetch stop for the pull, and wait for the sync to finish
+    if not pbmaintenance.preempt():
+        handle_error(
+            "Another PBSync is already synchronizing this workspace. Please wait for it to finish."
+        )
+
     index_lock = Path(".git/index.lock")
     if index_lock.exists():
         success = False
@@ -595,7 +1557,7 @@ def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
                     "Git is currently being used by another process. Retrying..."
                 )
                 retry_count += 1
-                resolve_conflicts_and_pull(retry_count, 2)
+                resolve_conflicts_and_pull(retry_count, 2, fast=fast)
                 return
         except AssertionError:
             # just fall back to full error
@@ -605,11 +1567,21 @@ def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
                 f"Git is currently being used by another process. Please try again later or request help in {pbconfig.get('support_channel')} to resolve it, and please do not run UpdateProject until the issue is resolved."
             )
 
-    out = get_combined_output(
-        [pbgit.get_git_executable(), "status", "--porcelain=2", "--branch"]
-    )
+    status = pbstatus.get_status()
+    # without a status, pull anyway and let git tell
+    behind = status.branch.behind if status is not None else None
+
+    if behind != 0:
+        if status is not None:
+            # a pull that can only fail would cost its checkout and the abort first
+            conflicts = pbconflicts.find_conflicts(branch_name, status)
+            if conflicts:
+                for file, reason in conflicts:
+                    pblog.error(f"{file}: {reason}")
+                handle_error(
+                    f"Aborting the pull before it started. {len(conflicts)} of your files conflict with incoming changes, listed above. Please request help in {pbconfig.get('support_channel')} to resolve conflicts, and please do not run UpdateProject until the issue is resolved."
+                )
 
-    if not it_has_any(out, "-0"):
         pbunreal.ensure_ue_closed()
         pblog.info(
             "Please wait while getting the latest changes from the repository. It may take a while..."
@@ -630,159 +1602,67 @@ def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
             pblog.info(log)
             res_out += log
 
-        use_new_sync = False
-        if use_new_sync:
-            # Check what files we are going to change
-            diff_proc = run_with_combined_output(
-                [
-                    pbgit.get_git_executable(),
-                    "diff",
-                    "--name-only",
-                    f"HEAD...origin/{branch_name}",
-                ]
-            )
-            if diff_proc.returncode == 0:
-                changed_files = diff_proc.stdout.splitlines()
-            else:
-                changed_files = []
-
-            changed_files = [file for file in changed_files if pbgit.is_lfs_file(file)]
-
-            cpus = os.cpu_count()
-            total = len(changed_files)
-            fetch_processes = min(cpus, math.ceil(total / 50))
-            fetch_batch_size = min(50, math.ceil(total / fetch_processes))
-            if fetch_batch_size == total:
+        if (
+            fast
+            and status is not None
+            and pbgit.get_lfs_files(status.get_changed_paths())
+        ):
+            # git lfs checkout would overwrite the local changes it finds as pointers after the autostash
+            pblog.info("Local changes to LFS files found, using the regular sync")
+            fast = False
+
+        # Get the latest files
+        cmdline = [pbgit.get_git_executable()]
+        pull_env = None
+        if fast:
+            changed_files = get_incoming_lfs_files(branch_name)
+            if changed_files:
                 start_lfs_fetch(changed_files)
-            else:
-                fetch_batched = chunks(changed_files, fetch_batch_size)
-                with multiprocessing.Pool(fetch_processes) as pool:
-                    pool.map(do_lfs_fetch, fetch_batched)
-
-            # Get the latest files, but skip smudge so we can super charge a LFS pull as one batch
-            cmdline = [
-                pbgit.get_git_executable(),
-                "-c",
-                "filter.lfs.smudge=",
-                "-c",
-                "filter.lfs.process=",
-                "-c",
-                "filter.lfs.required=false",
-            ]
-            # if we can fast forward merge, do that instead of a rebase (faster, safer)
-            if it_has_any(out, "+0"):
-                pblog.info(
-                    "Fast forwarding workspace to the latest changes from the repository..."
-                )
-                cmdline.extend(["merge", "--ff-only"])
-            else:
-                pblog.info(
-                    "Rebasing workspace with the latest changes from the repository..."
-                )
-                cmdline.extend(["rebase", "--autostash"])
-            cmdline.append(f"origin/{branch_name}")
-            result = run_with_combined_output(cmdline)
-
-            # update plugin submodules
-            if run_with_combined_output(
-                [pbgit.get_git_executable(), "ls-files", "--", "Plugins"]
-            ).stdout:
-                run_with_combined_output(
-                    [
-                        pbgit.get_git_executable(),
-                        "submodule",
-                        "update",
-                        "--init",
-                        "--",
-                        "Plugins",
-                    ]
-                )
-            else:
-                shutil.rmtree("Plugins", ignore_errors=True)
-
-            processes = min(cpus, math.ceil(total / 5))
-            batch_size = min(50, math.ceil(total / processes))
-            chunked_files = chunks(changed_files, batch_size)
-
-            # make index.lock to block LFS from updating index
-            with open(".git/index.lock", "w") as f:
-                pass
-
-            # Update index without FS monitor
-            run(
-                [
-                    pbgit.get_git_executable(),
-                    "config",
-                    "-f",
-                    ".gitconfig",
-                    "core.useBuiltinFSMonitor",
-                    "false",
-                ]
+            # skip smudge so we can super charge a LFS checkout as one batch
+            # overriding filter.lfs.process instead would turn off the clean filter too, and git would take any LFS file it has to hash as changed
+            pull_env = {"GIT_LFS_SKIP_SMUDGE": "1"}
+        # if we can fast forward merge, do that instead of a rebase (faster, safer)
+        if status is not None and status.branch.ahead == 0:
+            pblog.info(
+                "Fast forwarding workspace to the latest changes from the repository..."
             )
-
-            # split it out to multiprocess
-            with multiprocessing.Pool(processes) as pool:
-                # Checkout LFS in one go since we skipped smudge and fetched in the background
-                finish_lfs_fetch()
-                pool.map(do_lfs_checkout, chunked_files)
-
-            os.remove(".git/index.lock")
-
-            update_index = [
-                pbgit.get_git_executable(),
-                "update-index",
-                "-q",
-                "--refresh",
-                "--unmerged",
-                "--",
-            ]
-            update_index.extend(changed_files)
-            run(update_index)
-
-            # Revert back to using FS monitor
-            run(
+            cmdline.extend(["merge", "--ff-only"])
+        else:
+            pblog.info(
+                "Rebasing workspace with the latest changes from the repository..."
+            )
+            cmdline.extend(["rebase", "--autostash"])
+        cmdline.append(f"origin/{branch_name}")
+        result = run_stream(cmdline, env=pull_env, logfunc=res_log)
+        pbstatus.invalidate()
+
+        # update plugin submodules
+        if run_with_combined_output(
+            [pbgit.get_git_executable(), "ls-files", "--", "Plugins"], cache=True
+        ).stdout:
+            run_stream(
                 [
                     pbgit.get_git_executable(),
-                    "config",
-                    "-f",
-                    ".gitconfig",
-                    "core.useBuiltinFSMonitor",
-                    "true",
+                    "submodule",
+                    "update",
+                    "--init",
+                    "--",
+                    "Plugins",
                 ]
             )
         else:
-            # Get the latest files
-            cmdline = [pbgit.get_git_executable()]
-            # if we can fast forward merge, do that instead of a rebase (faster, safer)
-            if it_has_any(out, "+0"):
-                pblog.info(
-                    "Fast forwarding workspace to the latest changes from the repository..."
-                )
-                cmdline.extend(["merge", "--ff-only"])
-            else:
-                pblog.info(
-                    "Rebasing workspace with the latest changes from the repository..."
-                )
-                cmdline.extend(["rebase", "--autostash"])
-            cmdline.append(f"origin/{branch_name}")
-            result = run_stream(cmdline, logfunc=res_log)
-
-            # update plugin submodules
-            if run_with_combined_output(
-                [pbgit.get_git_executable(), "ls-files", "--", "Plugins"]
-            ).stdout:
-                run_stream(
-                    [
-                        pbgit.get_git_executable(),
-                        "submodule",
-                        "update",
-                        "--init",
-                        "--",
-                        "Plugins",
-                    ]
+            shutil.rmtree("Plugins", ignore_errors=True)
+
+        if fast:
+            # Checkout LFS in one go since we skipped smudge and fetched in the background
+            finish_lfs_fetch()
+            remaining = pbgit.repair_lfs_pointers(
+                changed_files, os.cpu_count(), no_fsmonitor_config
+            )
+            if remaining:
+                pblog.warning(
+                    f"{len(remaining)} LFS files could not be checked out. Run PBSync with --sync verify-lfs to try again."
                 )
-            else:
-                shutil.rmtree("Plugins", ignore_errors=True)
 
         # see if the update was successful
         code = result.returncode
@@ -815,7 +1695,7 @@ def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
         if should_attempt_auto_resolve():
             pblog.error("Unborn branch detected. Retrying...")
             retry_count += 1
-            resolve_conflicts_and_pull(retry_count)
+            resolve_conflicts_and_pull(retry_count, fast=fast)
             return
         else:
             handle_error(
@@ -825,7 +1705,7 @@ def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
         if should_attempt_auto_resolve():
             pblog.error("Remote repository not found. Retrying...")
             retry_count += 1
-            resolve_conflicts_and_pull(retry_count, 2)
+            resolve_conflicts_and_pull(retry_count, 2, fast=fast)
             return
         else:
             handle_error(
@@ -835,7 +1715,7 @@ def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
         if should_attempt_auto_resolve():
             pblog.error("Git file info could not be read. Retrying...")
             retry_count += 1
-            resolve_conflicts_and_pull(retry_count, 3)
+            resolve_conflicts_and_pull(retry_count, 3, fast=fast)
             return
         else:
             handle_error(
@@ -848,11 +1728,18 @@ def resolve_conflicts_and_pull(retry_count=0, max_retries=1):
         if should_attempt_auto_resolve():
             pblog.error("Untracked files would be overwritten. Retrying...")
             files = [l.strip() for l in out.splitlines()[1:]]
-            run_with_combined_output(
-                [pbgit.get_git_executable(), "add", "-A", "--", *files]
+            run_with_paths(
+                [
+                    pbgit.get_git_executable(),
+                    "add",
+                    "-A",
+                    "--pathspec-from-file=-",
+                    "--pathspec-file-nul",
+                ],
+                files,
             )
             retry_count += 1
-            resolve_conflicts_and_pull(retry_count, 1)
+            resolve_conflicts_and_pull(retry_count, 1, fast=fast)
             return
         else:
             handle_error(
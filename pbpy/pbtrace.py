@@ -0,0 +1,227 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import psutil
+
+from pbpy import pblog, pbtools
+
+# how often running processes are sampled for memory and CPU usage
+sample_interval = 0.05
+
+# finished spans are written out once there are this many, so long running processes like the prefetcher stay small
+flush_length = 1000
+
+trace_file_path = None
+# the trace is a JSON array, written out as spans finish and closed at exit
+# viewers also read one which was cut off, when PBSync did not get to close it
+trace_started = False
+trace_finished = False
+
+# finished spans not written yet, in Chrome trace event format
+events = []
+active_spans = set()
+# rows in the trace viewer, so that concurrent processes do not overlap
+busy_lanes = set()
+lock = threading.Lock()
+sampler_thread = None
+start_time = time.perf_counter()
+subcommand_pattern = re.compile(r"[A-Za-z][\w-]*$")
+
+
+class Span:
+    """Timing and resource usage of one spawned process."""
+
+    def __init__(self, cmd, pid):
+        self.name = get_span_name(cmd)
+        self.summary = pbtools.describe_cmd(cmd)
+        self.pid = pid
+        self.start = time.perf_counter()
+        self.output_bytes = 0
+        self.peak_rss = None
+        self.cpu_time = None
+        self.lane = 0
+        self.process = None
+        self.children = {}
+        if pid is not None:
+            try:
+                self.process = psutil.Process(pid)
+            except psutil.Error:
+                pass
+
+    def add_output(self, output):
+        if output is None:
+            return
+        if isinstance(output, str):
+            output = output.encode("utf-8", errors="replace")
+        self.output_bytes += len(output)
+
+    def sample(self):
+        if self.process is None:
+            return
+        try:
+            with self.process.oneshot():
+                rss = self.process.memory_info().rss
+                times = self.process.cpu_times()
+                # reaped children are already included in the parent's times
+                cpu_time = (
+                    times.user
+                    + times.system
+                    + times.children_user
+                    + times.children_system
+                )
+            for child in self.process.children(recursive=True):
+                self.children.setdefault(child.pid, child)
+        except psutil.Error:
+            return
+        # git and the shell hand most of the work off to child processes, so sum the whole tree
+        child_cpu_time = 0.0
+        for pid, child in list(self.children.items()):
+            try:
+                with child.oneshot():
+                    rss += child.memory_info().rss
+                    times = child.cpu_times()
+                    child_cpu_time += times.user + times.system
+            except psutil.Error:
+                del self.children[pid]
+        self.peak_rss = rss if self.peak_rss is None else max(self.peak_rss, rss)
+        cpu_time += child_cpu_time
+        self.cpu_time = (
+            cpu_time if self.cpu_time is None else max(self.cpu_time, cpu_time)
+        )
+
+    def to_event(self, end, returncode, timed_out):
+        return {
+            "name": self.name,
+            "cat": "process",
+            "ph": "X",
+            "ts": round((self.start - start_time) * 1e6),
+            "dur": round((end - self.start) * 1e6),
+            "pid": os.getpid(),
+            "tid": self.lane,
+            "args": {
+                "cmd": self.summary,
+                "pid": self.pid,
+                "returncode": returncode,
+                "timed_out": timed_out,
+                "output_bytes": self.output_bytes,
+                "peak_rss": self.peak_rss,
+                "cpu_time": None if self.cpu_time is None else round(self.cpu_time, 3),
+            },
+        }
+
+
+def get_span_name(cmd):
+    if isinstance(cmd, str):
+        cmd = cmd.split()
+    if not cmd:
+        return ""
+    name = Path(str(cmd[0])).stem
+    # name git commands by their subcommand, skipping over any -c options
+    args = iter(cmd[1:])
+    for arg in args:
+        arg = str(arg)
+        if arg == "-c":
+            next(args, None)
+        elif not arg.startswith("-"):
+            return f"{name} {arg}" if subcommand_pattern.match(arg) else name
+    return name
+
+
+def get_process_trace_path(path, mode):
+    """Returns the trace file of a background process running as mode, next to path, so that it does not write into the trace of the sync."""
+    path = Path(path)
+    return path.with_name(f"{path.stem}.{mode}.{os.getpid()}{path.suffix}")
+
+
+def setup_trace(path):
+    global trace_file_path
+    if trace_file_path is None:
+        atexit.register(finish_trace)
+    trace_file_path = path
+
+
+def begin(cmd, pid):
+    if trace_file_path is None:
+        return None
+    span = Span(cmd, pid)
+    span.sample()
+    global sampler_thread
+    with lock:
+        lane = 0
+        while lane in busy_lanes:
+            lane += 1
+        busy_lanes.add(lane)
+        span.lane = lane
+        active_spans.add(span)
+        if sampler_thread is None:
+            sampler_thread = threading.Thread(target=sampler, daemon=True)
+            sampler_thread.start()
+    return span
+
+
+def end(span, returncode, timed_out=False):
+    if span is None:
+        return
+    end_time = time.perf_counter()
+    with lock:
+        active_spans.discard(span)
+        busy_lanes.discard(span.lane)
+        events.append(span.to_event(end_time, returncode, timed_out))
+        flush = len(events) >= flush_length
+    if flush:
+        write_trace()
+
+
+def add_output(span, output):
+    if span is None:
+        return
+    span.add_output(output)
+
+
+def sampler():
+    global sampler_thread
+    while True:
+        with lock:
+            spans = list(active_spans)
+            if not spans:
+                sampler_thread = None
+                return
+        for span in spans:
+            span.sample()
+        time.sleep(sample_interval)
+
+
+def write_trace():
+    global trace_started
+    with lock:
+        pending = list(events)
+        events.clear()
+        if trace_file_path is None or not pending:
+            return
+        try:
+            with open(trace_file_path, "a" if trace_started else "w") as f:
+                for event in pending:
+                    f.write(",\n" if trace_started else "[\n")
+                    f.write(json.dumps(event))
+                    trace_started = True
+        except OSError as e:
+            pblog.warning(f"Could not write process trace to {trace_file_path}: {e}")
+
+
+def finish_trace():
+    global trace_finished
+    write_trace()
+    with lock:
+        if not trace_started or trace_finished:
+            return
+        try:
+            with open(trace_file_path, "a") as f:
+                f.write("\n]\n")
+            trace_finished = True
+        except OSError as e:
+            pblog.warning(f"Could not write process trace to {trace_file_path}: {e}")
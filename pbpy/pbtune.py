@@ -0,0 +1,500 @@
+import json
+import os
+import shutil
+import time
+
+import psutil
+
+from pbpy import (
+    pbgit,
+    pbgitindex,
+    pbgitmeta,
+    pbgitsession,
+    pblog,
+    pbmaintenance,
+    pbtools,
+)
+
+# measures git settings in this clone, and writes the fastest ones into an include of the repository config,
+# after the shared ../.gitconfig so they win over it. what changed and why is recorded in the PBSync cache
+
+record_file_name = "tune.json"
+scratch_dir_name = "tune"
+# a setting only changes if the candidate is this much faster, so noise does not flip it back and forth
+min_gain = 0.1
+rounds = 3
+checkout_sample_files = 2000
+lfs_sample_size = 32 * 1024 * 1024
+lfs_sample_files = 200
+lfs_transfers_candidates = (4, 8, 16, 32)
+# memory each pack thread may need for its delta window on large assets
+pack_thread_memory = 2 * 1024 * 1024 * 1024
+# git's defaults, for settings which are not set
+defaults = {
+    "core.untrackedcache": "false",
+    "core.fsmonitor": "false",
+    "checkout.workers": "1",
+    "lfs.concurrenttransfers": "8",
+}
+# microsoft/git reads the older setting, so it always gets the same value
+legacy_fsmonitor_key = "core.useBuiltinFSMonitor"
+
+
+def get_scratch_dir():
+    return pbtools.get_git_dir().absolute() / pbtools.cache_dir_name / scratch_dir_name
+
+
+def get_current(key):
+    value = pbgitsession.get_session().get_config(key)
+    return value.lower() if value else defaults.get(key.lower(), "")
+
+
+def time_cmd(cmd, env=None, prepare=None, warmup=True, count=rounds):
+    """Returns the best time of cmd in seconds, or None if it failed. prepare runs before each round, outside of the timing."""
+    times = []
+    for i in range(count + int(warmup)):
+        if prepare is not None:
+            prepare()
+        start = time.perf_counter()
+        proc = pbtools.run_with_combined_output(cmd, env=env)
+        elapsed = time.perf_counter() - start
+        if proc.returncode:
+            pblog.debug(f"{' '.join(cmd)} failed: {proc.stdout.strip()}")
+            return None
+        if i >= int(warmup):
+            times.append(elapsed)
+    return min(times)
+
+
+def pick(current, timings):
+    """Returns the fastest of timings, unless it is not clearly faster than current."""
+    timings = {
+        value: seconds for value, seconds in timings.items() if seconds is not None
+    }
+    if not timings:
+        return current
+    best = min(timings, key=timings.get)
+    if current in timings and timings[best] > timings[current] * (1 - min_gain):
+        return current
+    return best
+
+
+def describe(name, timings, value, current):
+    times = ", ".join(
+        f"{candidate}: {seconds * 1000:.0f}ms"
+        for candidate, seconds in timings.items()
+        if seconds is not None
+    )
+    return f"{name} took {times}, {value} replaces {current}"
+
+
+def get_env(config, index_path=None):
+    env = pbtools.get_config_env(config) or {}
+    if index_path is not None:
+        env["GIT_INDEX_FILE"] = str(index_path)
+    return env
+
+
+def make_scratch_index(index_version=None):
+    index_path = get_scratch_dir() / "index"
+    git_dir = pbtools.get_git_dir()
+    shutil.copyfile(pbgitindex.get_index_path(git_dir), index_path)
+    if index_version is not None:
+        pbtools.run_with_combined_output(
+            [
+                pbgit.get_git_executable(),
+                "update-index",
+                "--index-version",
+                index_version,
+            ],
+            env={"GIT_INDEX_FILE": str(index_path)},
+        )
+    return index_path
+
+
+def time_status(config, index_version=None):
+    # on a copy of the index, which status is free to rewrite with its caches
+    index_path = make_scratch_index(index_version)
+    return time_cmd(
+        [pbgit.get_git_executable(), "status", "--porcelain"],
+        env=get_env(config, index_path),
+    )
+
+
+def tune_index_version(config, changes):
+    try:
+        current = str(pbgitindex.read_index_version())
+    except (pbgitmeta.MetadataError, OSError) as e:
+        pblog.warning(f"Skipping the index version: {e}")
+        return
+    timings = {
+        version: time_status(config, version)
+        for version in dict.fromkeys([current, "4"])
+    }
+    value = pick(current, timings)
+    if value != current:
+        changes.append(
+            {
+                "key": "index.version",
+                "value": value,
+                "previous": current,
+                "reason": describe("git status", timings, value, current),
+            }
+        )
+    config["index.version"] = value
+
+
+def tune_status_setting(key, candidates, config, changes):
+    current = get_current(key)
+    timings = {}
+    for candidate in dict.fromkeys([current, *candidates]):
+        timings[candidate] = time_status(
+            config | {key: candidate}, config.get("index.version")
+        )
+    value = pick(current, timings)
+    if value != current:
+        changes.append(
+            {
+                "key": key,
+                "value": value,
+                "previous": current,
+                "reason": describe("git status", timings, value, current),
+            }
+        )
+    config[key] = value
+
+
+def is_fsmonitor_supported():
+    proc = pbtools.run_with_combined_output(
+        [pbgit.get_git_executable(), "fsmonitor--daemon", "status"]
+    )
+    # not watching yet is fine, missing support or an unknown command is not
+    return proc.returncode in (0, 1) and "not supported" not in proc.stdout
+
+
+def get_checkout_sample():
+    files = pbgit.get_tracked_files()
+    lfs_files = set(pbgit.get_lfs_files(files))
+    return [file for file in files if file not in lfs_files][:checkout_sample_files]
+
+
+def tune_checkout_workers(config, changes):
+    sample = get_checkout_sample()
+    if len(sample) < 100:
+        pblog.info("Too few files to measure parallel checkout")
+        return
+    git = pbgit.get_git_executable()
+    worktree = get_scratch_dir() / "worktree"
+    cmd = [
+        git,
+        "--literal-pathspecs",
+        f"--work-tree={worktree}",
+        "checkout",
+        "HEAD",
+        "--",
+    ]
+    # as much of the sample as fits on one command line
+    sample = next(pbtools.batch_args(cmd, sample))
+    cpus = os.cpu_count() or 1
+    current = get_current("checkout.workers")
+    timings = {}
+    for workers in dict.fromkeys([current, "1", str(max(1, cpus // 2)), str(cpus)]):
+        index_path = get_scratch_dir() / "index"
+
+        def prepare():
+            shutil.rmtree(worktree, ignore_errors=True)
+            worktree.mkdir()
+            make_scratch_index()
+
+        env = get_env(config | {"checkout.workers": workers}, index_path)
+        # writes into a scratch directory, and leaves the LFS files out
+        timings[workers] = time_cmd(cmd + sample, env=env, prepare=prepare)
+    shutil.rmtree(worktree, ignore_errors=True)
+    value = pick(current, timings)
+    if value != current:
+        changes.append(
+            {
+                "key": "checkout.workers",
+                "value": value,
+                "previous": current,
+                "reason": describe(
+                    f"checking out {len(sample)} files", timings, value, current
+                ),
+            }
+        )
+    config["checkout.workers"] = value
+
+
+def get_lfs_sample():
+    sample = []
+    size = 0
+    files = pbgit.get_lfs_files(pbgit.get_tracked_files())
+    for file in files:
+        try:
+            file_size = os.path.getsize(file)
+        except OSError:
+            continue
+        # pointers which were not checked out have nothing to measure
+        if (
+            file_size <= pbgit.lfs_pointer_max_size
+            or size + file_size > lfs_sample_size
+        ):
+            continue
+        sample.append(file)
+        size += file_size
+        if len(sample) >= lfs_sample_files:
+            break
+    return sample, size
+
+
+def tune_lfs_transfers(config, changes):
+    sample, size = get_lfs_sample()
+    if not sample:
+        pblog.info("No LFS files to measure transfers with")
+        return
+    current = get_current("lfs.concurrenttransfers")
+    cmd = [
+        pbgit.get_lfs_executable(),
+        "fetch",
+        "--refetch",
+        "origin",
+        "HEAD",
+        "-I",
+        ",".join(sample),
+    ]
+    timings = {}
+    for transfers in dict.fromkeys([current, *map(str, lfs_transfers_candidates)]):
+        env = get_env(config | {"lfs.concurrenttransfers": transfers})
+        # downloads are slow and noisy enough that one round each has to do
+        timings[transfers] = time_cmd(cmd, env=env, warmup=False, count=1)
+        if timings[transfers] is None:
+            pblog.info(
+                "This Git LFS can not download objects again, skipping transfers"
+            )
+            return
+    value = pick(current, timings)
+    if value != current:
+        changes.append(
+            {
+                "key": "lfs.concurrenttransfers",
+                "value": value,
+                "previous": current,
+                "reason": describe(
+                    f"fetching {len(sample)} LFS files ({size / 1024 / 1024:.0f} MiB)",
+                    timings,
+                    value,
+                    current,
+                ),
+            }
+        )
+    config["lfs.concurrenttransfers"] = value
+
+
+def tune_pack_threads(config, changes):
+    # repacking is too expensive to measure, but every thread needs memory for its delta window
+    cpus = os.cpu_count() or 1
+    memory = psutil.virtual_memory().total
+    threads = max(1, min(cpus, memory // pack_thread_memory))
+    current = pbgit.read_tuned_config().get("pack.threads")
+    if threads >= cpus:
+        # git uses every core by default, so a limit of an earlier run goes
+        if current is not None:
+            changes.append(
+                {
+                    "key": "pack.threads",
+                    "value": None,
+                    "previous": current,
+                    "reason": f"{memory / 1024 ** 3:.0f} GiB of memory is enough for {cpus} cores",
+                }
+            )
+        return
+    value = str(threads)
+    if value != current:
+        changes.append(
+            {
+                "key": "pack.threads",
+                "value": value,
+                "previous": current or "0",
+                "reason": f"{memory / 1024 ** 3:.0f} GiB of memory for {cpus} cores",
+            }
+        )
+    config["pack.threads"] = value
+
+
+def tune_fsmonitor(config, changes):
+    if not is_fsmonitor_supported():
+        pblog.info("This git has no builtin file system monitor")
+        return
+    tune_status_setting("core.fsmonitor", ["true"], config, changes)
+    value = config["core.fsmonitor"]
+    legacy = pbgitsession.get_session().get_config(legacy_fsmonitor_key).lower()
+    # disagreeing values would have git and microsoft/git run with different monitors
+    if legacy and legacy != value:
+        changes.append(
+            {
+                "key": legacy_fsmonitor_key,
+                "value": value,
+                "previous": legacy,
+                "reason": "kept in line with core.fsmonitor",
+            }
+        )
+
+
+def tune_many_files(config, changes):
+    # the bundle git recommends for large trees, for the settings newer versions of git add to it
+    if (
+        config.get("index.version") != "4"
+        or config.get("core.untrackedCache") != "true"
+    ):
+        return
+    current = get_current("feature.manyFiles")
+    if pbgitmeta.is_true(current or "false"):
+        return
+    changes.append(
+        {
+            "key": "feature.manyFiles",
+            "value": "true",
+            "previous": current or "false",
+            "reason": "index.version=4 and core.untrackedCache=true were both faster",
+        }
+    )
+
+
+def write_config(changes):
+    """Writes the changes into the tuned include, where a value of None removes the setting. Returns whether git wrote all of them."""
+    git = pbgit.get_git_executable()
+    path = str(pbgit.get_tuned_config_path())
+    values = {change["key"]: change["value"] for change in changes}
+    for key, value in values.items():
+        if value is None:
+            cmd = [git, "config", "--file", path, "--unset-all", key]
+        else:
+            cmd = [git, "config", "--file", path, key, value]
+        proc = pbtools.run_with_combined_output(cmd)
+        # unsetting what is not set is fine
+        if proc.returncode and not (value is None and proc.returncode == 5):
+            pblog.error(f"Could not write {key} to {path}: {proc.stdout.strip()}")
+            return False
+    pbgit.setup_config()
+    if "index.version" in values:
+        proc = pbtools.run_with_combined_output(
+            [git, "update-index", "--index-version", values["index.version"]]
+        )
+        if proc.returncode:
+            pblog.warning(
+                f"Could not rewrite the index as version {values['index.version']}: {proc.stdout.strip()}"
+            )
+    if values.get("core.fsmonitor") == "false":
+        # the daemon would keep watching the tree for nobody
+        pbtools.run_with_combined_output([git, "fsmonitor--daemon", "stop"])
+    return True
+
+
+def find_overrides(force=False):
+    """Returns the tuned settings which a later setting overrides, and the ones force removed from the repository config."""
+    git = pbgit.get_git_executable()
+    overridden = []
+    removed = []
+    session = pbgitsession.get_session()
+    # settings of earlier runs as well, the repository config may have set them again since
+    for key, value in pbgit.read_tuned_config().items():
+        if session.get_config(key).lower() == value.lower():
+            continue
+        if force:
+            # the repository config sets it after the include
+            pbtools.run_with_combined_output(
+                [git, "config", "--local", "--unset-all", key]
+            )
+            pbgitsession.invalidate_config()
+            if session.get_config(key).lower() == value.lower():
+                removed.append(key)
+                continue
+        # someone may have set it on purpose, so it stays unless asked
+        pblog.warning(
+            f"{key}={session.get_config(key)} overrides the tuned {value}, run PBSync with --tune force to remove it from .git/config"
+        )
+        overridden.append(key)
+    return overridden, removed
+
+
+def read_record():
+    path = pbmaintenance.get_cache_file(record_file_name)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (TypeError, OSError, ValueError):
+        return {"runs": []}
+
+
+def write_record(record):
+    path = pbmaintenance.get_cache_file(record_file_name)
+    try:
+        with open(path, "w") as f:
+            json.dump(record, f, indent=2)
+    except OSError as e:
+        pblog.warning(f"Could not record the tuning in {path}: {e}")
+
+
+def tune(force=False):
+    """Measures git settings in this clone, applies the fastest ones, and records what changed and why.
+
+    force removes the settings of the repository config which override the tuned ones, instead of only warning about them.
+    """
+    if not pbmaintenance.try_lock("tune"):
+        pblog.error("The repository is busy, try again once PBSync is done with it")
+        return False
+    scratch_dir = get_scratch_dir()
+    try:
+        scratch_dir.mkdir(parents=True, exist_ok=True)
+        pblog.info("Measuring git settings. It may take a few minutes...")
+        config = {}
+        changes = []
+        tune_index_version(config, changes)
+        tune_status_setting("core.untrackedCache", ["true"], config, changes)
+        tune_fsmonitor(config, changes)
+        tune_many_files(config, changes)
+        tune_checkout_workers(config, changes)
+        tune_lfs_transfers(config, changes)
+        tune_pack_threads(config, changes)
+        if not write_config(changes):
+            return False
+        overridden, removed = find_overrides(force)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        pbmaintenance.release_lock()
+    run = {
+        "time": time.time(),
+        "git_version": pbgit.get_git_version(),
+        "changes": changes,
+        "overridden": overridden,
+        "removed": removed,
+    }
+    record = read_record()
+    record["runs"] = (record["runs"] + [run])[-pbmaintenance.history_length :]
+    write_record(record)
+    log_run(run)
+    return True
+
+
+def log_run(run):
+    if not run["changes"]:
+        pblog.info("The git settings are already the fastest measured")
+    for change in run["changes"]:
+        value = "unset" if change["value"] is None else change["value"]
+        pblog.info(f"{change['key']}: {change['previous']} -> {value}")
+        pblog.info(f"  {change['reason']}")
+    for key in run.get("removed", []):
+        pblog.info(f"Removed {key} from .git/config, it overrode the tuned value")
+    for key in run["overridden"]:
+        pblog.info(f"{key} in the repository config overrides the tuned value")
+
+
+def show():
+    runs = read_record()["runs"]
+    if not runs:
+        pblog.info("Git settings have not been tuned yet")
+        return True
+    for run in runs:
+        pblog.info(f"Tuned at {pbmaintenance.format_time(run['time'])}")
+        log_run(run)
+    return True
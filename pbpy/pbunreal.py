@@ -9,7 +9,7 @@ import shutil
 import time
 import urllib.request
 import zipfile
-from functools import lru_cache
+from functools import lru_cache, partial
 from pathlib import Path
 from shutil import disk_usage, move, rmtree
 from urllib.parse import urlparse
@@ -356,7 +356,9 @@ def uses_longtail():
 
 def check_ue_file_association():
     if os.name == "nt":
-        file_assoc_result = pbtools.get_combined_output(["assoc", uproject_ext])
+        file_assoc_result = pbtools.get_combined_output(
+            ["assoc", uproject_ext], shell=True
+        )
         return "Unreal.ProjectFile" in file_assoc_result
     else:
         return True
@@ -591,7 +593,9 @@ def get_engine_base_path() -> Path | None:
 @lru_cache()
 def get_unreal_version_selector_path():
     if get_engine_version() is None:
-        ftype_info = pbtools.get_one_line_output(["ftype", "Unreal.ProjectFile"])
+        ftype_info = pbtools.get_one_line_output(
+            ["ftype", "Unreal.ProjectFile"], shell=True
+        )
         if ftype_info is not None:
             ftype_split = ftype_info.split('"')
             if len(ftype_split) == 5:
@@ -869,42 +873,30 @@ def download_engine(bundle_name=None, download_symbols=False):
                 f"Comparing target engine version {get_engine_version_with_prefix()} with local engine version {branch_version}"
             )
 
-        if get_engine_version_with_prefix() == branch_version:
-            # fast version
-            proc = pbtools.run_stream(
-                [
-                    pbinfo.format_repo_folder(longtail_path),
-                    "get",
-                    "--source-path",
-                    f"{gcs_bucket}lt/{bundle_name}/{version}.json",
-                    "--target-path",
-                    str(base_path),
-                    "--cache-path",
-                    f"Saved/longtail/cache/{bundle_name}",
-                    "--enable-file-mapping",
-                ],
-                env={"GOOGLE_APPLICATION_CREDENTIALS": "Build/credentials.json"},
-                logfunc=pbtools.progress_stream_log,
-            )
-        else:
+        longtail_cmd = [
+            pbinfo.format_repo_folder(longtail_path),
+            "get",
+            "--source-path",
+            f"{gcs_bucket}lt/{bundle_name}/{version}.json",
+            "--target-path",
+            str(base_path),
+            "--cache-path",
+            f"Saved/longtail/cache/{bundle_name}",
+        ]
+        if get_engine_version_with_prefix() != branch_version:
             # verify a new install
-            proc = pbtools.run_stream(
-                [
-                    pbinfo.format_repo_folder(longtail_path),
-                    "get",
-                    "--source-path",
-                    f"{gcs_bucket}lt/{bundle_name}/{version}.json",
-                    "--target-path",
-                    str(base_path),
-                    "--cache-path",
-                    f"Saved/longtail/cache/{bundle_name}",
-                    "--no-cache-target-index",
-                    "--validate",
-                    "--enable-file-mapping",
-                ],
+            longtail_cmd.extend(["--no-cache-target-index", "--validate"])
+        longtail_cmd.append("--enable-file-mapping")
+        # longtail resumes from its cache, so a stalled download can be retried
+        proc = pbtools.retry_on_timeout(
+            lambda: pbtools.run_stream(
+                longtail_cmd,
                 env={"GOOGLE_APPLICATION_CREDENTIALS": "Build/credentials.json"},
                 logfunc=pbtools.progress_stream_log,
-            )
+                idle_timeout=pbtools.get_timeout("longtail_idle"),
+            ),
+            "Engine download",
+        )
         # print out a newline
         print("")
         if proc.returncode:
@@ -1007,7 +999,7 @@ def update_source_control():
 
 # we will either error out, or succeed, so this won't matter
 @lru_cache()
-def is_ue_closed():
+def is_ue_closed(project_path=None):
     # check if there is a UE running at all
     p = pbtools.get_running_process(get_editor_program())
     if p is None:
@@ -1027,7 +1019,7 @@ def is_ue_closed():
                 return True
     # finally, do an expensive open files check to ensure the project is open
     files = p.open_files()
-    project_path = Path().resolve()
+    project_path = Path(project_path or ".").resolve()
     found_project = False
     for file in files:
         path = Path(file.path)
@@ -1069,7 +1061,8 @@ def get_vs_basepath():
             "*",
             "-property",
             "installationPath",
-        ]
+        ],
+        shell=True,
     )
 
 
@@ -1166,8 +1159,8 @@ def build_source(for_distribution=True):
             f"-project={str(get_uproject_path())}",
             "-TargetType=Editor",
         ],
-        logfunc=lambda x: pbtools.checked_stream_log(
-            x, error="error ", warning="warning "
+        batchfunc=partial(
+            pbtools.checked_stream_batch_log, error="error ", warning="warning "
         ),
     )
     if not use_source_dir:
@@ -1197,8 +1190,8 @@ def build_shaders(platform: str = "PCD3D_SM6"):
     ]
     pbtools.run_stream(
         args,
-        logfunc=lambda x: pbtools.checked_stream_log(
-            x, error="Error: ", warning="Warning: "
+        batchfunc=partial(
+            pbtools.checked_stream_batch_log, error="Error: ", warning="Warning: "
         ),
     )
 
@@ -1237,8 +1230,8 @@ def build_game(configuration="Shipping"):
         args.extend(["-patchpaddingalign=1048576", "-blocksize=1048576"])
     proc = pbtools.run_stream(
         args,
-        logfunc=lambda x: pbtools.checked_stream_log(
-            x, error="Error: ", warning="Warning: "
+        batchfunc=partial(
+            pbtools.checked_stream_batch_log, error="Error: ", warning="Warning: "
         ),
     )
     if proc.returncode:
@@ -1282,7 +1275,7 @@ def inspect_source(all=False):
     if all:
         modified_files_list = "Source/**/*"
     else:
-        modified_paths = pbgit.get_modified_files()
+        modified_paths = pbgit.get_modified_files(pathspecs=["Source"])
         if len(modified_paths) < 1:
             pblog.info(
                 "No modified files to inspect, done. Use --build inspectall if you'd like to inspect the entire project."
@@ -1433,8 +1426,8 @@ def build_installed_build():
             "uebp_CL": str(changelist),
             "uebp_CodeCL": str(code_changelist),
         },
-        logfunc=lambda x: pbtools.checked_stream_log(
-            x, error="Error: ", warning="Warning: "
+        batchfunc=partial(
+            pbtools.checked_stream_batch_log, error="Error: ", warning="Warning: "
         ),
     )
 
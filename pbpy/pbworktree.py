@@ -0,0 +1,153 @@
+import os
+from pathlib import Path
+
+from pbpy import pbconfig, pbgit, pblog, pbtools, pbunreal
+
+# a pool of worktrees, one for each configured branch, so switching branches only changes directories
+# they share the object and LFS store of the clone, and keep their own Intermediate and DDC files
+# new worktrees are created in [worktree] dir of the user config, or next to the main worktree
+
+
+def get_main_worktree():
+    # the main worktree holds the common git directory
+    return pbgit.get_common_dir().resolve().parent
+
+
+def get_pool_dir():
+    configured = pbconfig.get_user("worktree", "dir", "")
+    if configured:
+        return Path(configured).expanduser().resolve()
+    main_worktree = get_main_worktree()
+    return main_worktree.parent / f"{main_worktree.name}-worktrees"
+
+
+def get_worktrees():
+    """Returns the path of the worktree each branch is checked out in."""
+    proc = pbtools.run_with_combined_output(
+        [pbgit.get_git_executable(), "worktree", "list", "--porcelain"]
+    )
+    worktrees = {}
+    if proc.returncode:
+        pblog.warning(f"Could not list worktrees: {proc.stdout.strip()}")
+        return worktrees
+    path = None
+    for line in proc.stdout.splitlines():
+        if line.startswith("worktree "):
+            path = Path(line[len("worktree ") :])
+        elif line.startswith("branch refs/heads/") and path is not None:
+            worktrees[line[len("branch refs/heads/") :]] = path
+    return worktrees
+
+
+def fetch_branches(branches):
+    proc = pbtools.run_with_combined_output(
+        [pbgit.get_git_executable(), "fetch", "--no-tags", "origin", *branches]
+    )
+    if proc.returncode:
+        pblog.warning(f"Could not fetch {', '.join(branches)}: {proc.stdout.strip()}")
+        return False
+    return True
+
+
+def create_worktree(branch):
+    """Checks out branch in a new worktree of the pool, and returns its path, or None if that failed."""
+    git = pbgit.get_git_executable()
+    path = get_pool_dir() / branch.replace("/", "-")
+    # forget worktrees whose directories were deleted, so their branches can be checked out again
+    pbtools.run([git, "worktree", "prune"])
+    has_local_branch = (
+        pbtools.run_with_combined_output(
+            [git, "rev-parse", "--verify", "--quiet", f"refs/heads/{branch}"]
+        ).returncode
+        == 0
+    )
+    if has_local_branch:
+        cmd = [git, "worktree", "add", str(path), branch]
+    else:
+        cmd = [
+            git,
+            "worktree",
+            "add",
+            "--track",
+            "-b",
+            branch,
+            str(path),
+            f"origin/{branch}",
+        ]
+    pblog.info(
+        f"Setting up the worktree of {branch} in {path}. This only happens once, and may take a while..."
+    )
+    proc = pbtools.run(cmd)
+    if proc.returncode:
+        pblog.error(f"Could not create the worktree of {branch}")
+        return None
+    return path
+
+
+def update_worktree(branch, path):
+    """Fast forwards the worktree of branch to origin, unless it has local changes or the editor has it open."""
+    git = pbgit.get_git_executable()
+    status = pbtools.run_with_combined_output(
+        [git, "-C", str(path), "status", "--porcelain", "-uno"]
+    )
+    if status.returncode:
+        pblog.warning(f"Could not check {path} for changes: {status.stdout.strip()}")
+        return False
+    if status.stdout.strip():
+        pblog.info(f"Not updating {path}, it has local changes")
+        return False
+    # the editor keeps files open, which the checkout could not replace on Windows
+    if not pbunreal.is_ue_closed(path):
+        pblog.info(f"Not updating {path}, Unreal Editor has it open")
+        return False
+    proc = pbtools.run_with_combined_output(
+        [git, "-C", str(path), "merge", "--ff-only", f"origin/{branch}"]
+    )
+    if proc.returncode:
+        pblog.warning(f"Could not update {path}: {proc.stdout.strip()}")
+        return False
+    return True
+
+
+def update_pool():
+    """Brings the worktrees of the other configured branches up to date with origin."""
+    current_branch = pbgit.get_current_branch_name()
+    branches = pbconfig.get("branches")
+    worktrees = {
+        branch: path
+        for branch, path in get_worktrees().items()
+        if branch in branches and branch != current_branch
+    }
+    if not worktrees:
+        return True
+    pblog.info(f"Updating the worktrees of {', '.join(worktrees)}...")
+    if not fetch_branches(list(worktrees)):
+        return False
+    results = [update_worktree(branch, path) for branch, path in worktrees.items()]
+    return all(results)
+
+
+def switch(branch):
+    """Points the user and the editor at the worktree of branch, which is set up first if needed."""
+    branches = pbconfig.get("branches")
+    if branch not in branches:
+        pblog.error(
+            f"{branch} is not a configured branch. Available branches: {', '.join(branches)}"
+        )
+        return False
+    fetch_branches([branch])
+    path = get_worktrees().get(branch)
+    if path is None:
+        path = create_worktree(branch)
+        if path is None:
+            return False
+        pblog.info(
+            f"Run UpdateProject in {path} once, to pull the binaries and engine of {branch}"
+        )
+    elif path.resolve() != Path().resolve():
+        update_worktree(branch, path)
+    pblog.success(f"{branch} is checked out in {path}")
+    uproject = path / pbconfig.get("uproject_name")
+    if os.name == "nt" and uproject.exists():
+        os.startfile(uproject)
+    return True
@@ -15,12 +15,22 @@ from pbpy import (
     pbdispatch,
     pbgh,
     pbgit,
+    pbgitsession,
+    pblfsfilter,
     pblog,
+    pbmaintenance,
+    pbpartialclone,
+    pbprefetch,
     pbpy_version,
+    pbsparse,
+    pbstatus,
     pbsteamcmd,
     pbtools,
+    pbtrace,
+    pbtune,
     pbuac,
     pbunreal,
+    pbworktree,
 )
 from pbpy.pbtools import error_state
 
@@ -42,18 +52,44 @@ def config_handler(config_var, config_parser_func):
         )
 
 
-def sync_handler(sync_val: str, repository_val=None):
+def sync_handler(sync_val: str, repository_val=None, fast=False):
 
     sync_val = sync_val.lower()
 
     if sync_val == "all" or sync_val == "force" or sync_val == "partial":
         pblog.info(f"Executing {sync_val} sync command")
+        # background prefetch and maintenance stay out of the repository until the sync is done
+        if not pbmaintenance.preempt():
+            error_state(
+                "Another PBSync is already synchronizing this workspace. Please wait for it to finish."
+            )
+        fast = fast or pbconfig.get_user_config().getboolean(
+            "project", "fastsync", fallback=False
+        )
         pblog.info(f"PBpy Library Version: {pbpy_version.ver}")
         pblog.info(f"PBSync Program Version: {pbsync_version.ver}")
 
         pblog.info("------------------")
 
-        detected_git_version = pbgit.get_git_version()
+        # these probes are independent of each other, so run them all at once and report them in order below
+        (
+            detected_git_version,
+            detected_lfs_version,
+            detected_gcm_version,
+            remote_probe,
+            identity,
+            status,
+        ) = pbtools.gather(
+            pbgit.get_git_version_async(),
+            pbgit.get_lfs_version_async(),
+            pbgit.get_gcm_version_async(),
+            pbgit.check_remote_connection_async(),
+            pbgit.get_user_identity_async(),
+            pbstatus.get_status_async(),
+        )
+        # installing or removing tools below invalidates the probed versions
+        tools_changed = False
+
         supported_git_version = pbconfig.get("supported_git_version")
         needs_git_update = False
         if detected_git_version == supported_git_version:
@@ -101,6 +137,7 @@ def sync_handler(sync_val: str, repository_val=None):
                             )
                         else:
                             needs_git_update = False
+                            tools_changed = True
                             # reconfigure credential manager to make sure we have the proper path
                             pbtools.run([*pbgit.get_gcm_executable(), "configure"])
                         os.remove(download_path)
@@ -115,6 +152,7 @@ def sync_handler(sync_val: str, repository_val=None):
                         )
                     else:
                         needs_git_update = False
+                        tools_changed = True
                         input(
                             "Launching Git update, please press enter when done installing. "
                         )
@@ -152,6 +190,7 @@ def sync_handler(sync_val: str, repository_val=None):
                     for possible_lfs_path in possible_lfs_paths:
                         path = git_root / possible_lfs_path
                         if path.exists():
+                            tools_changed = True
                             try:
                                 if is_admin:
                                     path.unlink()
@@ -190,7 +229,8 @@ def sync_handler(sync_val: str, repository_val=None):
                 if bundled_git_lfs:
                     error_state()
 
-        detected_lfs_version = pbgit.get_lfs_version()
+        if tools_changed:
+            detected_lfs_version = pbgit.get_lfs_version()
         supported_lfs_version = pbconfig.get("supported_lfs_version")
         if detected_lfs_version == supported_lfs_version:
             pblog.info(f"Current Git LFS version: {detected_lfs_version}")
@@ -238,6 +278,7 @@ def sync_handler(sync_val: str, repository_val=None):
                             [pbgit.get_lfs_executable(), "install"], cwd=current_drive
                         )
                         needs_git_update = False
+                        tools_changed = True
                     os.remove(download_path)
 
             if needs_git_update:
@@ -254,6 +295,7 @@ def sync_handler(sync_val: str, repository_val=None):
                 for git_lfs_path in git_lfs_paths:
                     if supported_lfs_version == pbgit.get_lfs_version(git_lfs_path):
                         if index != 0:
+                            tools_changed = True
                             pblog.info(
                                 "Requesting admin permission to move installed Git LFS which is being overridden..."
                             )
@@ -279,7 +321,10 @@ def sync_handler(sync_val: str, repository_val=None):
                         break
                     index += 1
 
-        detected_gcm_version = pbgit.get_gcm_version()
+        # the credential helper needs repairs if the probe could not resolve it
+        gcm_repaired = detected_gcm_version is None
+        if tools_changed or gcm_repaired:
+            detected_gcm_version = pbgit.get_gcm_version()
         supported_gcm_version_raw = pbconfig.get("supported_gcm_version")
         supported_gcm_version = f"{supported_gcm_version_raw}"
         if detected_gcm_version == supported_gcm_version:
@@ -316,6 +361,7 @@ def sync_handler(sync_val: str, repository_val=None):
                         "credential.helper",
                     ]
                 )
+                pbgitsession.invalidate_config()
                 exe_location = detected_gcm_version.split(".", 1)[1]
                 # if they actually have a Windows program installed, inform them.
                 if exe_location.endswith(".exe"):
@@ -389,6 +435,7 @@ def sync_handler(sync_val: str, repository_val=None):
                             "credential.helper",
                         ]
                     )
+                    pbgitsession.invalidate_config()
                     pblog.error(
                         "Git Credential Manager failed due to an installation conflict, please launch UpdateProject again to finalize the installation."
                     )
@@ -403,7 +450,11 @@ def sync_handler(sync_val: str, repository_val=None):
         pblog.info("------------------")
 
         # Check our remote connection before doing anything
-        remote_state, remote_url = pbgit.check_remote_connection()
+        # the probe may have used a stale remote URL or credential helper, so check again after repairs
+        if remote_probe is None or gcm_repaired or tools_changed:
+            remote_state, remote_url = pbgit.check_remote_connection()
+        else:
+            remote_state, remote_url = remote_probe
         if not remote_state:
             error_state(
                 f"Remote connection was not successful. Please verify that you have an internet connection. Current git remote URL: {remote_url}"
@@ -417,26 +468,19 @@ def sync_handler(sync_val: str, repository_val=None):
         pbgit.setup_config()
 
         # Check if we have correct credentials
-        pbgit.check_credentials()
+        pbgit.check_credentials(identity)
 
         partial_sync = sync_val == "partial"
         is_ci = pbconfig.get("is_ci")
 
-        status_out = pbtools.run_with_combined_output(
-            [pbgit.get_git_executable(), "status", "-uno"]
-        ).stdout
         # continue a trivial rebase
-        if "rebase" in status_out:
-            if pbtools.it_has_any(
-                status_out,
-                "nothing to commit",
-                "git rebase --continue",
-                "all conflicts fixed",
-            ):
+        if pbgit.is_rebase_in_progress():
+            if status is not None and not status.unmerged:
                 pbunreal.ensure_ue_closed()
                 rebase_out = pbtools.run_with_combined_output(
                     [pbgit.get_git_executable(), "rebase", "--continue"]
                 ).stdout
+                pbstatus.invalidate()
                 if pbtools.it_has_any(rebase_out, "must edit all merge conflicts"):
                     # this is an improper state, since git told us otherwise before. abort all.
                     pbgit.abort_all()
@@ -456,13 +500,21 @@ def sync_handler(sync_val: str, repository_val=None):
                     "+refs/heads/*:refs/remotes/origin/*",
                 ]
             )
+            pbgitsession.invalidate_config()
+
+        # check out what the selected profiles need before pulling, so the rest is not downloaded
+        if not pbsparse.apply_profile():
+            pblog.warning("Sparse checkout profile could not be applied")
+        if not pblfsfilter.apply_profile():
+            pblog.warning("LFS fetch profile could not be applied")
 
         # Execute synchronization part of script if we're on the expected branch, or force sync is enabled
         if sync_val == "force" or pbgit.is_on_expected_branch():
             if partial_sync:
                 pbtools.maintain_repo()
             else:
-                pbtools.resolve_conflicts_and_pull()
+                with pbtools.phase_timeout(pbtools.get_timeout("pull_phase")):
+                    pbtools.resolve_conflicts_and_pull(fast=fast)
 
                 pblog.info("------------------")
 
@@ -486,7 +538,8 @@ def sync_handler(sync_val: str, repository_val=None):
 
             if needs_binaries_pull:
                 pblog.info("Binaries are not up to date, pulling new binaries...")
-                ret = pbgh.pull_binaries(project_version)
+                with pbtools.phase_timeout(pbtools.get_timeout("binaries_phase")):
+                    ret = pbgh.pull_binaries(project_version)
                 if ret == 0:
                     pblog.success("Binaries were pulled successfully!")
                 elif ret < 0:
@@ -507,13 +560,17 @@ def sync_handler(sync_val: str, repository_val=None):
         elif pbconfig.get_user_config().getboolean(
             "project", "autosync", fallback=True
         ):
-            pbtools.resolve_conflicts_and_pull()
+            pbtools.resolve_conflicts_and_pull(fast=fast)
         else:
             pblog.info(
                 f"Current branch does not need auto synchronization: {pbgit.get_current_branch_name()}."
             )
             pbtools.maintain_repo()
 
+        # the worktrees of the other branches stay current, so switching to them is instant
+        if not partial_sync and not pbworktree.update_pool():
+            pblog.warning("Some branch worktrees could not be updated")
+
         symbols_needed = pbunreal.is_versionator_symbols_enabled()
         pbunreal.clean_binaries_folder(not symbols_needed)
 
@@ -543,7 +600,11 @@ def sync_handler(sync_val: str, repository_val=None):
 
             bundle_name = pbunreal.get_bundle()
 
-            if pbunreal.download_engine(bundle_name, symbols_needed):
+            with pbtools.phase_timeout(pbtools.get_timeout("engine_phase")):
+                engine_registered = pbunreal.download_engine(
+                    bundle_name, symbols_needed
+                )
+            if engine_registered:
                 pblog.info(
                     f"Engine build {bundle_name}-{engine_version} successfully registered"
                 )
@@ -586,7 +647,7 @@ def sync_handler(sync_val: str, repository_val=None):
             os.startfile(pbunreal.get_sln_path())
         elif launch_pref == "rider":
             rider_bin = pbtools.get_one_line_output(
-                ["echo", "%Rider for Unreal Engine%"]
+                ["echo", "%Rider for Unreal Engine%"], shell=True
             )
             rider_bin = rider_bin.replace(";", "")
             rider_bin = rider_bin.replace('"', "")
@@ -649,6 +710,16 @@ def sync_handler(sync_val: str, repository_val=None):
         else:
             error_state(f"Failed to pull binaries for {project_version}")
 
+    elif sync_val == "verify-lfs":
+        remaining = pbgit.repair_lfs_pointers()
+        if remaining:
+            for file in remaining:
+                pblog.error(f"{file} is still an LFS pointer")
+            error_state(
+                f"{len(remaining)} LFS files could not be checked out. Please get help in {pbconfig.get('support_channel')}"
+            )
+        pblog.info("All LFS files are checked out")
+
     elif sync_val == "engine":
         # Pull engine build with ueversionator and register it
         bundle_name = pbunreal.get_bundle()
@@ -731,6 +802,77 @@ def printversion_handler(print_val, repository_val=None):
         print(project_version, end="")
 
 
+benchmark_hooks = {
+    "spawn": pbtools.benchmark_spawn,
+}
+
+
+def benchmark_handler(benchmark_val):
+    benchmark_hooks[benchmark_val]()
+
+
+prefetch_hooks = {
+    "daemon": pbprefetch.run_daemon,
+    "once": pbprefetch.run_once,
+    "register": pbprefetch.register,
+    "unregister": pbprefetch.unregister,
+}
+
+
+def prefetch_handler(prefetch_val):
+    if prefetch_hooks[prefetch_val]() is False:
+        error_state(f"Prefetch {prefetch_val} failed")
+
+
+partialclone_hooks = {
+    "measure": pbpartialclone.print_size,
+    "convert": pbpartialclone.convert,
+}
+
+
+def partialclone_handler(partialclone_val):
+    if partialclone_hooks[partialclone_val]() is False:
+        error_state(f"Partial clone {partialclone_val} failed")
+
+
+maintain_hooks = {
+    "run": pbmaintenance.run,
+    "plan": pbmaintenance.print_plan,
+    "status": pbmaintenance.print_status,
+}
+
+
+def maintain_handler(maintain_val):
+    if maintain_hooks[maintain_val]() is False:
+        error_state(f"Maintenance {maintain_val} failed")
+
+
+tune_hooks = {
+    "run": pbtune.tune,
+    "force": partial(pbtune.tune, True),
+    "show": pbtune.show,
+}
+
+
+def tune_handler(tune_val):
+    if tune_hooks[tune_val]() is False:
+        error_state(f"Tuning {tune_val} failed")
+
+
+def switch_handler(switch_val):
+    if not pbworktree.switch(switch_val):
+        error_state(f"Could not switch to {switch_val}")
+
+
+def hydrate_handler(hydrate_val):
+    remaining = pblfsfilter.hydrate(hydrate_val)
+    if remaining:
+        for file in remaining:
+            pblog.error(f"{file} is still an LFS pointer")
+        error_state(f"{len(remaining)} LFS files could not be hydrated")
+    pblog.success("Requested LFS files are checked out")
+
+
 def autoversion_handler(autoversion_val):
     if pbunreal.project_version_increase(autoversion_val):
         pblog.info("Successfully increased project version")
@@ -796,10 +938,16 @@ def main(argv):
             "engineversion",
             "engine",
             "force",
+            "verify-lfs",
         ],
         const="all",
         nargs="?",
     )
+    parser.add_argument(
+        "--fast",
+        help="Skips smudging while pulling, and checks out LFS files in parallel afterwards. Can also be enabled with fastsync in the project section of the user config",
+        action="store_true",
+    )
     parser.add_argument(
         "--printversion",
         help="Prints requested version information into console.",
@@ -837,6 +985,42 @@ def main(argv):
         const="default",
         nargs="?",
     )
+    parser.add_argument(
+        "--benchmark",
+        help="Measures the cost of an internal operation in the current workspace",
+        choices=list(benchmark_hooks.keys()),
+    )
+    parser.add_argument(
+        "--hydrate",
+        help="Fetches and checks out LFS files which the LFS fetch profile left as pointers, by path or glob",
+        nargs="+",
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="Fetches upcoming changes and their LFS content in the background at low priority. register starts the daemon at login",
+        choices=list(prefetch_hooks.keys()),
+    )
+    parser.add_argument(
+        "--maintain",
+        help="Runs the repository maintenance tasks one at a time at low priority, shows which tasks the repository needs, or shows the status of the last runs",
+        choices=list(maintain_hooks.keys()),
+    )
+    parser.add_argument(
+        "--tune",
+        help="Measures git settings in this clone and applies the fastest ones, force also removes the settings of .git/config which override them, or shows what earlier runs changed and why",
+        nargs="?",
+        const="run",
+        choices=list(tune_hooks.keys()),
+    )
+    parser.add_argument(
+        "--switch",
+        help="Switches to a configured branch through its own worktree, which shares the git and LFS objects of this clone, instead of checking it out here",
+    )
+    parser.add_argument(
+        "--partialclone",
+        help="Measures the size of .git, or converts the clone in place into a partial clone which fetches file contents from history only when needed",
+        choices=list(partialclone_hooks.keys()),
+    )
     parser.add_argument(
         "--debugpath", help="If provided, PBSync will run in provided path"
     )
@@ -872,6 +1056,7 @@ def main(argv):
             "git_url": ("git/url", None, None, True),
             "branches": ("git/branches/branch", None, ["main"], False),
             "log_file_path": ("log/file", None, "pbsync_log.txt", True),
+            "trace_file_path": ("log/trace", None, None, True),
             "user_config": ("project/userconfig", None, ".user-sync", True),
             "ci_config": ("project/ciconfig", None, ".ci-sync", True),
             "uev_default_bundle": ("versionator/defaultbundle", None, "editor", True),
@@ -934,11 +1119,42 @@ def main(argv):
         if missing_keys:
             raise KeyError("Missing keys: %s" % ", ".join(missing_keys))
 
+        # sparse checkout profiles, by name
+        config_map["sparse_profiles"] = {
+            profile.get("name"): [
+                dir.text for dir in profile.findall("dir") if dir.text
+            ]
+            for profile in root.findall("sparse/profile")
+            if profile.get("name")
+        }
+        # LFS fetch profiles, by name
+        config_map["lfs_profiles"] = {
+            profile.get("name"): {
+                key: [pattern.text for pattern in profile.findall(key) if pattern.text]
+                for key in ("include", "exclude")
+            }
+            for profile in root.findall("lfs/profile")
+            if profile.get("name")
+        }
+
         return config_map
 
     # Preparation
     config_handler(args.config, pbsync_config_parser_func)
     pblog.setup_logger(pbconfig.get("log_file_path"))
+    # tracing is opt in through log/trace, since it samples every process it spawns
+    trace_file_path = pbconfig.config.get("trace_file_path")
+    if trace_file_path:
+        # maintenance and prefetch run next to the sync which started them, and each get a trace of their own
+        if args.maintain == "run":
+            trace_file_path = pbtrace.get_process_trace_path(
+                trace_file_path, "maintain"
+            )
+        elif args.prefetch in ("daemon", "once"):
+            trace_file_path = pbtrace.get_process_trace_path(
+                trace_file_path, "prefetch"
+            )
+        pbtrace.setup_trace(trace_file_path)
 
     # Do not process further if we're in an error state
     if pbtools.check_error_state():
@@ -961,13 +1177,27 @@ def main(argv):
     if not (args.clean is None):
         clean_handler(args.clean)
     if not (args.sync is None):
-        sync_handler(args.sync, args.repository)
+        sync_handler(args.sync, args.repository, args.fast)
     if not (args.autoversion is None):
         autoversion_handler(args.autoversion)
     if not (args.build is None):
         build_handler(args.build)
     if not (args.publish is None):
         publish_handler(args.publish)
+    if not (args.benchmark is None):
+        benchmark_handler(args.benchmark)
+    if not (args.prefetch is None):
+        prefetch_handler(args.prefetch)
+    if not (args.hydrate is None):
+        hydrate_handler(args.hydrate)
+    if not (args.partialclone is None):
+        partialclone_handler(args.partialclone)
+    if not (args.switch is None):
+        switch_handler(args.switch)
+    if not (args.maintain is None):
+        maintain_handler(args.maintain)
+    if not (args.tune is None):
+        tune_handler(args.tune)
 
     pbconfig.shutdown()
 
@@ -0,0 +1,118 @@
+import configparser
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pbpy import (  # noqa: E402
+    pbconfig,
+    pbgit,
+    pbgitattributes,
+    pbgitindex,
+    pbgitmeta,
+    pbgitsession,
+    pbstatus,
+)
+
+
+def git(*args, cwd=None, input=None, env=None):
+    """Runs git, and returns its stdout. Fails the test if git fails."""
+    proc = subprocess.run(
+        ["git", *args],
+        cwd=cwd,
+        input=input,
+        capture_output=True,
+        env=None if env is None else {**os.environ, **env},
+    )
+    assert proc.returncode == 0, proc.stderr.decode(errors="replace")
+    return proc.stdout.decode("utf-8", errors="surrogateescape")
+
+
+def write(path, content):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(content, str):
+        content = content.encode()
+    path.write_bytes(content)
+
+
+def clear_caches():
+    pbgitsession.close_sessions()
+    pbgitsession.sessions.clear()
+    pbgitattributes.engine_cache.clear()
+    pbgitattributes.nested_paths_cache.clear()
+    pbgitindex.index_cache.clear()
+    pbgitmeta.packed_refs_cache.clear()
+    pbstatus.snapshots.clear()
+    pbgit.get_git_executable.cache_clear()
+    pbgit.get_lfs_executable.cache_clear()
+    pbgit.get_current_branch_name.cache_clear()
+    pbgit.get_binaries_mode.cache_clear()
+    pbgit.is_on_expected_branch.cache_clear()
+
+
+@pytest.fixture(autouse=True)
+def git_env(tmp_path, monkeypatch):
+    """Keeps git away from the user's and the system's config, and PBSync away from its own."""
+    home = tmp_path / "home"
+    home.mkdir()
+    monkeypatch.setenv("HOME", str(home))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(home / ".config"))
+    monkeypatch.setenv("GIT_ATTR_NOSYSTEM", "1")
+    for name in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{name}_NAME", "PBSync Tests")
+        monkeypatch.setenv(f"GIT_{name}_EMAIL", "tests@pbsync.invalid")
+    for name in ("GIT_DIR", "GIT_WORK_TREE", "GIT_INDEX_FILE", "GIT_CONFIG_COUNT"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(
+        pbconfig,
+        "config",
+        {
+            "branches": ["main"],
+            "expected_branch_names": ["main"],
+            "is_ci": False,
+            "user_config": ".user-sync",
+            "support_channel": "#support",
+            "log_file_path": "pbsync_log.txt",
+        },
+    )
+    monkeypatch.setattr(pbconfig, "user_config", configparser.ConfigParser())
+    clear_caches()
+    yield home
+    clear_caches()
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    """An empty repository on main, which is also the working directory."""
+    path = tmp_path / "repo"
+    path.mkdir()
+    git("init", "-q", "-b", "main", cwd=path)
+    monkeypatch.chdir(path)
+    return path
+
+
+@pytest.fixture
+def lfs(tmp_path, monkeypatch):
+    """Puts the git-lfs stand-in on PATH, with an empty directory as its server, and returns the server directory."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    stub = Path(__file__).resolve().parent / "lfs_stub.py"
+    if os.name == "nt":
+        write(bin_dir / "git-lfs.cmd", f'@"{sys.executable}" "{stub}" %*\r\n')
+    else:
+        script = bin_dir / "git-lfs"
+        write(script, f'#!/bin/sh\nexec "{sys.executable}" "{stub}" "$@"\n')
+        script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    server = tmp_path / "lfs-server"
+    server.mkdir()
+    git("config", "--global", "filter.lfs.clean", "git-lfs clean -- %f")
+    git("config", "--global", "filter.lfs.smudge", "git-lfs smudge -- %f")
+    git("config", "--global", "filter.lfs.required", "true")
+    git("config", "--global", "lfs.url", server.as_uri())
+    return server
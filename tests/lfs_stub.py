@@ -0,0 +1,169 @@
+"""A stand-in for git-lfs, for the commands PBSync runs, with a directory as the LFS server.
+
+The server is the directory lfs.url points to with a file:// URL, laid out like the local object store.
+Objects are stored and looked up by their sha256, in .git/lfs/objects/<aa>/<bb>/<oid>.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+
+version = "git-lfs/3.4.0 (PBSync test stub)"
+pointer_template = (
+    "version https://git-lfs.github.com/spec/v1\noid sha256:{oid}\nsize {size}\n"
+)
+
+
+def git(*args, input=None, check=True):
+    proc = subprocess.run(["git", *args], input=input, capture_output=True)
+    if proc.returncode and check:
+        sys.stderr.buffer.write(proc.stderr)
+        sys.exit(proc.returncode)
+    return proc.stdout
+
+
+def get_local_store():
+    common_dir = git("rev-parse", "--path-format=absolute", "--git-common-dir")
+    return Path(common_dir.decode().strip()) / "lfs" / "objects"
+
+
+def get_remote_store():
+    url = git("config", "lfs.url").decode().strip()
+    return Path(unquote(urlparse(url).path))
+
+
+def get_object_path(store, oid):
+    return store / oid[:2] / oid[2:4] / oid
+
+
+def parse_pointer(data):
+    if not data.startswith(b"version https://git-lfs.github.com/spec/v1\n"):
+        return None
+    for line in data.decode().splitlines():
+        if line.startswith("oid sha256:"):
+            return line[len("oid sha256:") :]
+    return None
+
+
+def copy_object(source, destination, oid):
+    source_path = get_object_path(source, oid)
+    destination_path = get_object_path(destination, oid)
+    if destination_path.exists() or not source_path.exists():
+        return destination_path.exists()
+    destination_path.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(source_path, destination_path)
+    return True
+
+
+def clean():
+    data = sys.stdin.buffer.read()
+    if parse_pointer(data) is not None:
+        sys.stdout.buffer.write(data)
+        return 0
+    oid = hashlib.sha256(data).hexdigest()
+    path = get_object_path(get_local_store(), oid)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    sys.stdout.write(pointer_template.format(oid=oid, size=len(data)))
+    return 0
+
+
+def smudge():
+    data = sys.stdin.buffer.read()
+    oid = parse_pointer(data)
+    if oid is None or os.getenv("GIT_LFS_SKIP_SMUDGE") == "1":
+        sys.stdout.buffer.write(data)
+        return 0
+    local = get_local_store()
+    if not copy_object(get_remote_store(), local, oid):
+        sys.stderr.write(f"Object {oid} not found on the server\n")
+        return 2
+    sys.stdout.buffer.write(get_object_path(local, oid).read_bytes())
+    return 0
+
+
+def fetch(args):
+    # git lfs fetch <remote> <ref> -I <path>,<path>, where PBSync only includes exact paths
+    paths = []
+    positional = []
+    args = iter(args)
+    for arg in args:
+        if arg in ("-I", "--include"):
+            paths.extend(path for path in next(args, "").split(",") if path)
+        elif not arg.startswith("-"):
+            positional.append(arg)
+    ref = positional[1] if len(positional) > 1 else "HEAD"
+    local = get_local_store()
+    remote = get_remote_store()
+    failed = 0
+    for path in paths:
+        # like git lfs, paths which are not at ref are left out
+        oid = parse_pointer(git("cat-file", "blob", f"{ref}:{path}", check=False))
+        if oid is not None and not copy_object(remote, local, oid):
+            sys.stderr.write(f"Object {oid} for {path} not found on the server\n")
+            failed = 2
+    return failed
+
+
+def checkout(args):
+    paths = args[args.index("--") + 1 :] if "--" in args else args
+    local = get_local_store()
+    checked_out = []
+    for path in paths:
+        oid = parse_pointer(git("cat-file", "blob", f":{path}"))
+        if oid is None:
+            continue
+        object_path = get_object_path(local, oid)
+        if not object_path.exists():
+            sys.stderr.write(f"Skipped checking out {path}, its object is missing\n")
+            continue
+        shutil.copyfile(object_path, path)
+        checked_out.append(path)
+    if checked_out:
+        # git lfs refreshes the index for what it checked out
+        git(
+            "update-index",
+            "-q",
+            "--refresh",
+            "-z",
+            "--stdin",
+            input="\0".join(checked_out).encode(),
+        )
+    return 0
+
+
+def push():
+    local = get_local_store()
+    remote = get_remote_store()
+    for path in local.rglob("*"):
+        if path.is_file():
+            copy_object(local, remote, path.name)
+    return 0
+
+
+def main(args):
+    command = args[0] if args else ""
+    if command in ("version", "--version"):
+        print(version)
+        return 0
+    if command == "clean":
+        return clean()
+    if command == "smudge":
+        return smudge()
+    if command == "fetch":
+        return fetch(args[1:])
+    if command == "checkout":
+        return checkout(args[1:])
+    if command == "push":
+        return push()
+    sys.stderr.write(f"The stub does not support git lfs {command}\n")
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,141 @@
+import os
+import random
+import time
+from pathlib import Path
+
+import pytest
+from conftest import clear_caches, git, write
+
+from pbpy import pbgit, pbtools, pbunreal
+
+attributes = "*.uasset filter=lfs diff=lfs merge=lfs -text\n*.umap filter=lfs diff=lfs merge=lfs -text\n"
+
+
+def push(path):
+    git("push", "-q", "origin", "main", cwd=path)
+    git("lfs", "push", "origin", "--all", cwd=path)
+
+
+def seed(upstream, rng):
+    write(upstream / ".gitattributes", attributes)
+    for i in range(24):
+        folder = "Maps" if i % 4 == 0 else "Props"
+        extension = "umap" if i % 4 == 0 else "uasset"
+        write(
+            upstream / f"Content/{folder}/Asset{i}.{extension}", rng.randbytes(2048 + i)
+        )
+    for i in range(12):
+        write(
+            upstream / f"Source/Game/File{i}.cpp",
+            f"// file {i}\nint f{i}() {{ return {i}; }}\n",
+        )
+    write(upstream / "Config/DefaultGame.ini", "[/Script/Game]\nVersion=1\n")
+    git("add", "-A", cwd=upstream)
+    git("commit", "-q", "-m", "seed", cwd=upstream)
+    push(upstream)
+
+
+def change(upstream, rng):
+    # modified, added, removed and renamed LFS files, along with source changes
+    for i in range(1, 24, 3):
+        path = upstream / f"Content/Props/Asset{i}.uasset"
+        if path.exists():
+            write(path, rng.randbytes(3000 + i))
+    write(upstream / "Content/Maps/Asset0.umap", rng.randbytes(5000))
+    for i in range(6):
+        write(upstream / f"Content/New/NewAsset{i}.uasset", rng.randbytes(1500 + i))
+    git("rm", "-q", "Content/Props/Asset2.uasset", cwd=upstream)
+    git(
+        "mv",
+        "Content/Props/Asset3.uasset",
+        "Content/Props/Renamed3.uasset",
+        cwd=upstream,
+    )
+    write(
+        upstream / "Source/Game/File0.cpp",
+        "// changed upstream\nint f0() { return 42; }\n",
+    )
+    write(upstream / "Config/DefaultGame.ini", "[/Script/Game]\nVersion=2\n")
+    git("add", "-A", cwd=upstream)
+    git("commit", "-q", "-m", "upstream changes", cwd=upstream)
+    push(upstream)
+
+
+def commit_local_change(path):
+    # touches nothing upstream changed, so the rebase applies cleanly
+    write(
+        path / "Source/Game/File11.cpp",
+        "// changed locally\nint f11() { return 11; }\n",
+    )
+    git("commit", "-q", "-am", "local change", cwd=path)
+
+
+def read_tree(path):
+    files = {}
+    for root, dirs, names in os.walk(path):
+        dirs[:] = [dir for dir in dirs if dir != ".git"]
+        for name in names:
+            file = Path(root, name)
+            files[file.relative_to(path).as_posix()] = file.read_bytes()
+    return files
+
+
+def sync(path, fast, monkeypatch):
+    monkeypatch.chdir(path)
+    clear_caches()
+    git("fetch", "-q", "origin")
+    start = time.perf_counter()
+    pbtools.resolve_conflicts_and_pull(fast=fast)
+    elapsed = time.perf_counter() - start
+    clear_caches()
+    return elapsed
+
+
+@pytest.fixture
+def workspaces(tmp_path, lfs, monkeypatch):
+    # there is no editor to close here
+    monkeypatch.setattr(pbunreal, "is_ue_closed", lambda project_path=None: True)
+    # nor background maintenance to start after the sync
+    monkeypatch.setattr(pbtools, "maintain_repo", lambda: None)
+    rng = random.Random(15)
+    remote = tmp_path / "remote.git"
+    git("init", "-q", "--bare", "-b", "main", str(remote))
+    upstream = tmp_path / "upstream"
+    git("clone", "-q", str(remote), str(upstream))
+    seed(upstream, rng)
+    classic = tmp_path / "classic"
+    fast = tmp_path / "fast"
+    git("clone", "-q", str(remote), str(classic))
+    git("clone", "-q", str(remote), str(fast))
+    change(upstream, rng)
+    return classic, fast
+
+
+@pytest.mark.parametrize("local_commit", [False, True], ids=["fast-forward", "rebase"])
+def test_fast_sync_matches_classic_sync(
+    workspaces, local_commit, monkeypatch, record_property
+):
+    classic, fast = workspaces
+    if local_commit:
+        commit_local_change(classic)
+        commit_local_change(fast)
+
+    classic_seconds = sync(classic, False, monkeypatch)
+    fast_seconds = sync(fast, True, monkeypatch)
+    print(f"classic sync: {classic_seconds:.2f}s, fast sync: {fast_seconds:.2f}s")
+    record_property("classic_seconds", classic_seconds)
+    record_property("fast_seconds", fast_seconds)
+
+    assert git("rev-parse", "HEAD^{tree}", cwd=classic) == git(
+        "rev-parse", "HEAD^{tree}", cwd=fast
+    )
+    assert git("rev-parse", "origin/main", cwd=fast) in git(
+        "rev-list", "HEAD", cwd=fast
+    )
+    assert git("ls-files", "-s", cwd=classic) == git("ls-files", "-s", cwd=fast)
+    assert read_tree(classic) == read_tree(fast)
+    for path in (classic, fast):
+        assert git("status", "--porcelain", cwd=path) == ""
+        monkeypatch.chdir(path)
+        clear_caches()
+        assert pbgit.find_lfs_pointers() == {}
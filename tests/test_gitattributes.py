@@ -0,0 +1,169 @@
+import itertools
+import time
+
+from conftest import git, write
+
+from pbpy import pbgitattributes, pbgitsession
+
+attrs = (
+    "text",
+    "eol",
+    "filter",
+    "diff",
+    "merge",
+    "lockable",
+    "generated",
+    "linguist",
+    "custom",
+    "nomacro",
+)
+
+root_attributes = """\
+[attr]asset lockable filter=lfs diff=lfs merge=lfs -text
+*.uasset asset
+*.[Uu][Mm][Aa][Pp] asset
+*.txt text eol=lf
+*.bin binary !custom
+**/Generated/** -text generated
+docs/**/*.md linguist=doc
+Source/**/Private/*.cpp custom=private
+Content/ custom=directory
+"a b.txt" custom=quoted
+/README custom=rooted
+!*.txt custom=negated
+# a comment, and a line which only names a pattern
+*.log
+"""
+
+source_attributes = """\
+*.txt -text
+Private/** custom=nested
+[attr]nomacro text
+*.h nomacro custom=header
+Build/ custom=directory
+Build/* custom=build
+"""
+
+maps_attributes = """\
+*.umap !filter lockable=maps
+* -custom
+"""
+
+info_attributes = """\
+*.log -diff custom=info
+"""
+
+dirs = [
+    "",
+    "Source",
+    "Source/Game/Private",
+    "Source/Build",
+    "Content",
+    "Content/Maps",
+    "Content/Maps/Generated",
+    "docs/a/b",
+    "x/Generated/y",
+    "Build",
+]
+names = [
+    "a.txt",
+    "b.uasset",
+    "M.UMAP",
+    "c.umap",
+    "d.bin",
+    "e.cpp",
+    "f.h",
+    "g.md",
+    "a b.txt",
+    "Build",
+    "Content",
+    "README",
+    "h.log",
+]
+
+
+def make_tree():
+    write(".gitattributes", root_attributes)
+    write("Source/.gitattributes", source_attributes)
+    write("Content/Maps/.gitattributes", maps_attributes)
+    write(".git/info/attributes", info_attributes)
+    # nested attributes files are found through the index
+    git("add", ".gitattributes", "Source/.gitattributes", "Content/Maps/.gitattributes")
+    return [
+        f"{dir}/{name}" if dir else name for dir, name in itertools.product(dirs, names)
+    ]
+
+
+def check_attr(paths):
+    output = git("check-attr", "--stdin", "-z", *attrs, input="\0".join(paths).encode())
+    records = output.split("\0")
+    values = []
+    # path, attribute and value, for each attribute of each path
+    step = 3 * len(attrs)
+    for i in range(0, len(paths) * step, step):
+        values.append(
+            dict(zip(records[i + 1 : i + step : 3], records[i + 2 : i + step : 3]))
+        )
+    return values
+
+
+def diff_against_git(paths):
+    expected = check_attr(paths)
+    actual = pbgitattributes.check_attr_paths(paths, *attrs)
+    return [
+        (path, attr, want[attr], got[attr])
+        for path, want, got in zip(paths, expected, actual)
+        for attr in attrs
+        if want[attr] != got[attr]
+    ]
+
+
+def test_matches_check_attr(repo):
+    paths = make_tree()
+    assert diff_against_git(paths) == []
+
+
+def test_matches_check_attr_ignoring_case(repo):
+    paths = make_tree()
+    git("config", "core.ignorecase", "true")
+    pbgitsession.invalidate_config()
+    cased = []
+    for path in paths:
+        dir, _, name = path.rpartition("/")
+        cased += [
+            f"{dir}/{name.upper()}".lstrip("/"),
+            f"{dir}/{name.lower()}".lstrip("/"),
+        ]
+        # git opens nested attributes files by the path asked about, which only finds them on case insensitive file systems
+        if not path.startswith(("Source/", "Content/Maps/")):
+            cased += [path.upper(), path.lower()]
+    assert diff_against_git(paths + cased) == []
+
+
+def test_later_files_change_the_answer(repo):
+    paths = make_tree()
+    assert diff_against_git(paths) == []
+    write(".gitattributes", root_attributes + "*.txt -text custom=late\n")
+    assert diff_against_git(paths) == []
+
+
+def test_classifies_many_paths_quickly(repo):
+    lfs_extensions = ("uasset", "umap", "png", "wav", "fbx")
+    write(
+        ".gitattributes",
+        "".join(f"*.{ext} filter=lfs -text\n" for ext in lfs_extensions),
+    )
+    extensions = (*lfs_extensions, "cpp", "h", "ini")
+    paths = [
+        f"Content/Dir{i % 997}/Asset{i}.{extensions[i % len(extensions)]}"
+        for i in range(1_000_000)
+    ]
+    pbgitattributes.get_attr_values(paths[:10], "filter")
+    start = time.perf_counter()
+    values = pbgitattributes.get_attr_values(paths, "filter")
+    elapsed = time.perf_counter() - start
+    assert values.count("lfs") == sum(
+        1 for path in paths if path.rpartition(".")[2] in lfs_extensions
+    )
+    # well under a second on a developer machine, with headroom for slow CI runners
+    assert elapsed < 3, f"Classified {len(paths)} paths in {elapsed:.2f}s"
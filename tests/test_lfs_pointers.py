@@ -0,0 +1,83 @@
+import os
+import random
+
+import pytest
+from conftest import git, write
+
+from pbpy import pbgit
+
+attributes = "*.uasset filter=lfs diff=lfs merge=lfs -text\n*.umap filter=lfs diff=lfs merge=lfs -text\n"
+
+
+def make_assets(count):
+    rng = random.Random(count)
+    assets = {}
+    for i in range(count):
+        # a few are small enough to be sized like pointers, without being one
+        size = 200 if i % 5 == 0 else 4096 + i
+        path = f"Content/{'Maps' if i % 3 == 0 else 'Props'}/Asset{i}.{'umap' if i % 3 == 0 else 'uasset'}"
+        assets[path] = rng.randbytes(size)
+    return assets
+
+
+@pytest.fixture
+def lfs_repo(repo, lfs):
+    write(".gitattributes", attributes)
+    assets = make_assets(12)
+    for path, content in assets.items():
+        write(path, content)
+    write("Source/Game.cpp", "int main() {}\n")
+    git("add", "-A")
+    git("commit", "-q", "-m", "assets")
+    git("lfs", "push", "origin", "--all")
+    return assets
+
+
+def unsmudge(path):
+    # what a skipped or failed smudge leaves behind
+    write(path, git("cat-file", "blob", f":{path}"))
+
+
+def remove_local_object(path):
+    oid = pbgit.read_lfs_pointer(path)
+    (pbgit.get_lfs_storage_dir() / "objects" / oid[:2] / oid[2:4] / oid).unlink()
+
+
+def test_finds_only_pointers(lfs_repo):
+    assert pbgit.find_lfs_pointers() == {}
+    pointers = sorted(lfs_repo)[::3]
+    for path in pointers:
+        unsmudge(path)
+    found = pbgit.find_lfs_pointers()
+    assert sorted(found) == pointers
+    for path, oid in found.items():
+        assert git("cat-file", "blob", f":{path}").split("oid sha256:")[1][:64] == oid
+    assert pbgit.find_lfs_pointers(["Source/Game.cpp", pointers[0]]) == {
+        pointers[0]: found[pointers[0]]
+    }
+
+
+@pytest.mark.parametrize("processes", [1, 4])
+def test_repairs_pointers(lfs_repo, processes):
+    pointers = sorted(lfs_repo)[1::2]
+    for path in pointers:
+        unsmudge(path)
+    # some objects only the server has left
+    for path in pointers[::2]:
+        remove_local_object(path)
+    assert pbgit.repair_lfs_pointers(checkout_processes=processes) == []
+    for path, content in lfs_repo.items():
+        with open(path, "rb") as f:
+            assert f.read() == content, path
+    assert pbgit.find_lfs_pointers() == {}
+    assert git("status", "--porcelain") == ""
+
+
+def test_reports_pointers_it_cannot_repair(lfs_repo, lfs):
+    path = sorted(lfs_repo)[0]
+    unsmudge(path)
+    oid = pbgit.read_lfs_pointer(path)
+    remove_local_object(path)
+    (lfs / oid[:2] / oid[2:4] / oid).unlink()
+    assert pbgit.repair_lfs_pointers() == [path]
+    assert os.path.getsize(path) < pbgit.lfs_pointer_max_size